@@ -1,6 +1,7 @@
 # Copyright 2008 Anton Mellit
 
 import context
+import events
 
 class StaticAllocator(context.State):
     ''' A simple allocator which allocates addresses from a given list
@@ -16,23 +17,47 @@ class StaticAllocator(context.State):
     def alloc(self):
         address = self._available.pop()
         self._used.append(address)
+        if events.alloc.fire is not None:
+            events.alloc.fire(self, address)
         return address
 
+    ''' Allocates nbytes free addresses which follow each other, returns
+    them lowest first'''
+    def alloc_long(self, nbytes):
+        free = dict(((a.address, a.use_bsr), a) for a in self._available)
+        for a in sorted(self._available, key=lambda a: -a.address):
+            run = [free.get((a.address + i, a.use_bsr))
+                    for i in range(nbytes)]
+            if None not in run:
+                break
+        else:
+            raise ValueError('no %d free bytes in a row' % nbytes)
+        for address in run:
+            self._available.remove(address)
+            self._used.append(address)
+            if events.alloc.fire is not None:
+                events.alloc.fire(self, address)
+        return run
+
     ''' Frees the address previously allocated'''
     def free(self, address):
         assert address in self._used
         self._used.remove(address)
         self._available.append(address)
+        if events.free.fire is not None:
+            events.free.fire(self, address)
 
     def child(self):
         return StaticAllocator(list(self._available))
 
     def close(self):
-        print 'close allocator'
         assert not self._used
 
 def alloc():
     return context.get_context().allocator.alloc()
 
+def alloc_long(nbytes):
+    return context.get_context().allocator.alloc_long(nbytes)
+
 def free(address):
     context.get_context().allocator.free(address)
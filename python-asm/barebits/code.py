@@ -2,34 +2,321 @@
 
 """ Basics of code generation """
 
+from array import array
+
 from context import get_context, State
+import events
+
+def add_cycles(a, b):
+    """ Adds two pairs (min, max) of cycle counts, max is None if the
+    execution time is not bounded """
+    if a[1] is None or b[1] is None:
+        return (a[0]+b[0], None)
+    return (a[0]+b[0], a[1]+b[1])
+
+def mul_cycles(a, n):
+    """ Multiplies a pair (min, max) of cycle counts by n """
+    if a[1] is None:
+        return (a[0]*n, None)
+    return (a[0]*n, a[1]*n)
+
+
+class Fixup:
+    """ Base class of the operands whose value is only known when the code
+    is finished (e.g. virtual registers). Instructions with such operands
+    are listed in CodeMaker.fixups to be encoded again later. resolved is
+    set once the value is known. """
+    resolved = False
+
+
+class Label(Fixup):
+    """ Position in the output of a CodeMaker, the operand of absolute
+    jumps. pos follows the code when it is plugged into another CodeMaker;
+    link gives the label its address. Until then CodeMaker encodes it as 0
+    and int() of it raises ValueError.
+
+    pos -- position in words
+    address -- address in bytes or None
+
+    """
+    def __init__(self, pos):
+        self.pos = pos
+        self.address = None
+
+    def __int__(self):
+        """ The word address, as jump instructions take it """
+        if self.address is None:
+            raise ValueError('label L%d has no address, the code is not '
+                                'linked (see program origin)' % self.pos)
+        return self.address >> 1
+
+    def __and__(self, mask):
+        return int(self) & mask
+
+    def __rshift__(self, n):
+        return int(self) >> n
+
+    def __repr__(self):
+        if self.address is None:
+            return 'L%d' % self.pos
+        return '0x%x' % self.address
+
+
+def _placeholders(args):
+    """ args with the Labels which have no address replaced by 0 """
+    return [0 if isinstance(arg, Label) and arg.address is None else arg
+            for arg in args]
+
+def unresolved_labels(code):
+    """ True if instructions of the CodeMaker code jump to Labels which
+    have no address """
+    return any(isinstance(arg, Label) and arg.address is None
+                for fixup in code.fixups.itervalues() for arg in fixup[1:])
+
+
+class Block:
+    """ Report on a block of code generated by a control statement.
+
+    kind -- 'program', 'block', 'if', 'while', 'for'
+    name -- name given to the statement or None
+    offset -- position of the first word, relative to the enclosing block
+    words -- length in words
+    cycles -- pair (min, max) of execution times in instruction cycles,
+    max is None if the time is not bounded
+    iterations -- number of iterations of a loop if it is known
+    iteration -- pair (min, max) of cycles of one iteration of a loop
+    body -- position of the body of a loop relative to offset, the words
+    before it are the test which runs once more than the body
+    children -- list of the blocks nested in this one
+    
+    """
+    def __init__(self, kind, name, offset):
+        self.kind = kind
+        self.name = name
+        self.offset = offset
+        self.words = 0
+        self.cycles = (0, 0)
+        self.iterations = None
+        self.iteration = None
+        self.body = None
+        self.children = []
+
+    def to_dict(self, address=0):
+        """ Converts the report to a dictionary (suitable for json), 
+        address is the address of the enclosing block in bytes """
+        address += 2*self.offset
+        res = {'kind': self.kind, 'address': address, 
+                'bytes': 2*self.words, 'cycles': list(self.cycles),
+                'children': [b.to_dict(address) for b in self.children]}
+        if self.name is not None:
+            res['name'] = self.name
+        if self.iteration is not None:
+            res['iteration'] = list(self.iteration)
+            res['iterations'] = self.iterations
+        return res
+
+    def listing(self, address=0, indent=0):
+        """ Returns the report as a list of lines of text """
+        address += 2*self.offset
+        (lo, hi) = self.cycles
+        line = '%04x %5d bytes %7s cycles  %s%s' % (address, 2*self.words, 
+                '%d-%s' % (lo, '?' if hi is None else hi) if lo != hi 
+                else lo, '  '*indent, self.kind)
+        if self.name is not None:
+            line += ' ' + self.name
+        if self.iteration is not None:
+            line += ' (%s x %d-%d cycles)' % ('?' if self.iterations is None
+                            else self.iterations, self.iteration[0], 
+                            self.iteration[1])
+        res = [line]
+        for b in self.children:
+            res += b.listing(address, indent+1)
+        return res
+
 
 class CodeMaker(State):
     """ CodeMaker is used to generate instructions.
     
-    output -- list of instructions generated. Each instruction is
-    a Word instance,
+    output -- array('H') of instruction words generated,
+    
+    comments -- optional side table which maps the offset of the first
+    word of an instruction to [name]+args (None if comments are off),
+    
+    cycles -- pair (min, max) of execution times of the output,
+    
+    blocks -- reports (Block instances) on the control statements in the
+    output,
+    
+    fixups -- side table which maps the offset of every instruction with
+    Fixup operands to [name]+args,
+    
+    labels -- the Labels at positions of the output,
     
     instructions -- dictionary of instructions available.
     
     """    
-    def __init__(self, instructions, parent=None):
+    def __init__(self, instructions, parent=None, comments=True):
         self.instructions = instructions
-        self.output = []
+        self.output = array('H')
+        if comments:
+            self.comments = {}
+        else:
+            self.comments = None
+        self.cycles = (0, 0)
+        self.blocks = []
+        self.fixups = {}
+        self.labels = []
         self.parent = parent
     
     def do(self, name, *args):
         """ Append next instruction to the output """
         
-        print name, args
-        for word in self.instructions[name].write(*args):
-            word.comments = [name]+list(args)
-            self.output.append(word)
+        output = self.output
+        if events.instruction.fire is not None:
+            events.instruction.fire(self, len(output), name, args)
+        if self.comments is not None:
+            self.comments[len(output)] = [name]+list(args)
+        for arg in args:
+            if isinstance(arg, Fixup):
+                self.fixups[len(output)] = [name]+list(args)
+                args = _placeholders(args)
+                break
+        instruction = self.instructions[name]
+        output.extend(instruction.encode(*args))
+        self.cycles = add_cycles(self.cycles, instruction.cycles)
+
+    def emit(self, sequence):
+        """ Appends a sequence of instructions given as pairs (instruction,
+        args), where instruction is an Instruction (see its encode) or the
+        name of one; the same as calling do for each of them """
+        output = self.output
+        comments = self.comments
+        fixups = self.fixups
+        instructions = self.instructions
+        fire = events.instruction.fire
+        lo = hi = 0
+        for (instruction, args) in sequence:
+            if isinstance(instruction, str):
+                instruction = instructions[instruction]
+            pos = len(output)
+            if fire is not None:
+                fire(self, pos, instruction.name, args)
+            if comments is not None:
+                comments[pos] = [instruction.name]+list(args)
+            for arg in args:
+                if isinstance(arg, Fixup):
+                    fixups[pos] = [instruction.name]+list(args)
+                    args = _placeholders(args)
+                    break
+            output.extend(instruction.encode(*args))
+            (a, b) = instruction.cycles
+            lo += a
+            hi += b
+        self.cycles = add_cycles(self.cycles, (lo, hi))
+            
+    def plug(self, code, block=None):
+        """ Append the output of another CodeMaker (usually a child).
+        The reports of the other CodeMaker become children of block, which
+        should be opened by open_block, if it is given. """
+        offset = len(self.output)
+        self.output.extend(code.output)
+        if self.comments is not None and code.comments:
+            comments = self.comments
+            for (pos, comment) in code.comments.iteritems():
+                comments[pos+offset] = comment
+        for (pos, fixup) in code.fixups.iteritems():
+            self.fixups[pos+offset] = fixup
+        for label in code.labels:
+            label.pos += offset
+            self.labels.append(label)
+        if block is None:
+            self.cycles = add_cycles(self.cycles, code.cycles)
+            blocks = self.blocks
+        else:
+            offset -= block.offset
+            blocks = block.children
+        for b in code.blocks:
+            b.offset += offset
+            blocks.append(b)
+            
+    def encode_fixups(self, labels=True):
+        """ Encodes again the instructions with Fixup operands, once the
+        operands got their values. A Label without address raises
+        ValueError, unless labels is False: it is then encoded as 0 (the
+        registers are allocated before the code is linked). """
+        output = self.output
+        for (pos, fixup) in self.fixups.iteritems():
+            args = fixup[1:]
+            if not labels:
+                args = _placeholders(args)
+            words = self.instructions[fixup[0]].encode(*args)
+            output[pos:pos+len(words)] = array('H', words)
+
+    def drop_resolved(self):
+        """ Forgets the fixups whose operands are all resolved """
+        for (pos, fixup) in self.fixups.items():
+            if all(arg.resolved for arg in fixup[1:]
+                    if isinstance(arg, Fixup)):
+                del self.fixups[pos]
+
+    def label(self, pos=None):
+        """ Returns a Label at position pos of the output, the end of the
+        output by default """
+        if pos is None:
+            pos = len(self.output)
+        label = Label(pos)
+        self.labels.append(label)
+        return label
+
+    def link(self, origin):
+        """ Places the output at address origin (in bytes): gives the
+        labels their addresses and encodes the jumps to them """
+        for label in self.labels:
+            label.address = origin + 2*label.pos
+            label.resolved = True
+        self.encode_fixups()
+        self.drop_resolved()
+            
+    def open_block(self, kind, name=None):
+        """ Starts a report on the code which follows """
+        block = Block(kind, name, len(self.output))
+        block.start_cycles = self.cycles
+        if events.block_open.fire is not None:
+            events.block_open.fire(self, block)
+        return block
+
+    def block_cycles(self, block):
+        """ Returns the cycles of the code since block was opened, as if
+        it was executed straight """
+        (lo, hi) = block.start_cycles
+        return (self.cycles[0]-lo, 
+                None if self.cycles[1] is None else self.cycles[1]-hi)
+
+    def close_block(self, block):
+        """ Finishes a report, block.cycles must be set by the caller """
+        block.words = len(self.output) - block.offset
+        self.cycles = add_cycles(block.start_cycles, block.cycles)
+        del block.start_cycles
+        self.blocks.append(block)
+        if events.block_close.fire is not None:
+            events.block_close.fire(self, block)
+
+    def report(self):
+        """ Returns the report on the whole output """
+        block = Block('program', None, 0)
+        block.words = len(self.output)
+        block.cycles = self.cycles
+        block.children = self.blocks
+        return block
             
     def child(self):
-        return CodeMaker(self.instructions, self)
+        return CodeMaker(self.instructions, self, self.comments is not None)
         
 def do(*args):
     """ Shortcut for get_context().code_maker.do(...) """
     get_context().code_maker.do(*args)
+
+def emit(sequence):
+    """ Shortcut for get_context().code_maker.emit(...) """
+    get_context().code_maker.emit(sequence)
     
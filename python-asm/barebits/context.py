@@ -1,8 +1,22 @@
 # Copyright 2008 Anton Mellit
 
+""" The state of the compiler
+
+All the state of a compilation (code maker, allocator, ALU, variable
+manager...) is kept in a Context. Every thread has its own current
+context, returned by get_context; isolated makes another one current for
+a while, so that several programs can be compiled at once. """
+
 import contextlib
+try:
+    from thread import _local  # threading.local without importing threading
+except ImportError:
+    from threading import local as _local
 
-class Context: pass
+class Context:
+    
+    def __init__(self):
+        self.manager = contextlib.nested
 
 
 class State:
@@ -33,12 +47,36 @@ class StateManager(object):
             setattr(get_context(), self.attr_name, oldvalue)
         
 
-_context = Context()
+class _Current(_local):
+    def __init__(self):
+        self.context = Context()
 
-_context.manager = contextlib.nested
+_current = _Current()
 
 def get_context():
-    return _context
+    return _current.context
+
+@contextlib.contextmanager
+def isolated(context=None):
+    """ Makes context (a new Context by default) the current one of this
+    thread until the end of the with statement, yields it.
+    
+    Usage:
+    
+    with isolated() as context:
+        with program():
+            <program>
+    <use context.code_maker>
+    
+    """
+    if context is None:
+        context = Context()
+    saved = _current.context
+    _current.context = context
+    try:
+        yield context
+    finally:
+        _current.context = saved
 
 def manage(*attr_names):
     res = [StateManager(name) for name in attr_names]
@@ -0,0 +1,218 @@
+# Copyright 2008 Anton Mellit
+
+""" Events of the compiler
+
+Interesting things happening during a build are announced as events:
+
+instruction (code_maker, pos, name, args) -- CodeMaker.do emitted an
+instruction at position pos of code_maker
+block_open (code_maker, block), block_close (code_maker, block) -- a
+report on a control statement was opened or closed
+alloc (allocator, address), free (allocator, address) -- an allocator
+handed out or took back a register
+record (line) -- a HexWriter wrote a HEX record
+
+A subscriber is called as subscriber(event, *args). The code announcing
+an event checks its fire attribute, which is None while nobody listens,
+so an event without subscribers costs one attribute lookup:
+
+    if instruction.fire is not None:
+        instruction.fire(self, pos, name, args)
+
+Subscribers are global: they see the events of all the threads.
+TextTrace, Counters and BinaryTrace are ready-made subscribers.
+
+"""
+
+from __future__ import with_statement
+
+import sys
+from struct import pack, unpack, calcsize
+from contextlib import contextmanager
+
+
+class Event:
+    """ A kind of event and its subscribers """
+
+    def __init__(self, name):
+        self.name = name
+        self.subscribers = []
+        self.fire = None
+
+    def __repr__(self):
+        return '<Event %s>' % self.name
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+        self._update()
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.remove(subscriber)
+        self._update()
+
+    def _update(self):
+        name = self.name
+        subscribers = list(self.subscribers)
+        if not subscribers:
+            self.fire = None
+        elif len(subscribers) == 1:
+            subscriber = subscribers[0]
+            self.fire = lambda *args: subscriber(name, *args)
+        else:
+            def fire(*args):
+                for subscriber in subscribers:
+                    subscriber(name, *args)
+            self.fire = fire
+
+
+instruction = Event('instruction')
+block_open = Event('block_open')
+block_close = Event('block_close')
+alloc = Event('alloc')
+free = Event('free')
+record = Event('record')
+
+EVENTS = [instruction, block_open, block_close, alloc, free, record]
+_by_name = dict((e.name, e) for e in EVENTS)
+
+def _events(names):
+    if not names:
+        return EVENTS
+    return [_by_name[name] for name in names]
+
+def subscribe(subscriber, *names):
+    """ Calls subscriber on the events with given names (all by default) """
+    for event in _events(names):
+        event.subscribe(subscriber)
+
+def unsubscribe(subscriber, *names):
+    for event in _events(names):
+        event.unsubscribe(subscriber)
+
+@contextmanager
+def subscribed(subscriber, *names):
+    """ Calls subscriber on the events until the end of the with statement.
+
+    Usage:
+
+    with subscribed(TextTrace()):
+        with program():
+            <program>
+
+    """
+    subscribe(subscriber, *names)
+    try:
+        yield subscriber
+    finally:
+        unsubscribe(subscriber, *names)
+
+
+class TextTrace:
+    """ Writes a line per event to a stream (sys.stdout by default) """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def __call__(self, event, *args):
+        stream = self.stream
+        if stream is None:
+            stream = sys.stdout
+        if event == 'instruction':
+            line = '%s %r' % (args[2], args[3])
+        elif event in ('block_open', 'block_close'):
+            block = args[1]
+            line = '%s %s %s' % (event, block.kind, block.name or '')
+        elif event in ('alloc', 'free'):
+            line = '%s %r' % (event, args[1])
+        else:
+            line = args[0]
+        stream.write(line.rstrip() + '\n')
+
+
+class Counters:
+    """ Counts the events.
+
+    events -- dictionary event name -> number of events
+    instructions -- dictionary instruction name -> number emitted
+
+    """
+    def __init__(self):
+        self.events = dict((e.name, 0) for e in EVENTS)
+        self.instructions = {}
+
+    def __call__(self, event, *args):
+        self.events[event] += 1
+        if event == 'instruction':
+            name = args[2]
+            self.instructions[name] = self.instructions.get(name, 0) + 1
+
+    def __repr__(self):
+        return '<Counters: %s>' % ', '.join('%s %d' % (e.name,
+                                    self.events[e.name]) for e in EVENTS)
+
+
+""" Binary trace records: code of the event, a byte and a 32-bit value.
+Strings are given numbers by _NAME records followed by the string. """
+_record = '<BBI'
+_record_size = calcsize(_record)
+_NAME = 0
+_codes = dict((e.name, n+1) for (n, e) in enumerate(EVENTS))
+
+def _register(register):
+    """ Returns (1, number) for a virtual register without address, (0,
+    full address) for other registers """
+    from barebits.pic16.instructions import fullAddress
+    if not getattr(register, 'resolved', True):
+        return (1, register.number)
+    return (0, fullAddress(register))
+
+class BinaryTrace:
+    """ Writes the events to a binary stream in records of 6 bytes:
+    instruction (name, position), block_open and block_close (kind,
+    offset), alloc and free (0 and the full address, or 1 and the number
+    of a virtual register), record (type, address).
+    Names are numbered in the order they first appear. read_trace decodes
+    the stream. """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.names = {}
+
+    def _name(self, s):
+        n = self.names.get(s)
+        if n is None:
+            assert len(self.names) < 0x100, 'too many names'
+            n = self.names[s] = len(self.names)
+            self.stream.write(pack(_record, _NAME, n, len(s)) + s)
+        return n
+
+    def __call__(self, event, *args):
+        if event == 'instruction':
+            (byte, value) = (self._name(args[2]), args[1])
+        elif event in ('block_open', 'block_close'):
+            block = args[1]
+            (byte, value) = (self._name(block.kind), block.offset)
+        elif event in ('alloc', 'free'):
+            (byte, value) = _register(args[1])
+        else:
+            line = args[0]
+            (byte, value) = (int(line[7:9], 16), int(line[3:7], 16))
+        self.stream.write(pack(_record, _codes[event], byte, value))
+
+def read_trace(stream):
+    """ Decodes a stream written by BinaryTrace, yields the events as
+    tuples (event name, name or byte, value) """
+    names = {}
+    events = dict((n, name) for (name, n) in _codes.iteritems())
+    while True:
+        head = stream.read(_record_size)
+        if not head:
+            break
+        (code, byte, value) = unpack(_record, head)
+        if code == _NAME:
+            names[byte] = stream.read(value)
+            continue
+        event = events[code]
+        if event in ('instruction', 'block_open', 'block_close'):
+            byte = names[byte]
+        yield (event, byte, value)
@@ -1,18 +1,27 @@
 # Copyright 2008 Anton Mellit
 
-""" Functions to transform code to HEX format """
+""" Functions to transform code to HEX format and to read HEX files """
+
+import sys
+from array import array
+from binascii import hexlify, unhexlify
+from struct import pack, unpack
 
 from barebits.pic16.instructions import standard
+from barebits.memory import Memory
+from barebits import events
 
 hex = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'a', 'b', 'c', 
         'd', 'e', 'f']
 
 def wordsToBytes(words):
-    for w in words:
-        if hasattr(w, 'comments'):
-            print w.comments
-        yield w.word & 0xff
-        yield (w.word>>8) & 0xff
+    """ Converts an array('H') (or a sequence of ints) of instruction words
+    to array('B') of bytes, least significant byte first """
+    if not isinstance(words, array) or sys.byteorder != 'little':
+        words = array('H', words)
+        if sys.byteorder != 'little':
+            words.byteswap()
+    return array('B', words.tostring())
 
 def to_hex(val, len):
     s = ''
@@ -21,38 +30,248 @@ def to_hex(val, len):
         val = val>>4
     return s
 
+def _to_string(data):
+    """ Converts a sequence of byte values to a string """
+    if isinstance(data, str):
+        return data
+    if isinstance(data, bytearray):
+        return str(data)
+    if not isinstance(data, array):
+        data = array('B', data)
+    return data.tostring()
+
+def _checksum(data):
+    return sum(bytearray(data))
+
 def hex_line(address, type, data):
-    s = ':'
-    sum = 0
-    s += to_hex(len(data), 2)
-    sum -= len(data)
-    s += to_hex(address, 4)
-    sum -= address&0xff
-    sum -= (address>>8)&0xff
-    s += to_hex(type, 2)
-    sum -= type
-    sum &= 0xff
-    for c in data:
-        s += to_hex(c, 2)
-        sum -= c
-        sum &= 0xff
-    s += to_hex(sum, 2)
-    return s
+    data = _to_string(data)
+    head = pack('>BHB', len(data), address&0xffff, type)
+    sum = -(_checksum(head) + _checksum(data)) & 0xff
+    return ':' + hexlify(head) + hexlify(data) + hex[sum>>4] + hex[sum&0xf]
+
+def _data_lines(address, data, record_size):
+    """ Encodes data records for data stored at 16-bit address. The data
+    must not cross a 64 KiB boundary.
+
+    Full records are assembled column by column in one binary buffer
+    which is then converted to hex digits at once.
+
+    """
+    size = record_size
+    width = size + 5 # count, address (2 bytes), type, data, checksum
+    n = len(data) // size
+    values = bytearray(data)
+    records = bytearray(n*width)
+    addresses = xrange(address, address + n*size, size)
+    records[0::width] = bytearray([size])*n
+    records[1::width] = bytearray([a>>8 for a in addresses])
+    records[2::width] = bytearray([a&0xff for a in addresses])
+    for i in range(size):
+        records[4+i::width] = values[i:n*size:size]
+    records[width-1::width] = bytearray([-sum(records[p:p+width-1]) & 0xff 
+                                for p in xrange(0, n*width, width)])
+    digits = hexlify(records)
+    w = 2*width
+    lines = [':' + digits[i:i+w] for i in xrange(0, len(digits), w)]
+    if n*size < len(data):
+        lines.append(hex_line(address + n*size, 0, data[n*size:]))
+    return lines
+
+
+class HexEncoder:
+    """ Encodes memory contents as Intel HEX records.
+
+    Extended linear address records (type 4) are inserted whenever the
+    upper 16 bits of the address change, so images may cross 64 KiB.
+
+    record_size -- maximal number of data bytes in one record
+    upper -- upper 16 bits of the address set by the last extended linear
+    address record (None before the first one)
+
+    """
+    def __init__(self, record_size=16):
+        self.record_size = record_size
+        self.upper = None
+
+    def data(self, address, data):
+        """ Returns the list of lines which store data at given address """
+        data = _to_string(data)
+        lines = []
+        pos = 0
+        while pos < len(data):
+            upper = (address>>16) & 0xffff
+            if upper != self.upper:
+                lines.append(hex_line(0, 4, pack('>H', upper)))
+                self.upper = upper
+            low = address & 0xffff
+            count = min(len(data) - pos, 0x10000 - low)
+            lines.extend(_data_lines(low, data[pos:pos+count], 
+                                    self.record_size))
+            pos += count
+            address += count
+        return lines
+
+    def end(self):
+        """ Returns the end of file record """
+        return [hex_line(0, 1, '')]
+
+
+class HexWriter:
+    """ Writes HEX records to a file-like object.
+
+    Data is encoded and written in chunks of at most chunk_size bytes
+    (rounded down to a multiple of record_size), so the memory used does
+    not depend on the size of the image.
+
+    """
+    def __init__(self, stream, chunk_size=0x10000, record_size=16):
+        self.stream = stream
+        self.encoder = HexEncoder(record_size)
+        self.chunk_size = max(chunk_size - chunk_size%record_size, 
+                                record_size)
+
+    def write(self, address, data):
+        """ Writes data (bytes) which should be stored at given address """
+        data = _to_string(data)
+        for pos in xrange(0, len(data), self.chunk_size):
+            self._write_lines(self.encoder.data(address+pos, 
+                                data[pos:pos+self.chunk_size]))
+
+    def write_words(self, address, words):
+        """ Writes an array('H') of instruction words """
+        n = self.chunk_size//2
+        for pos in xrange(0, len(words), n):
+            self._write_lines(self.encoder.data(address+2*pos, 
+                                wordsToBytes(words[pos:pos+n])))
+
+    def close(self):
+        """ Writes the end of file record """
+        self._write_lines(self.encoder.end())
+
+    def _write_lines(self, lines):
+        if events.record.fire is not None:
+            for line in lines:
+                events.record.fire(line)
+        if lines:
+            lines.append('')
+            self.stream.write('\n'.join(lines))
+
+
+def _reset_bytes(offset):
+    """ Returns the bytes of GOTO offset, which is stored at address 0 """
+    return wordsToBytes(standard['GOTO'].encode(offset>>1))
+
+def _words(output):
+    """ The words of output, an array('H') or a CodeMaker. A CodeMaker
+    whose far jumps have no addresses yet is refused. """
+    from barebits.code import unresolved_labels
+    if not hasattr(output, 'fixups'):
+        return output
+    if unresolved_labels(output):
+        raise ValueError('the code is not linked, its far jumps have no '
+                            'addresses (see CodeMaker.link)')
+    return output.output
 
 def gen_hex(output, offset):
-    """ Stores the program at given offset and returns a sequence of 
-    lines in HEX format """
+    """ Stores the program (an array of words or a CodeMaker) at given
+    offset and returns a sequence of lines in HEX format """
     
-    yield hex_line(0, 4, [0, 0])
+    output = _words(output)
+    encoder = HexEncoder()
+    for line in encoder.data(0, _reset_bytes(offset)):
+        yield line
+    for line in encoder.data(offset, wordsToBytes(output)):
+        yield line
+    for line in encoder.end():
+        yield line
+
+def write_hex(stream, output, offset, chunk_size=0x10000):
+    """ Stores the program at given offset and writes it in HEX format
+    to a file-like object. The lines are the same as produced by gen_hex,
+    each line is followed by a newline. """
     
-    goto = wordsToBytes(standard['GOTO'].write(offset>>1))
-    yield hex_line(0, 0, list(goto))
+    output = _words(output)
+    writer = HexWriter(stream, chunk_size)
+    writer.write(0, _reset_bytes(offset))
+    writer.write_words(offset, output)
+    writer.close()
+
+def write_memory(stream, memory, chunk_size=0x10000):
+    """ Writes a Memory image in HEX format to a file-like object """
     
-    bytes = list(wordsToBytes(output))
+    writer = HexWriter(stream, chunk_size)
+    for (address, data) in memory.segments():
+        writer.write(address, data)
+    writer.close()
+
+def _parse_lines(lines):
+    """ Decodes a list of HEX lines to a list of records (type, address,
+    data). The shape of every line is checked first, so that the error
+    names the line. All the lines are then converted to binary at once,
+    the records are cut out of the result and their checksums are
+    verified. """
+    for line in lines:
+        if line[0] != ':' or not len(line)&1 or len(line) < 11:
+            raise ValueError('malformed HEX record %r' % line)
+    try:
+        raw = unhexlify(''.join([line[1:] for line in lines]))
+    except TypeError:
+        for line in lines:
+            try:
+                unhexlify(line[1:])
+            except TypeError:
+                raise ValueError('non-hex characters in HEX record %r' %
+                                    line)
+        raise
+    values = bytearray(raw)
+    records = []
+    pos = 0
+    for line in lines:
+        size = len(line)>>1
+        if values[pos] + 5 != size:
+            raise ValueError('malformed HEX record %r' % line)
+        if _checksum(values[pos:pos+size]) & 0xff:
+            raise ValueError('bad checksum in HEX record %r' % line)
+        records.append((values[pos+3], (values[pos+1]<<8) | values[pos+2], 
+                        raw[pos+4:pos+size-1]))
+        pos += size
+    return records
+
+def iter_records(stream, chunk_size=0x100000):
+    """ Reads a file-like object (or an mmap) in HEX format chunk by chunk
+    and yields records (type, address, data), data is a string """
     
-    count = (len(bytes)+15)//16
-    for i in range(count):
-        buf = [bytes[x] for x in range(i*16, min((i+1)*16, len(bytes)))]
-        yield hex_line(offset+i*16, 0, buf)
-    yield hex_line(0, 1, [])
+    tail = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        text = tail + chunk
+        if chunk:
+            cut = text.rfind('\n') + 1
+            (text, tail) = (text[:cut], text[cut:])
+        lines = text.split()
+        if lines:
+            for record in _parse_lines(lines):
+                yield record
+        if not chunk:
+            return
 
+def read_hex(stream):
+    """ Reads a file-like object (or an mmap) in HEX format and returns
+    the image as a Memory instance """
+    
+    memory = Memory()
+    base = 0
+    for (type, address, data) in iter_records(stream):
+        if type == 0:
+            memory.write(base + address, data)
+        elif type == 1:
+            break
+        elif type == 2:
+            base = unpack('>H', data)[0]<<4
+        elif type == 4:
+            base = unpack('>H', data)[0]<<16
+        elif type in (3, 5):
+            memory.start = unpack('>I', data)[0]
+        else:
+            raise ValueError('unknown HEX record type %d' % type)
+    return memory
@@ -0,0 +1,100 @@
+# Copyright 2008 Anton Mellit
+
+""" Sparse memory images """
+
+from bisect import bisect_right
+
+class Memory:
+    """ A sparse memory image, a set of contiguous segments of bytes.
+
+    Segments are kept sorted by address, they never overlap or touch each
+    other. Looking up an address is a binary search over segment starts.
+
+    start -- start address from a start address record, or None
+
+    """
+    def __init__(self):
+        self._starts = []
+        self._data = []
+        self.start = None
+
+    def write(self, address, data):
+        """ Stores the bytes data at given address, overwriting the
+        previous contents """
+        starts = self._starts
+        segments = self._data
+        if segments and address == starts[-1] + len(segments[-1]):
+            segments[-1].extend(data)
+            return
+        end = address + len(data)
+        first = bisect_right(starts, address) - 1
+        if first < 0 or starts[first] + len(segments[first]) < address:
+            first += 1
+        last = bisect_right(starts, end)
+        if first == last:
+            starts.insert(first, address)
+            segments.insert(first, bytearray(data))
+            return
+        begin = min(starts[first], address)
+        buf = bytearray(max(starts[last-1] + len(segments[last-1]), end) - 
+                        begin)
+        for i in range(first, last):
+            pos = starts[i] - begin
+            buf[pos:pos+len(segments[i])] = segments[i]
+        buf[address-begin:end-begin] = data
+        starts[first:last] = [begin]
+        segments[first:last] = [buf]
+
+    def _find(self, address):
+        """ Returns the index of the segment containing address or -1 """
+        i = bisect_right(self._starts, address) - 1
+        if i >= 0 and address - self._starts[i] < len(self._data[i]):
+            return i
+        return -1
+
+    def __contains__(self, address):
+        return self._find(address) >= 0
+
+    def __getitem__(self, address):
+        i = self._find(address)
+        if i < 0:
+            raise KeyError(address)
+        return self._data[i][address - self._starts[i]]
+
+    def get(self, address, default=None):
+        i = self._find(address)
+        if i < 0:
+            return default
+        return self._data[i][address - self._starts[i]]
+
+    def read(self, address, length, fill=0xff):
+        """ Returns length bytes starting at address, the bytes which are
+        not set are filled with fill """
+        res = bytearray([fill])*length
+        end = address + length
+        i = max(bisect_right(self._starts, address) - 1, 0)
+        while i < len(self._starts) and self._starts[i] < end:
+            start = self._starts[i]
+            data = self._data[i]
+            lo = max(start, address)
+            hi = min(start + len(data), end)
+            if lo < hi:
+                res[lo-address:hi-address] = data[lo-start:hi-start]
+            i += 1
+        return res
+
+    def segments(self):
+        """ Returns the list of pairs (address, data), one for each
+        contiguous segment, in the order of addresses """
+        return zip(self._starts, self._data)
+
+    def __len__(self):
+        """ The number of bytes set """
+        return sum(len(data) for data in self._data)
+
+    def __eq__(self, other):
+        return isinstance(other, Memory) and (
+                self.segments() == other.segments())
+
+    def __ne__(self, other):
+        return not self == other
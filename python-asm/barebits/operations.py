@@ -1,5 +1,7 @@
 # Copyright 2008 Anton Mellit
 
+import operator
+
 def _op_stub(name):
     def f(*args):
         return Operation(name, args)
@@ -19,11 +21,33 @@ def _op_istub(name):
 def _op_stubs(name):
     return (_op_stub(name), _op_rstub(name), _op_istub(name))
 
-binary_ops = ['+', '^', '|', '&', '-']
+binary_ops = ['+', '^', '|', '&', '-', '*', '//']
 unary_ops = ['u-', 'id']
-commutative_ops = ['+', '^', '|', '&']
+commutative_ops = ['+', '^', '|', '&', '*']
+literal_ops = ['//']    # the second operand is a literal
 comp_ops = ['<', '<=', '==', '<>', '>', '>=']
 
+_semantics = {
+    '+': operator.add, '^': operator.xor, '|': operator.or_, 
+    '&': operator.and_, '-': operator.sub, '*': operator.mul,
+    '//': operator.floordiv, 'u-': operator.neg,
+    'id': lambda x: x,
+    '<': operator.lt, '<=': operator.le, '==': operator.eq, 
+    '<>': operator.ne, '>': operator.gt, '>=': operator.ge,
+}
+
+def evaluate(name, args, bits=8):
+    """ Computes the operation on unsigned integers of the given width.
+    
+    args may be ints or NumPy arrays. Comparisons return truth values,
+    other operations return the result modulo 2**bits.
+    
+    """
+    res = _semantics[name](*args)
+    if name in comp_ops:
+        return res
+    return res & ((1<<bits) - 1)
+
 class Variable:
     
     (__add__, __radd__, __iadd__) = _op_stubs('+')
@@ -31,6 +55,9 @@ class Variable:
     (__or__, __ror__, __ior__) = _op_stubs('|')
     (__and__, __rand__, __iand__) = _op_stubs('&')
     (__sub__, __rsub__, __isub__) = _op_stubs('-')
+    (__mul__, __rmul__, __imul__) = _op_stubs('*')
+    (__floordiv__, __rfloordiv__, __ifloordiv__) = _op_stubs('//')
+    (__div__, __rdiv__, __idiv__) = _op_stubs('//')
     (__lt__, __le__, __eq__, __ne__, __gt__, __ge__) = (_op_stub(x) for x in
                     ('<', '<=', '==', '<>', '>', '>='))
     
@@ -51,3 +78,129 @@ class Operation(Variable):
     def __init__(self, name, args):
         self.opname = name
         self.args = args
+
+
+def _is_literal(x):
+    return isinstance(x, (int, long))
+
+def _same(a, b, volatile):
+    """ True if the expressions a and b always have the same value """
+    if _is_literal(a) or _is_literal(b):
+        return _is_literal(a) and _is_literal(b) and (a - b) & 0xff == 0
+    if isinstance(a, Operation) or isinstance(b, Operation):
+        return (isinstance(a, Operation) and isinstance(b, Operation) and
+                a.opname == b.opname and len(a.args) == len(b.args) and
+                all(_same(x, y, volatile) for (x, y) in zip(a.args, b.args)))
+    return ((a is b or a.address is b.address) and
+            not (volatile and volatile(a)))
+
+def _terms(name, expr, terms):
+    """ Appends to terms the operands of a chain of operations name """
+    if isinstance(expr, Operation) and expr.opname == name:
+        for arg in expr.args:
+            _terms(name, arg, terms)
+    elif (name == '+' and isinstance(expr, Operation) and
+            expr.opname == '-' and _is_literal(expr.args[1])):
+        _terms(name, expr.args[0], terms)
+        terms.append(-expr.args[1])
+    else:
+        terms.append(expr)
+
+def _chain(name, expr, volatile):
+    """ Reassociates a chain of a commutative operation, the literals are
+    merged into one which comes last """
+    terms = []
+    _terms(name, expr, terms)
+    literal = None
+    others = []
+    for t in terms:
+        if _is_literal(t):
+            literal = t if literal is None else evaluate(name, (literal, t))
+            continue
+        if name in ('|', '&') and [x for x in others
+                                    if _same(x, t, volatile)]:
+            continue    # x | x = x & x = x
+        if name == '^':
+            same = [k for (k, x) in enumerate(others)
+                    if _same(x, t, volatile)]
+            if same:
+                del others[same[0]]     # x ^ x = 0
+                continue
+        others.append(t)
+    if literal is not None:
+        literal &= 0xff
+        if (name, literal) in (('&', 0), ('|', 0xff), ('*', 0)):
+            return literal
+        if (name, literal) not in (('&', 0xff), ('|', 0), ('+', 0),
+                                    ('^', 0), ('*', 1)):
+            others.append(literal)
+    if not others:
+        return {'&': 0xff, '|': 0, '+': 0, '^': 0, '*': 1}[name]
+    res = others[0]
+    for t in others[1:]:
+        res = Operation(name, (res, t))
+    return res
+
+_comp_flip = {'<': '>', '<=': '>=', '==': '==', '<>': '<>', '>': '<',
+                '>=': '<='}
+
+def _comparison(expr, volatile):
+    (a, b) = [simplify(x, volatile) for x in expr.args]
+    name = expr.opname
+    if _is_literal(a) and not _is_literal(b):
+        (name, a, b) = (_comp_flip[name], b, a)
+    if name in ('==', '<>') and isinstance(a, Operation):
+        (x, y) = a.args
+        if _is_literal(b) and a.opname in ('+', '^') and _is_literal(y):
+            # x + c1 == c2 -> x == c2 - c1, x ^ c1 == c2 -> x == c2 ^ c1
+            inverse = {'+': '-', '^': '^'}[a.opname]
+            (a, b) = (x, evaluate(inverse, (b, y)))
+        elif _is_literal(b) and a.opname == '-' and _is_literal(x):
+            (a, b) = (y, evaluate('-', (x, b)))     # c1 - y == c2
+        elif _is_literal(b) and b & 0xff == 0 and a.opname == '-':
+            (a, b) = (x, y)                         # x - y == 0
+    if _is_literal(b) and name in ('<', '>='):
+        # the sign of x - c is the converse of the sign of c - 1 - x
+        (name, b) = ({'<': '<=', '>=': '>'}[name], (b - 1) & 0xff)
+    elif (name in ('>', '<=') and not _is_literal(b) and
+            isinstance(a, Operation) == isinstance(b, Operation)):
+        (name, a, b) = (_comp_flip[name], b, a)
+    return Operation(name, (a, b))
+
+def simplify(expr, volatile=None):
+    """ Returns an expression which computes the same as expr with fewer
+    operations: literal subtrees are folded, identities applied, chains of
+    commutative operations reassociated so that their literals merge, and
+    comparisons rewritten into the forms which are cheapest to test.
+    
+    Ordering comparisons keep their meaning as the sign of the difference
+    of the operands, which is how they are compiled. volatile(v) tells if
+    the variable v may change between two reads (e.g. ports), such a
+    variable is never taken as equal to itself. expr is not changed.
+    
+    """
+    if not isinstance(expr, Operation):
+        return expr
+    name = expr.opname
+    if name in comp_ops:
+        return _comparison(expr, volatile)
+    if name not in binary_ops:
+        return Operation(name, tuple(simplify(x, volatile)
+                                    for x in expr.args))
+    if name in commutative_ops:
+        return _chain(name, Operation(name, tuple(simplify(x, volatile)
+                                    for x in expr.args)), volatile)
+    (a, b) = [simplify(x, volatile) for x in expr.args]
+    if name == '//':
+        if _is_literal(b) and b == 1:
+            return a
+        if _is_literal(a) and _is_literal(b) and b:
+            return evaluate(name, (a & 0xff, b))
+        return Operation(name, (a, b))
+    if _is_literal(a) and _is_literal(b):
+        return evaluate(name, (a, b))
+    if _is_literal(b):
+        return _chain('+', Operation('+', (a, -b)), volatile)
+    if _same(a, b, volatile):
+        return 0
+    return Operation(name, (a, b))
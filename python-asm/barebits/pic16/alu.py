@@ -1,10 +1,11 @@
 # Copyright 2008 Anton Mellit
 
-from barebits.pic16.registers import WREG, STATUS
+from barebits.pic16.registers import WREG, STATUS, PROD, LongRegister
 from barebits import operations
 from barebits.context import get_context, State
-from barebits.allocator import alloc, free
-from barebits.code import do
+from barebits.allocator import alloc, alloc_long, free
+from barebits.code import do, Fixup, add_cycles
+from barebits.pic16 import muldiv
 
 
 def _make_alu_proxy(name):
@@ -24,6 +25,28 @@ class Variable(operations.Variable):
     toggle_bit = _make_alu_proxy('toggle_bit')
         
 
+class LongVariable(Variable):
+    """ Variable of several bytes (16, 24 or 32 bits), the lowest byte
+    first. The operations on it are done on its whole width, narrower
+    operands are extended with zeros. Where a single byte is expected it
+    stands for its lowest byte.
+
+    addresses -- addresses of the bytes
+    nbytes -- number of bytes
+    address -- address of the lowest byte
+
+    A LongRegister may be given instead of the addresses, e.g.
+    LongVariable(TMR[1]).
+
+    """
+    def __init__(self, addresses):
+        if isinstance(addresses, LongRegister):
+            addresses = addresses.regs
+        self.addresses = list(addresses)
+        self.nbytes = len(self.addresses)
+        self.address = self.addresses[0]
+
+
 class VariableManager(State):
             
     def __init__(self, vars = None):
@@ -33,9 +56,11 @@ class VariableManager(State):
             self.parent_vars = vars			
         self.vars = []
         
-    def create_var(self):
-        address = alloc()
-        var = Variable(address)
+    def create_var(self, nbytes=1):
+        if nbytes == 1:
+            var = Variable(alloc())
+        else:
+            var = LongVariable(alloc_long(nbytes))
         self.vars.append(var)
         return var
         
@@ -43,9 +68,13 @@ class VariableManager(State):
         return VariableManager(self.parent_vars + self.vars)
     
     def close(self):
-        print 'close var_manager'
         for var in self.vars:
-            free(var.address)
+            if isinstance(var, LongVariable):
+                for address in var.addresses:
+                    free(address)
+                var.addresses = None
+            else:
+                free(var.address)
             var.address = None
 
 
@@ -55,6 +84,22 @@ def var(value = None):
         v <<= value
     return v
 
+def long_var(nbytes, value=None):
+    """ New variable of nbytes consecutive bytes (see LongVariable) """
+    v = get_context().var_manager.create_var(nbytes)
+    if value is not None:
+        v <<= value
+    return v
+
+def var16(value=None):
+    return long_var(2, value)
+
+def var24(value=None):
+    return long_var(3, value)
+
+def var32(value=None):
+    return long_var(4, value)
+
 _wreg = WREG
 
 _instr_wreg_reg = {'+': 'ADDWF', '&': 'ANDWF', '|': 'IORWF', '^': 'XORWF'}
@@ -73,9 +118,325 @@ _comp_flip = {'<': '>', '<=': '>=', '==': '==', '<>': '<>', '>': '<',
 class StatusAddress:
     pass
 
+def _key(address):
+    """ Identifies a general purpose register, None for special registers
+    (their contents may change by themselves) and other addresses """
+    if isinstance(address, Fixup):
+        return address
+    if not hasattr(address, 'use_bsr'):
+        return None
+    if not address.use_bsr and address.address >= 0x60:
+        return None
+    return (address.address, address.use_bsr)
+
+def _width(expr):
+    """ Number of bytes of the widest variable in expr """
+    if isinstance(expr, operations.Operation):
+        return max(_width(x) for x in expr.args)
+    if isinstance(expr, (LongVariable, LongRegister)):
+        return expr.nbytes
+    return 1
+
+def _literal_width(expr):
+    """ Number of bytes of expr if it is a literal, 1 otherwise """
+    if isinstance(expr, (int, long)) and expr > 0xff:
+        return (expr.bit_length() + 7)//8
+    return 1
+
+_is_literal = operations._is_literal
+
+def _wide_division(expr):
+    """ True if expr divides a value of several bytes, which needs all
+    its bytes """
+    if not isinstance(expr, operations.Operation):
+        return False
+    if expr.opname == '//' and _width(expr.args[0]) > 1:
+        return True
+    return any(_wide_division(x) for x in expr.args)
+
+def _reads(expr, addresses):
+    """ True if expr reads one of the registers at addresses """
+    if isinstance(expr, operations.Operation):
+        return any(_reads(x, addresses) for x in expr.args)
+    if isinstance(expr, LongRegister):
+        regs = expr.regs
+    elif isinstance(expr, LongVariable):
+        regs = expr.addresses
+    elif hasattr(expr, 'address'):
+        regs = [expr.address]
+    else:
+        return False
+    return any(a in addresses for a in regs)
+
+def _compare_byte(name, x, y):
+    """ Returns the instructions comparing the bytes x and y (registers
+    or literals): Z tells if they are equal and for an ordering
+    comparison C if x >= y. None if they are equal literals. """
+    if _is_literal(x) and _is_literal(y):
+        if x == y:
+            return None
+        if name in ('==', '<>'):
+            return [('BCF', STATUS, STATUS.Z.ind)]
+        return [('BSF' if x > y else 'BCF', STATUS, STATUS.C.ind)]
+    if name in ('==', '<>'):
+        if _is_literal(x):
+            (x, y) = (y, x)
+        if not _is_literal(y):
+            return [('MOVF', y, False), ('XORWF', x, False)]
+        if y == 0:
+            return [('MOVF', x, False)]
+        return [('MOVF', x, False), ('XORLW', y)]
+    if _is_literal(x):
+        return [('MOVF', y, False), ('SUBLW', x)]
+    if _is_literal(y):
+        return [('MOVLW', y), ('SUBWF', x, False)]
+    return [('MOVF', y, False), ('SUBWF', x, False)]
+
+def _bit(var, n):
+    """ The register and the index in it of bit n of var """
+    if isinstance(var, LongVariable):
+        return (var.addresses[n//8], n%8)
+    return (var.address, n)
+
+def _mentions(key, reg):
+    """ True if the expression key reads the register reg (a _key) """
+    if key[0] == 'r':
+        return key[1] == reg
+    return key[0] != 'k' and (_mentions(key[1], reg) or
+                                _mentions(key[2], reg))
+
+
 class ALU:
+    """ Generates the code of assignments and conditions.
+
+    If track_values is set, the ALU remembers what WREG and the registers
+    it wrote hold and skips loads which would not change anything. The
+    knowledge only lasts while the ALU is the only one writing code: it
+    is forgotten as soon as anything else is emitted, when the code maker
+    changes and at the labels of the control statements (invalidate).
+
+    If simplify is set, expressions go through operations.simplify before
+    they are compiled.
+
+    If cse is set (which implies track_values), the ALU also remembers
+    which expressions WREG and the registers hold and whether the Z and
+    N flags tell the value of WREG: an expression computed again over
+    unchanged operands is taken from where it is, and a test of WREG
+    against 0 needs no SUBLW. The control statements carry this knowledge
+    into their bodies and past them (snapshot, restore).
+
+    Assignments to LongVariables are compiled byte by byte, the lowest
+    first, with ADDWFC and SUBWFB carrying between the bytes; adding 1
+    or -1 in place uses INFSNZ or a skip on the carry. Comparisons of
+    variables of several bytes are unsigned and start with the highest
+    byte, jumping to the end as soon as two bytes differ. Expressions of
+    several bytes are not simplified.
+
+    Multiplications use the hardware multiplier (MULWF, MULLW); by a
+    literal they may shift and add instead, whichever plan of muldiv
+    takes the fewest cycles. Divisions are only by literals: shifts for a
+    power of two, otherwise a multiplication by the reciprocal. They are
+    done on all the bytes of the dividend, whatever the width of the
+    target.
+
+    """
+    def __init__(self, track_values=False, simplify=False, cse=False):
+        self.track_values = track_values or cse
+        self.simplify = simplify
+        self.cse = cse
+        self.invalidate()
+
+    def _simplify(self, expr):
+        if not self.simplify or _wide_division(expr):
+            return expr
+        return operations.simplify(expr,
+                                    lambda v: _key(v.address) is None)
+
+    def invalidate(self):
+        """ Forgets what the registers hold """
+        self._w_value = None    # literal in WREG
+        self._w_regs = set()    # registers equal to WREG
+        self._values = {}       # register -> literal it holds
+        self._w_expr = None     # expression in WREG
+        self._exprs = {}        # expression -> register holding it
+        self._flags_w = False   # Z and N were set by the value of WREG
+        self._mark = None
+
+    def snapshot(self):
+        """ Returns what the ALU knows at the current position, None if
+        it knows nothing, for restore """
+        if not self.cse or not self._valid():
+            return None
+        return (self._w_value, set(self._w_regs), dict(self._values),
+                self._w_expr, dict(self._exprs), self._flags_w)
+
+    def restore(self, knowledge, *others):
+        """ Makes knowledge (given by snapshot) hold at the current
+        position. others are the knowledge of other paths which join
+        here, only what all of them know is kept. """
+        self.invalidate()
+        for other in (knowledge,) + others:
+            if other is None:
+                return
+        (w_value, w_regs, values, w_expr, exprs, flags_w) = knowledge
+        for (o_value, o_regs, o_values, o_expr, o_exprs, o_flags) in others:
+            if w_value != o_value:
+                w_value = None
+            w_regs = w_regs & o_regs
+            values = dict(x for x in values.iteritems()
+                            if o_values.get(x[0]) == x[1])
+            if w_expr != o_expr:
+                w_expr = None
+            exprs = dict((k, a) for (k, a) in exprs.iteritems()
+                            if k in o_exprs and _key(o_exprs[k]) == _key(a))
+            flags_w = flags_w and o_flags
+        self._w_value = w_value
+        self._w_regs = set(w_regs)
+        self._values = dict(values)
+        self._w_expr = w_expr
+        self._exprs = dict(exprs)
+        self._flags_w = flags_w
+        code_maker = get_context().code_maker
+        self._mark = (code_maker, len(code_maker.output))
+
+    def _valid(self):
+        """ True if the knowledge applies at the current position """
+        if not self.track_values:
+            return False
+        code_maker = get_context().code_maker
+        if self._mark != (code_maker, len(code_maker.output)):
+            self.invalidate()
+            return False
+        return True
+
+    def _do(self, name, *args):
+        if not self.track_values:
+            do(name, *args)
+            return
+        self._valid()
+        do(name, *args)
+        self._track(name, args)
+        code_maker = get_context().code_maker
+        self._mark = (code_maker, len(code_maker.output))
+
+    def _forget(self, address):
+        key = _key(address)
+        self._values.pop(key, None)
+        self._w_regs.discard(key)
+        if address == _wreg:
+            self._w_value = None
+            self._w_regs = set()
+            self._w_expr = None
+        if key is None:
+            return
+        if self._w_expr is not None and _mentions(self._w_expr, key):
+            self._w_expr = None
+        for (k, a) in self._exprs.items():
+            if _key(a) == key or _mentions(k, key):
+                del self._exprs[k]
+
+    def _track(self, name, args):
+        """ Updates the knowledge after the instruction """
+        key = _key(args[0]) if args else None
+        flags_w = False
+        if name == 'MOVLW':
+            self._forget(_wreg)
+            self._w_value = args[0] & 0xff
+        elif name == 'MOVF' and not args[1]:
+            self._forget(_wreg)
+            self._w_value = self._values.get(key)
+            if key:
+                self._w_regs = set([key])
+                for (k, a) in self._exprs.iteritems():
+                    if _key(a) == key:
+                        self._w_expr = k
+            flags_w = True
+        elif name == 'MOVWF':
+            self._forget(args[0])
+            if key:
+                self._w_regs.add(key)
+                if self._w_value is not None:
+                    self._values[key] = self._w_value
+                if self._w_expr is not None:
+                    self._exprs[self._w_expr] = args[0]
+            flags_w = self._flags_w
+        elif name == 'MOVFF':
+            self._forget(args[1])
+            flags_w = self._flags_w
+        elif name in ('MULWF', 'MULLW'):
+            flags_w = self._flags_w     # only PRODH:PRODL change
+        elif name in ('CLRF', 'SETF'):
+            self._forget(args[0])
+            if key:
+                self._values[key] = 0 if name == 'CLRF' else 0xff
+            flags_w = self._flags_w and name == 'SETF'
+        elif name in ('SUBLW', 'ADDLW', 'ANDLW', 'IORLW', 'XORLW'):
+            self._forget(_wreg)
+            flags_w = True
+        elif len(args) == 2 and isinstance(args[1], bool):
+            # operations with a destination
+            self._forget(args[1] and args[0] or _wreg)
+            flags_w = not args[1]
+        elif args and hasattr(args[0], 'use_bsr'):
+            # bit operations, NEGF
+            self._forget(args[0])
+            if name == 'NEGF':
+                flags_w = args[0] == _wreg
+            else:
+                flags_w = self._flags_w and args[0] != STATUS
+        else:
+            self.invalidate()
+        self._flags_w = flags_w
+
+    def _expr_key(self, expr):
+        """ Returns a key identifying the value of expr while its operands
+        do not change, None if it has none """
+        if hasattr(expr, 'opname'):
+            if expr.opname not in operations.binary_ops:
+                return None
+            keys = [self._expr_key(arg) for arg in expr.args]
+            if None in keys:
+                return None
+            return (expr.opname,) + tuple(keys)
+        if hasattr(expr, 'address'):
+            key = _key(expr.address)
+            return key and ('r', key)
+        return ('k', int(expr) & 0xff)
+
+    def _lookup(self, expr):
+        """ Returns WREG or the register which holds the value of expr,
+        None if it is not known """
+        if not self.cse or not self._valid():
+            return None
+        key = self._expr_key(expr)
+        if key is None:
+            return None
+        if key == self._w_expr:
+            return _wreg
+        return self._exprs.get(key)
+
+    def _remember(self, expr, address):
+        """ Notes that address holds the value of expr """
+        if not self.cse or not self._valid():
+            return
+        key = self._expr_key(expr)
+        if key is None:
+            return
+        if address == _wreg:
+            self._w_expr = key
+            return
+        reg = _key(address)
+        if reg is None or _mentions(key, reg):
+            return
+        self._exprs[key] = address
+        if reg in self._w_regs:
+            self._w_expr = key
+
     def assign(self, target, expression):
-        self._compute(target.address, expression)
+        if isinstance(target, LongVariable):
+            self._assign_long(target.addresses, expression)
+            return
+        self._compute(target.address, self._simplify(expression))
         
     def _compute(self, addr, expr):
         if hasattr(expr, 'opname'):
@@ -86,7 +447,16 @@ class ALU:
             self._copy_int(addr, int(expr))
 
     def _compute_op(self, addr, expr):
-        if expr.opname in operations.binary_ops:
+        held = self._lookup(expr)
+        if held is not None:
+            if addr is None:
+                addr = alloc()
+            self._copy(addr, held)
+            expr.address = addr
+            return
+        if expr.opname in ('*', '//'):
+            self._mul_div(addr, expr)
+        elif expr.opname in operations.binary_ops:
             self._binary(addr, expr)
         elif expr.opname in operations.unary_ops:
             self._unary(addr, name, *args)
@@ -101,9 +471,13 @@ class ALU:
         
         if hasattr(arg2, 'opname'):
             if hasattr(arg1, 'opname'):
-                self._compute_op(None, arg1)
-                res_addr = arg1.address
-                to_free.append(res_addr)
+                held = self._lookup(arg1)
+                if held is None or held == _wreg:
+                    self._compute_op(None, arg1)
+                    res_addr = arg1.address
+                    to_free.append(res_addr)
+                else:
+                    arg1.address = held     # not a temporary
             self._compute_op(_wreg, arg2)
         else:
             if hasattr(arg1, 'opname'):
@@ -121,6 +495,7 @@ class ALU:
             self._binary_reg(res_addr, expr.opname, arg1.address, arg2.address)
         else:
             self._binary_literal(res_addr, expr.opname, arg1, arg2)
+        self._remember(expr, res_addr)
         
         for a in to_free:
             if a != res_addr:
@@ -143,10 +518,10 @@ class ALU:
         
             if src1 == _wreg:
                 if name=='-':
-                    do('BSF', STATUS, STATUS.C.ind)
-                do(_instr_wreg_reg[name], src, to_source)
+                    self._do('BSF', STATUS, STATUS.C.ind)
+                self._do(_instr_wreg_reg[name], src, to_source)
             else:
-                do(_instr_reg_wreg[name], src, to_source)
+                self._do(_instr_reg_wreg[name], src, to_source)
             
             if not to_source:
                 src = _wreg
@@ -165,7 +540,7 @@ class ALU:
             if src2.address != _wreg:
                 self._copy(_wreg, src2.address)
             if name in operations.binary_ops:
-                do(_instr_lit_wreg[name], int(src1))
+                self._do(_instr_lit_wreg[name], int(src1) & 0xff)
                 if target!=_wreg:
                     self._copy(target, _wreg)
             else:
@@ -180,34 +555,117 @@ class ALU:
             else:
                 assert false
 
+    def _byte_operand(self, expr, temps):
+        """ Returns a register holding the value of expr, or a literal;
+        operations are computed into temporaries appended to temps """
+        if hasattr(expr, 'opname'):
+            held = self._lookup(expr)
+            if held is not None and held != _wreg:
+                return held
+            res = alloc()
+            temps.append(res)
+            self._compute_op(res, expr)
+            return res
+        if hasattr(expr, 'address'):
+            return expr.address
+        return int(expr) & 0xff
+
+    def _run(self, plan):
+        for instr in plan:
+            self._do(*instr)
+
+    def _mul_div(self, addr, expr):
+        """ Computes a multiplication or a division by a literal of one
+        byte (see muldiv) """
+        (arg1, arg2) = expr.args
+        name = expr.opname
+        if name == '*' and _is_literal(arg1):
+            (arg1, arg2) = (arg2, arg1)
+        if name == '//' and not (_is_literal(arg2) and arg2 >= 0):
+            raise ValueError('only divisions by literals are supported')
+        if name == '//' and arg2 == 0:
+            raise ZeroDivisionError('division by 0')
+        temps = []
+        if name == '//' and _width(arg1) > 1:
+            res = [alloc() for i in range(_width(arg1))]
+            temps.extend(res)
+            self._long_op(res, expr)
+            src = res[0]
+        else:
+            x = self._byte_operand(arg1, temps)
+            y = self._byte_operand(arg2, temps)
+            src = _wreg
+            if _is_literal(x):
+                src = operations.evaluate(name, (x, arg2 if name == '//'
+                                                    else y))
+            elif name == '*' and not _is_literal(y):
+                self._copy(_wreg, x)
+                self._do('MULWF', y)
+                src = PROD.regs[0]
+            elif name == '*' and y in (0, 1):
+                src = x if y else 0
+            elif name == '*':
+                self._run(min(muldiv.mul_byte_plans(x, y), key=muldiv.cost))
+            elif arg2 == 1:
+                src = x
+            elif arg2 > 0xff:
+                src = 0
+            else:
+                self._run(muldiv.div_byte_plan(x, arg2))
+        if addr is None:
+            addr = alloc()
+        expr.address = addr
+        self._copy_byte(addr, src)
+        self._remember(expr, addr)
+        for a in temps:
+            if a != addr:
+                free(a)
+
     def _copy(self, target, src):
         if target==src:
             return
-        elif target==_wreg:
-            do('MOVF', src, False)
+        if self._valid():
+            if target==_wreg and _key(src) in self._w_regs:
+                return
+            if src==_wreg and _key(target) in self._w_regs:
+                return
+            if src!=_wreg and target!=_wreg and _key(src) in self._w_regs:
+                self._copy(target, _wreg)
+                return
+        if target==_wreg:
+            self._do('MOVF', src, False)
         elif src==_wreg:
-            do('MOVWF', target)
+            self._do('MOVWF', target)
         else:
-            do('MOVFF', src, target)
+            self._do('MOVFF', src, target)
             
     
     def _copy_int(self, target, src):
+        if self._valid():
+            if target==_wreg and self._w_value == src & 0xff:
+                return
+            key = _key(target)
+            if key and self._values.get(key) == src & 0xff:
+                return
         if target==_wreg:
-            do('MOVLW', src)
+            self._do('MOVLW', src & 0xff)
         else:
             self._copy_int(_wreg, src)
             self._copy(target, _wreg)
 
     def set_bit(self, var, n):
-        do('BSF', var.address, n)
+        self._do('BSF', *_bit(var, n))
         
     def clear_bit(self, var, n):
-        do('BCF', var.address, n)
+        self._do('BCF', *_bit(var, n))
 
     def toggle_bit(self, var, n):
-        do('BTG', var.address, n)
+        self._do('BTG', *_bit(var, n))
         
     def compute_bool(self, expr):
+        if _width(expr) > 1:
+            return self._compare_long(expr)
+        expr = self._simplify(expr)
         if expr.opname in operations.comp_ops:
             self._binary(StatusAddress(), expr)
         else:
@@ -224,7 +682,7 @@ class ALU:
         elif name == '>=':
             target.cond = 'not negative'
         else:
-            do('NEGF', _wreg)
+            self._do('NEGF', _wreg)
             if name == '>':
                 target.cond = 'negative'
             elif name == '<=':
@@ -233,9 +691,340 @@ class ALU:
                 assert False		
     
     def _compare_wreg_reg(self, target, name, reg):
-        do('SUBWF', reg, False) # reg - wreg
+        self._do('SUBWF', reg, False) # reg - wreg
         self._compare(target, _comp_flip[name])
     
     def _compare_lit_wreg(self, target, name, lit):
-        do('SUBLW', lit) # lit - wreg
+        if (name in ('==', '<>') and lit & 0xff == 0 and self.cse and
+                self._valid() and self._flags_w):
+            pass    # Z tells already if WREG is 0
+        else:
+            self._do('SUBLW', lit & 0xff) # lit - wreg
         self._compare(target, name)
+
+    def _long_operand(self, expr, n, temps):
+        """ Returns the n bytes of the value of expr, the lowest first, as
+        addresses or literals. Operations are computed into temporaries,
+        which are appended to temps. """
+        if isinstance(expr, operations.Operation):
+            res = [alloc() for i in range(n)]
+            temps.extend(res)
+            self._long_op(res, expr)
+            return res
+        if isinstance(expr, LongRegister):
+            res = list(expr.regs)
+        elif isinstance(expr, LongVariable):
+            res = list(expr.addresses)
+        elif hasattr(expr, 'address'):
+            res = [expr.address]
+        else:
+            return [(int(expr) >> 8*i) & 0xff for i in range(n)]
+        return (res + [0]*n)[:n]
+
+    def _assign_long(self, target, expr):
+        n = len(target)
+        order = range(n)
+        if _key(target[0]) is None:
+            # special registers such as the timers take their high byte
+            # when the low one is written, so the low byte goes last
+            order.reverse()
+        elif isinstance(expr, operations.Operation):
+            self._long_op(target, expr)
+            return
+        temps = []
+        value = self._long_operand(expr, n, temps)
+        for i in order:
+            self._copy_byte(target[i], value[i])
+        for a in temps:
+            free(a)
+
+    def _copy_byte(self, target, src):
+        """ Copies a register or a literal into the register target """
+        if not _is_literal(src):
+            self._copy(target, src)
+        elif src in (0, 0xff) and target != _wreg:
+            if not (self._valid() and
+                    self._values.get(_key(target)) == src):
+                self._do('CLRF' if src == 0 else 'SETF', target)
+        else:
+            self._copy_int(target, src)
+
+    def _long_op(self, target, expr):
+        """ Computes the operation expr into the registers target """
+        n = len(target)
+        name = expr.opname
+        if name in ('*', '//'):
+            self._long_mul_div(target, expr)
+            return
+        assert name in operations.binary_ops, name
+        (arg1, arg2) = expr.args
+        if name == '-' and _is_literal(arg2):
+            (name, arg2) = ('+', -arg2)
+        commutative = name in operations.commutative_ops
+        if commutative and not isinstance(arg1, operations.Operation):
+            (arg1, arg2) = (arg2, arg1)
+        temps = []
+        if (isinstance(arg1, operations.Operation) and
+                not _reads(arg2, target)):
+            # the first operand is computed in place
+            self._long_op(target, arg1)
+            a = target
+        else:
+            a = self._long_operand(arg1, n, temps)
+        b = self._long_operand(arg2, n, temps)
+        if commutative and b == target:
+            (a, b) = (b, a)
+        if name == '+':
+            self._long_add(target, a, b)
+        elif name == '-':
+            self._long_sub(target, a, b)
+        else:
+            for i in range(n):
+                self._logic_byte(target[i], name, a[i], b[i])
+        for x in temps:
+            free(x)
+
+    def _logic_byte(self, target, name, x, y):
+        """ target = x name y for one byte of a bitwise operation """
+        if _is_literal(x):
+            (x, y) = (y, x)
+        if _is_literal(x):
+            self._copy_byte(target, operations.evaluate(name, (x, y)))
+        elif not _is_literal(y):
+            if y == target:
+                (x, y) = (y, x)
+            self._binary_reg(target, name, x, y)
+        elif (name, y) in (('&', 0), ('|', 0xff)):
+            self._copy_byte(target, y)
+        elif (name, y) in (('&', 0xff), ('|', 0), ('^', 0)):
+            self._copy(target, x)
+        elif (name, y) == ('^', 0xff):
+            self._do('COMF', x, x == target)
+            if x != target:
+                self._copy(target, _wreg)
+        elif x == target:
+            self._copy_int(_wreg, y)
+            self._do(_instr_wreg_reg[name], x, True)
+        else:
+            self._copy(_wreg, x)
+            self._do(_instr_lit_wreg[name], y)
+            self._copy(target, _wreg)
+
+    def _exact(self, start, cycles):
+        """ Sets the cycles of the code emitted since the code maker had
+        start cycles """
+        code_maker = get_context().code_maker
+        code_maker.cycles = add_cycles(start, cycles)
+
+    def _long_add(self, t, a, b):
+        """ t = a + b, byte by byte with the carry """
+        n = len(t)
+        if a == t and all(_is_literal(y) for y in b):
+            k = sum(y << 8*i for (i, y) in enumerate(b))
+            start = get_context().code_maker.cycles
+            if k == 1 and n == 2:
+                self._do('INFSNZ', t[0], True)
+                self._do('INCF', t[1], True)
+                self._exact(start, (2, 2))
+                return
+            if k == (1 << 8*n) - 1 and n == 2:
+                self._do('DECF', t[0], True)
+                self._do('BTFSS', STATUS, STATUS.C.ind)
+                self._do('DECF', t[1], True)
+                self._exact(start, (3, 3))
+                return
+            if k in (1, (1 << 8*n) - 1):
+                # INCF and DECF set the carry as ADDLW 1 and ADDLW 0xff
+                self._do('INCF' if k == 1 else 'DECF', t[0], True)
+                self._copy_int(_wreg, 0 if k == 1 else 0xff)
+                for x in t[1:]:
+                    self._do('ADDWFC', x, True)
+                return
+        carry = False
+        for i in range(n):
+            (x, y) = (a[i], b[i])
+            if _is_literal(x) or y == t[i]:
+                (x, y) = (y, x)
+            if not carry and _is_literal(y):
+                if _is_literal(x):
+                    self._copy_byte(t[i], (x + y) & 0xff)
+                    if x + y > 0xff:
+                        self._do('BSF', STATUS, STATUS.C.ind)
+                        carry = True
+                elif y == 0:
+                    self._copy(t[i], x)
+                elif x == t[i]:
+                    self._copy_int(_wreg, y)
+                    self._do('ADDWF', x, True)
+                    carry = True
+                else:
+                    self._copy(_wreg, x)
+                    self._do('ADDLW', y)
+                    self._copy(t[i], _wreg)
+                    carry = True
+                continue
+            if _is_literal(x):
+                # no literal form of ADDWFC: the byte is added in place
+                self._copy_byte(t[i], x)
+                x = t[i]
+            if _is_literal(y):
+                self._copy_int(_wreg, y)
+            else:
+                self._copy(_wreg, y)
+            self._do('ADDWFC' if carry else 'ADDWF', x, x == t[i])
+            if x != t[i]:
+                self._copy(t[i], _wreg)
+            carry = True
+
+    def _long_sub(self, t, a, b):
+        """ t = a - b, byte by byte with the borrow """
+        borrow = False
+        for i in range(len(t)):
+            (x, y) = (a[i], b[i])
+            if not borrow and _is_literal(y) and y == 0:
+                self._copy_byte(t[i], x)
+                continue
+            if _is_literal(x) and _is_literal(y):
+                if borrow:
+                    # no literal form of SUBWFB: the byte is done in place
+                    self._copy_byte(t[i], x)
+                    x = t[i]
+                else:
+                    self._copy_byte(t[i], (x - y) & 0xff)
+                    if x < y:
+                        self._do('BCF', STATUS, STATUS.C.ind)
+                        borrow = True
+                    continue
+            if not borrow:
+                if _is_literal(x):
+                    self._copy(_wreg, y)
+                    self._do('SUBLW', x)
+                elif _is_literal(y):
+                    self._copy_int(_wreg, y)
+                    self._do('SUBWF', x, x == t[i])
+                else:
+                    self._copy(_wreg, y)
+                    self._do('SUBWF', x, x == t[i])
+                if x != t[i]:
+                    self._copy(t[i], _wreg)
+                borrow = True
+            elif _is_literal(x) or y == t[i]:
+                # W - f - borrow
+                self._copy_byte(_wreg, x)
+                self._do('SUBFWB', y, y == t[i])
+                if y != t[i]:
+                    self._copy(t[i], _wreg)
+            else:
+                self._copy_byte(_wreg, y)
+                self._do('SUBWFB', x, x == t[i])
+                if x != t[i]:
+                    self._copy(t[i], _wreg)
+
+    def _long_mul_div(self, target, expr):
+        """ Computes a multiplication, or a division by a literal, into
+        the registers target (see muldiv) """
+        n = len(target)
+        (arg1, arg2) = expr.args
+        name = expr.opname
+        if name == '*' and _is_literal(arg1):
+            (arg1, arg2) = (arg2, arg1)
+        if name == '//' and not (_is_literal(arg2) and arg2 >= 0):
+            raise ValueError('only divisions by literals are supported')
+        if name == '//' and arg2 == 0:
+            raise ZeroDivisionError('division by 0')
+        if _is_literal(arg1):
+            value = arg1*arg2 if name == '*' else arg1//arg2
+            for i in range(n):
+                self._copy_byte(target[i], (value >> 8*i) & 0xff)
+            return
+        temps = []
+        # a quotient depends on all the bytes of the dividend
+        w = max(n, _width(arg1)) if name == '//' else n
+        a = self._long_operand(arg1, w, temps)
+        b = []
+        k = None
+        if not _is_literal(arg2):
+            b = self._long_operand(arg2, n, temps)
+        elif name == '*':
+            k = arg2 & ((1 << 8*n) - 1)
+        in_place = a == target and (name == '//' or
+                                    (k is not None and k & (k - 1) == 0))
+        res = target
+        if w > n or (not in_place and
+                    [x for x in a + b if not _is_literal(x) and x in target]):
+            res = [alloc() for i in range(w)]
+            temps.extend(res)
+        if name == '//':
+            acc = [alloc() for i in range(muldiv.div_temps(arg2, w))]
+            temps.extend(acc)
+            plan = muldiv.div_plan(res, a, arg2, acc)
+        elif k is None:
+            plan = muldiv.mul_plan(res, a, b)
+        elif in_place and k:
+            plan = muldiv.shift_plan(res, a, k.bit_length() - 1)
+        else:
+            plan = min(muldiv.mul_plans(res, a, k), key=muldiv.cost)
+        self._run(plan)
+        if res is not target:
+            for i in range(n):
+                self._copy(target[i], res[i])
+        for x in temps:
+            free(x)
+
+    def _compare_long(self, expr):
+        """ Compiles a comparison of several bytes, returns the condition
+        telling if it holds """
+        (arg1, arg2) = expr.args
+        name = expr.opname
+        assert name in operations.comp_ops, name
+        if name in ('>', '<='):
+            (name, arg1, arg2) = (_comp_flip[name], arg2, arg1)
+        n = max(_width(expr), _literal_width(arg1), _literal_width(arg2))
+        temps = []
+        a = self._long_operand(arg1, n, temps)
+        b = self._long_operand(arg2, n, temps)
+        if name in ('==', '<>'):
+            flag = STATUS.Z.ind
+            cond = {'==': 'zero', '<>': 'not zero'}[name]
+        else:
+            flag = STATUS.C.ind
+            cond = {'<': 'not carry', '>=': 'carry'}[name]
+        # steps comparing the bytes from the highest one, each sets the
+        # flag for the bytes compared so far and Z if they are equal
+        steps = []
+        if (name in ('==', '<>') and not any(x for x in a + b
+                if _is_literal(x)) and (all(map(_is_literal, a)) or
+                                        all(map(_is_literal, b)))):
+            # equal to 0: the OR of the bytes
+            regs = [x for x in reversed(a + b) if not _is_literal(x)]
+            if regs:
+                steps.append([('MOVF', regs[0], False)] +
+                                [('IORWF', x, False) for x in regs[1:]])
+        else:
+            for i in reversed(range(n)):
+                steps.append(_compare_byte(name, a[i], b[i]))
+                if steps[-1] is None:
+                    steps.pop()     # equal literals
+                elif steps[-1][0][0] in ('BSF', 'BCF'):
+                    break           # different literals decide
+        if not steps:
+            # equal literals
+            steps.append([('BSF', STATUS, flag)])
+        start = get_context().code_maker.cycles
+        paths = []
+        spent = 0
+        for (k, step) in enumerate(steps):
+            for instr in step:
+                self._do(*instr)
+            spent += len(step)
+            if k < len(steps) - 1:
+                rest = sum(len(x) + 1 for x in steps[k+1:]) - 1
+                self._do('BNZ', rest)
+                paths.append(spent + 2)
+                spent += 1
+        paths.append(spent)
+        self._exact(start, (min(paths), max(paths)))
+        self.invalidate()
+        for x in temps:
+            free(x)
+        return conditions[cond]
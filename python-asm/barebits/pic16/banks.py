@@ -0,0 +1,242 @@
+# Copyright 2008 Anton Mellit
+
+""" Banked data memory
+
+The pic18f2455/2550/4455/4550 have 2 KiB of RAM at 0x000-0x7ff in eight
+banks of 256 bytes. The first 0x60 bytes are also reached through the
+access bank; the other addresses are reached with BSR holding their bank.
+Other devices have other sizes (see devices), given to place.
+
+place chooses the addresses of the registers found by the liveness
+allocator: the most used ones go to the access bank, the others are
+packed into banks so that registers used one after another share a
+bank, and the bytes of a variable of several bytes stay together.
+insert_movlb then adds the MOVLB instructions the code needs,
+tracking the value of BSR along the control flow so that a MOVLB is only
+emitted where BSR changes, and loading BSR before a loop rather than in
+its body when the loop uses a single bank.
+
+"""
+
+from barebits.pic16.instructions import skips
+from barebits.pic16.peephole import Pass, Item
+
+RAM = 0x800
+ACCESS = 0x60
+BANK = 0x100
+
+_unknown = -1
+_loop_weight = 8
+
+
+def _loop_depths(successors):
+    """ Returns for every instruction the number of loops around it, a
+    loop being the instructions between a backward branch and its
+    target """
+    n = len(successors)
+    delta = [0]*(n+1)
+    for (i, succs) in enumerate(successors):
+        for s in succs:
+            if s <= i:
+                delta[s] += 1
+                delta[i+1] -= 1
+    depths = []
+    depth = 0
+    for i in xrange(n):
+        depth += delta[i]
+        depths.append(depth)
+    return depths
+
+def place(flow, accesses, colors, ncolors, ram=RAM, access=ACCESS,
+            groups=()):
+    """ Chooses the addresses of ncolors bytes.
+
+    flow -- the control flow of the code as returned by regalloc._flow
+    accesses -- list of (position, VirtualRegister) in the order of the
+    code
+    colors -- dictionary VirtualRegister -> byte number
+    ram -- bytes of RAM
+    access -- the bytes at 0-access are in the access bank
+    groups -- lists of byte numbers which go to consecutive addresses, in
+    the order of the list (the bytes of a variable)
+
+    Returns the list of the full addresses of the bytes.
+
+    """
+    if ncolors > ram:
+        raise ValueError('%d bytes are live at once, %d available' %
+                            (ncolors, ram))
+    (index, successors) = flow
+    depths = _loop_depths(successors)
+    weights = [0]*ncolors
+    affinity = [{} for c in range(ncolors)]
+    previous = None
+    for (pos, reg) in accesses:
+        c = colors[reg]
+        w = _loop_weight**min(depths[index[pos]], 6)
+        weights[c] += w
+        if previous is not None and previous != c:
+            affinity[c][previous] = affinity[c].get(previous, 0) + w
+            affinity[previous][c] = affinity[previous].get(c, 0) + w
+        previous = c
+    order = sorted(range(ncolors), key=lambda c: -weights[c])
+    units = {}
+    for group in groups:
+        for c in group:
+            units[c] = group
+    addresses = [None]*ncolors
+    a = 0
+    rest = []
+    done = set()
+    for c in order:
+        if c in done:
+            continue
+        unit = units.get(c, [c])
+        done.update(unit)
+        if a + len(unit) > access:
+            rest.append(unit)
+            continue
+        for d in unit:
+            addresses[d] = a
+            a += 1
+    nbanks = (ram - 1)//BANK + 1
+    free = [[] for b in range(nbanks)]
+    for a in range(ram - 1, access - 1, -1):
+        free[a//BANK].append(a)
+    bank_of = {}
+    for unit in rest:
+        score = [0]*nbanks
+        for c in unit:
+            for (d, w) in affinity[c].iteritems():
+                b = bank_of.get(d)
+                if b is not None:
+                    score[b] += w
+        fit = [b for b in range(nbanks) if len(free[b]) >= len(unit)]
+        if not fit:
+            raise ValueError('no %d consecutive bytes free in a bank' %
+                                len(unit))
+        best = max(fit, key=lambda b: (score[b], -len(free[b]), -b))
+        for c in unit:
+            addresses[c] = free[best].pop()
+            bank_of[c] = best
+    return addresses
+
+
+class BankPass(Pass):
+    """ Inserts the MOVLB instructions needed by banked registers """
+
+    def __init__(self, code, banks):
+        Pass.__init__(self, code, [])
+        self.banks = banks
+
+    def _flow_banks(self):
+        """ Returns the value of BSR before every item, _unknown if it
+        differs between paths """
+        self.number()
+        items = self.items
+        succs = self.successors()
+        state = [None]*len(items)
+        state[0] = _unknown
+        work = [0]
+        end = len(items) - 1
+        while work:
+            i = work.pop()
+            if i == end:
+                continue
+            item = items[i]
+            if item.name == 'MOVLB':
+                out = item.args[0]
+            elif item.name == 'RCALL':
+                out = _unknown
+            elif item.bank is not None:
+                out = item.bank
+            else:
+                out = state[i]
+            for s in succs[i]:
+                old = state[s]
+                if old is None:
+                    new = out
+                elif old == out:
+                    continue
+                else:
+                    new = _unknown
+                if new != old:
+                    state[s] = new
+                    work.append(s)
+        return state
+
+    def _hoist(self):
+        """ Loads BSR before the loops which use a single bank, returns
+        the new MOVLB items """
+        self.number()
+        items = self.items
+        heads = {}
+        for (j, item) in enumerate(items[:-1]):
+            if (item.name not in ('BRA', 'GOTO') or
+                    item.args[0].index > j):
+                continue
+            t = item.args[0].index
+            if t == 0 or items[t-1].name in skips:
+                continue
+            body = items[t:j+1]
+            if [x for x in body if x.name in ('MOVLB', 'RCALL')]:
+                continue
+            banks = set(x.bank for x in body if x.bank is not None)
+            if len(banks) == 1:
+                heads[id(items[t])] = banks.pop()
+        hoisted = []
+        res = []
+        for item in items:
+            bank = heads.get(id(item))
+            if bank is not None:
+                movlb = Item('MOVLB', [bank], item.pos - 0.5)
+                movlb.bank = None
+                hoisted.append(movlb)
+                res.append(movlb)
+            res.append(item)
+        self.items = res
+        return hoisted
+
+    def run(self):
+        if not self.decode():
+            raise ValueError('the code can not be analyzed')
+        items = self.items
+        for item in items:
+            item.bank = self.banks.get(item.pos)
+        for i in range(1, len(items) - 1):
+            if items[i].bank is None or items[i-1].name not in skips:
+                continue
+            # MOVLB can not go between a skip and the skipped instruction
+            skip = items[i-1]
+            if skip.bank not in (None, items[i].bank):
+                raise ValueError('skip at %d and the instruction it skips '
+                                'use different banks' % skip.pos)
+            skip.bank = items[i].bank
+        hoisted = self._hoist()
+        state = self._flow_banks()
+        hoisted = dict((id(x), x) for x in hoisted)
+        res = []
+        for (i, item) in enumerate(self.items):
+            if id(item) in hoisted:
+                if state[i] == item.args[0]:
+                    continue    # BSR holds the bank already
+                self.saved.append((item.pos, (-1, -1)))
+                self.savings.words -= 1
+            if item.bank is not None and state[i] != item.bank:
+                # item becomes the MOVLB, so that branches to item land
+                # on it, and the instruction moves after it
+                moved = Item(item.name, item.args, item.pos, item.comment)
+                moved.bank = item.bank
+                self.saved.append((item.pos, (-1, -1)))
+                self.savings.words -= 1
+                item.name = 'MOVLB'
+                item.args = [item.bank]
+                item.comment = None
+                item.bank = None
+                res.append(item)
+                res.append(moved)
+            else:
+                res.append(item)
+        self.items = res
+        self.layout()
+        return self.savings
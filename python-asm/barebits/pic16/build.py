@@ -0,0 +1,117 @@
+# Copyright 2008 Anton Mellit
+
+""" Builds several variants of a program at once
+
+A Variant is a source -- a function generating the code of the program,
+e.g. for given ports -- with its arguments, the options of program and the
+offset where the code goes. build compiles the variants on a pool of
+processes, every one in a context of its own (see context.isolated), and
+writes the HEX file of every variant into a directory.
+
+The source must be defined at the top level of a module, so that the
+processes can find it by name.
+
+"""
+
+from __future__ import with_statement
+
+import os
+import time
+import multiprocessing
+
+from barebits.context import isolated
+from barebits.hex import write_hex
+from barebits.pic16.control import program
+
+
+class Variant:
+    """ A program to build.
+
+    name -- the HEX file is named name + '.hex'
+    source -- function called with args inside program()
+    args -- dictionary of keyword arguments of source
+    offset -- address in bytes of the code, also the origin used to link
+    its far jumps
+    options -- keyword arguments of program
+
+    """
+    def __init__(self, name, source, args=None, offset=0x100, **options):
+        self.name = name
+        self.source = source
+        if args is None:
+            args = {}
+        self.args = args
+        self.offset = offset
+        self.options = options
+
+    def __repr__(self):
+        return '<Variant %s>' % self.name
+
+    def compile(self):
+        """ Compiles the variant in a new context, returns its CodeMaker """
+        options = dict(self.options)
+        options.setdefault('origin', self.offset)
+        with isolated() as context:
+            with program(**options):
+                self.source(**self.args)
+        return context.code_maker
+
+
+class BuildResult:
+    """ What build did for a variant.
+
+    path -- the HEX file written
+    words -- length of the code
+    cycles -- pair (min, max) of execution times of the code
+    seconds -- time spent compiling and writing
+
+    """
+    def __init__(self, name, path, words, cycles, seconds):
+        self.name = name
+        self.path = path
+        self.words = words
+        self.cycles = cycles
+        self.seconds = seconds
+
+    def __repr__(self):
+        return '<BuildResult %s: %d words>' % (self.name, self.words)
+
+
+def build_variant(variant, directory):
+    """ Compiles variant and writes its HEX file into directory, returns
+    a BuildResult """
+    t = time.time()
+    code_maker = variant.compile()
+    path = os.path.join(directory, variant.name + '.hex')
+    f = open(path, 'w')
+    try:
+        write_hex(f, code_maker.output, variant.offset)
+    finally:
+        f.close()
+    return BuildResult(variant.name, path, len(code_maker.output),
+                        code_maker.cycles, time.time() - t)
+
+def _build(job):
+    return build_variant(*job)
+
+def build(variants, directory, processes=None):
+    """ Builds the variants into directory on a pool of processes (by
+    default as many as there are CPUs; with 1 they are built in this
+    process). Returns the BuildResults in the order of variants. """
+    names = [v.name for v in variants]
+    if len(set(names)) != len(names):
+        raise ValueError('variants must have different names')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    jobs = [(v, directory) for v in variants]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(jobs))
+    if processes <= 1:
+        return map(_build, jobs)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_build, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
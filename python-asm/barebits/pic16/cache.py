@@ -0,0 +1,356 @@
+# Copyright 2008 Anton Mellit
+
+""" On-disk cache of compiled routines
+
+A routine is a function generating code, decorated with cached. When it
+is called in a program built with a BlockCache, its code is looked up by
+a key made of the code of the function, its arguments (literals,
+registers and expression trees over them), the instruction set, the
+options of the ALU and the state of the allocator. On a hit the stored
+words are plugged in without running the function; on a miss the
+function runs in a block as usual and its output is stored.
+
+The stored code is relocatable: virtual registers of the liveness
+allocator are kept as references to the arguments of the routine or to
+the registers it allocated, labels as positions in the routine. A
+routine using registers it did not get as arguments is not stored, nor
+one allocating variables of several bytes, whose bytes must stay
+consecutive.
+
+The key also covers the globals the routine reads: the code of the
+functions (and in turn of their globals and closures) and the values of
+the others. Functions and classes of barebits itself are keyed by name.
+Attributes of modules (module.helper) are not followed, nor the objects
+referenced by the values; a routine should depend on nothing else than
+its arguments and its globals, and must return None.
+
+Entries are pickled files named by the key in the cache directory. Hits
+update their modification time and the least recently used entries are
+removed when the directory grows over max_bytes.
+
+"""
+
+from __future__ import with_statement
+
+import hashlib
+import os
+import types
+import cPickle as pickle
+from array import array
+
+from barebits.context import get_context
+from barebits.code import Label
+from barebits.operations import Operation
+from barebits.allocator import StaticAllocator
+from barebits.utils import cache_dir
+from barebits.pic16.instructions import Designator
+from barebits.pic16.regalloc import VirtualRegister, LivenessAllocator
+
+_version = 3
+
+
+class CacheStats:
+    """ Hits and misses of a BlockCache during one build.
+
+    uncacheable -- routines which could not be keyed or stored
+
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+    def __repr__(self):
+        return '<CacheStats: %d hits, %d misses, %d uncacheable>' % (
+                self.hits, self.misses, self.uncacheable)
+
+
+class BlockCache:
+    """ Directory of compiled routines.
+
+    path -- the directory, cache_dir('blocks') by default
+    max_bytes -- bound on the total size of the entries
+
+    """
+    def __init__(self, path=None, max_bytes=64<<20):
+        if path is None:
+            path = cache_dir('blocks')
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    def get(self, key):
+        """ Returns the entry stored under key or None """
+        name = self._file(key)
+        try:
+            f = open(name, 'rb')
+            try:
+                entry = pickle.load(f)
+            finally:
+                f.close()
+            os.utime(name, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        """ Stores entry under key and evicts old entries """
+        name = self._file(key)
+        tmp = '%s.%d' % (name, os.getpid())
+        f = open(tmp, 'wb')
+        try:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, name)
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the directory
+        holds at most max_bytes """
+        entries = []
+        total = 0
+        for x in os.listdir(self.path):
+            if not x.endswith('.pickle'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, x))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, x, st.st_size))
+            total += st.st_size
+        entries.sort()
+        for (mtime, x, size) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, x))
+            except OSError:
+                pass
+            total -= size
+
+
+class _Ref:
+    """ Relocatable operand of a stored routine: ('arg', n) the n-th
+    virtual register of the arguments, ('local', n) the n-th one the
+    routine allocated, ('label', pos) a label at pos in the routine """
+
+    def __init__(self, kind, n):
+        self.kind = kind
+        self.n = n
+
+
+class _Unkeyable(Exception):
+    pass
+
+
+def _code_digest(code, h):
+    h.update(code.co_code)
+    h.update(repr(code.co_names))
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _code_digest(const, h)
+        else:
+            h.update(repr(const))
+
+def _global_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            names |= _global_names(const)
+    return names
+
+def _is_library(x):
+    return (getattr(x, '__module__', None) or '').split('.')[0] == 'barebits'
+
+def _value_digest(x, h, vrs, seen):
+    """ Adds a global (or closure) value to h: functions by their code,
+    defaults, closure and globals, other values with _describe """
+    if isinstance(x, types.FunctionType) and not _is_library(x):
+        if x in seen:
+            h.update(repr(('seen', seen.index(x))))
+            return
+        seen.append(x)
+        _code_digest(x.func_code, h)
+        _value_digest(x.func_defaults, h, vrs, seen)
+        for c in x.func_closure or ():
+            _value_digest(c.cell_contents, h, vrs, seen)
+        _globals_digest(x, h, vrs, seen)
+    elif isinstance(x, types.ModuleType):
+        h.update(repr(('module', x.__name__)))
+    elif isinstance(x, (types.FunctionType, types.BuiltinFunctionType,
+                        types.ClassType, type)):
+        h.update(repr(('name', x.__module__, x.__name__)))
+    elif isinstance(x, (tuple, list)):
+        h.update('(')
+        for y in x:
+            _value_digest(y, h, vrs, seen)
+        h.update(')')
+    else:
+        h.update(repr(_describe(x, vrs)))
+
+def _globals_digest(f, h, vrs, seen):
+    """ Adds to h the globals f reads, builtins are left out """
+    for name in sorted(_global_names(f.func_code)):
+        if name in f.func_globals:
+            h.update(name)
+            _value_digest(f.func_globals[name], h, vrs, seen)
+
+def _describe(x, vrs):
+    """ Converts an argument to something hashable by repr, vrs collects
+    the virtual registers in order """
+    if isinstance(x, (int, long, str, bool)) or x is None:
+        return x
+    if isinstance(x, (tuple, list)):
+        return tuple(_describe(y, vrs) for y in x)
+    if isinstance(x, Operation):
+        return (x.opname, _describe(x.args, vrs))
+    if isinstance(x, VirtualRegister):
+        if x not in vrs:
+            vrs.append(x)
+        return ('arg', vrs.index(x))
+    if isinstance(x, Designator):
+        return ('reg', x.address, x.use_bsr)
+    if hasattr(x, 'addresses'):
+        return ('long', _describe(x.addresses, vrs))
+    if hasattr(x, 'address'):
+        return ('var', _describe(x.address, vrs))
+    raise _Unkeyable(x)
+
+def _allocator_state(allocator):
+    if isinstance(allocator, StaticAllocator):
+        return ('static', [(a.address, a.use_bsr)
+                            for a in allocator._available])
+    if isinstance(allocator, LivenessAllocator):
+        return ('liveness', allocator.banked, allocator.ram,
+                allocator.access)
+    raise _Unkeyable(allocator)
+
+def _key(f, args, vrs):
+    context = get_context()
+    alu = context.alu
+    h = hashlib.sha1()
+    _code_digest(f.func_code, h)
+    closure = [c.cell_contents for c in f.func_closure or ()]
+    h.update(repr((_version, f.__module__, f.__name__,
+            _describe(f.func_defaults, vrs), _describe(closure, vrs),
+            _describe(args, vrs), context.code_maker.instructions.stamp,
+            context.code_maker.comments is not None,
+            (alu.track_values, alu.simplify, alu.cse), context.countdown,
+            _allocator_state(context.allocator))))
+    _globals_digest(f, h, vrs, [f])
+    return h.hexdigest()
+
+
+def _store(code, start, report, vrs, locals_):
+    """ Returns the entry of the routine at position start of code with
+    the block report, None if it can not be relocated """
+    end = start + report.words
+    def encode(arg):
+        if isinstance(arg, VirtualRegister):
+            if arg in vrs:
+                return _Ref('arg', vrs.index(arg))
+            if arg in locals_ and arg.group is None:
+                return _Ref('local', locals_.index(arg))
+            raise _Unkeyable(arg)
+        if isinstance(arg, Label):
+            if not start <= arg.pos <= end:
+                raise _Unkeyable(arg)
+            return _Ref('label', arg.pos - start)
+        if isinstance(arg, Designator):
+            return Designator(arg.address, arg.use_bsr)
+        return arg
+    def table(d):
+        if d is None:
+            return None
+        return dict((pos - start, [c[0]] + [encode(a) for a in c[1:]])
+                    for (pos, c) in d.iteritems() if start <= pos < end)
+    try:
+        return {'output': code.output[start:end].tostring(),
+                'comments': table(code.comments),
+                'fixups': table(code.fixups),
+                'locals': len(locals_),
+                'name': report.name,
+                'cycles': report.cycles,
+                'blocks': report.children}
+    except _Unkeyable:
+        return None
+
+def _replay(entry, vrs):
+    """ Plugs a stored routine into the current CodeMaker """
+    from barebits.pic16.control import plug
+    code_maker = get_context().code_maker
+    child = code_maker.child()
+    locals_ = [get_context().allocator.alloc()
+                for n in range(entry['locals'])]
+    labels = {}
+    def decode(arg):
+        if not isinstance(arg, _Ref):
+            return arg
+        if arg.kind == 'arg':
+            return vrs[arg.n]
+        if arg.kind == 'local':
+            return locals_[arg.n]
+        if arg.n not in labels:
+            labels[arg.n] = child.label(arg.n)
+        return labels[arg.n]
+    def table(d):
+        return dict((pos, [c[0]] + [decode(a) for a in c[1:]])
+                    for (pos, c) in d.iteritems())
+    child.output = array('H', entry['output'])
+    if child.comments is not None and entry['comments'] is not None:
+        child.comments = table(entry['comments'])
+    child.fixups = table(entry['fixups'])
+    child.cycles = entry['cycles']
+    child.blocks = entry['blocks']
+    report = code_maker.open_block('block', entry['name'])
+    plug(child, report)
+    report.cycles = child.cycles
+    code_maker.close_block(report)
+
+
+def cached(f):
+    """ Decorator of routines whose code is kept in the BlockCache of the
+    program (see program), they are compiled in a block named after
+    them """
+    def routine(*args):
+        from barebits.pic16.control import block
+        context = get_context()
+        cache = getattr(context, 'block_cache', None)
+        key = None
+        vrs = []
+        if cache is not None:
+            try:
+                key = _key(f, args, vrs)
+            except _Unkeyable:
+                context.cache_stats.uncacheable += 1
+        if key is not None:
+            entry = cache.get(key)
+            if entry is not None:
+                context.cache_stats.hits += 1
+                _replay(entry, vrs)
+                return
+            context.cache_stats.misses += 1
+        code_maker = context.code_maker
+        start = len(code_maker.output)
+        allocator = context.allocator
+        first = len(getattr(allocator, 'registers', ()))
+        with block(f.__name__):
+            res = f(*args)
+        assert res is None, 'routines return nothing'
+        if key is None:
+            return
+        locals_ = list(getattr(allocator, 'registers', ())[first:])
+        entry = _store(code_maker, start, code_maker.blocks[-1], vrs,
+                        locals_)
+        if entry is None:
+            context.cache_stats.uncacheable += 1
+        else:
+            cache.put(key, entry)
+    routine.__name__ = f.__name__
+    routine.__doc__ = f.__doc__
+    return routine
@@ -7,11 +7,12 @@ from __future__ import with_statement
 from contextlib import contextmanager, nested
 
 from barebits.context import get_context, manage
-from barebits.pic16.registers import STATUS
+from barebits.pic16.registers import STATUS, WREG
 from barebits.pic16.alu import ALU, VariableManager
-from barebits.pic16.instructions import standard, Designator
-from barebits.allocator import StaticAllocator
-from barebits.code import do, CodeMaker
+from barebits.pic16.instructions import standard, Designator, fullAddress
+from barebits.allocator import StaticAllocator, alloc, free
+from barebits.code import do, CodeMaker, add_cycles, mul_cycles, \
+        unresolved_labels
 
 """
 Recall that
@@ -29,22 +30,28 @@ _index_converse = [1, 0, 3, 2, 5, 4, 7, 6]
 _status_reg = STATUS
 
 def control_handler(f):
-    def g(*args):
+    def g(*args, **kwargs):
         with manage('allocator', 'var_manager', 'code_maker'):
             yield
-            output = get_context().code_maker.output
-        f(output, *args)
+            code = get_context().code_maker
+        f(code, *args, **kwargs)
     return contextmanager(g)
 
-def plug(output):
-    get_context().code_maker.output.extend(output)
+def plug(code, block=None):
+    get_context().code_maker.plug(code, block)
 
 @control_handler
-def block(output):
-    plug(output)
+def block(code, name=None):
+    code_maker = get_context().code_maker
+    report = code_maker.open_block('block', name)
+    plug(code, report)
+    report.cycles = code.cycles
+    code_maker.close_block(report)
 
 @contextmanager
-def program():
+def program(peephole=False, track_values=False, allocator='static',
+            relax=False, origin=None, simplify=False, cse=False,
+            cache=None, device=None, countdown=False):
     """ Begins a program.
     
     Usage:
@@ -52,17 +59,131 @@ def program():
     with program():
         <program>
     
+    peephole -- run the peephole optimizer over the finished code, True
+    for all the rules or a list of rule names (see peephole.RULES); what
+    it saved is kept in code_maker.savings
+    track_values -- let the ALU skip loads of values already in place
+    allocator -- 'static' gives every variable its own address until it
+    goes out of scope, 'liveness' lets variables which are never live at
+    the same time share addresses (see regalloc), 'banked' does the same
+    with all the RAM and adds MOVLB where needed (see banks); the
+    Allocation is kept in code_maker.allocation
+    relax -- give every jump its cheapest form (see peephole.relax), what
+    it saved is kept in code_maker.relaxation
+    origin -- address in bytes where the code goes, needed to encode the
+    GOTOs of far jumps; without it a program which has some raises
+    ValueError
+    simplify -- fold constants and apply identities in expressions before
+    they are compiled (see operations.simplify)
+    cse -- let the ALU reuse the values of expressions computed before
+    (see ALU), implies track_values
+    cache -- BlockCache (or True for the default one) keeping the code of
+    the routines decorated with cache.cached; the hits and misses are
+    counted in code_maker.cache_stats (None without a cache)
+    device -- name of a part or a Device (see devices): the allocators get
+    its RAM (bank 0 in BSR mode, or all of it with 'banked'), the code
+    its instruction set, and a ValueError is raised if the code does not
+    fit in its program memory; by default the allocators use 0x00-0x3f
+    and the code the standard instructions
+    countdown -- compile the for_ loops with constant bounds whose body
+    does not use the variable as DECFSZ/BRA loops counting the variable
+    down, which leaves 0 in it instead of the limit (see for_)
+    
+    The modules of the optional passes are imported when a program first
+    asks for them.
+    
     """
-    get_context().code_maker = CodeMaker(standard)
-    get_context().allocator = StaticAllocator([Designator(x, True)
-                                for x in range(0x40)])
-    get_context().alu = ALU()
+    if isinstance(device, str):
+        from barebits.pic16.devices import device as find_device
+        device = find_device(device)
+    if device is None:
+        get_context().code_maker = CodeMaker(standard)
+        registers = [Designator(x, True) for x in range(0x40)]
+    else:
+        get_context().code_maker = CodeMaker(device.instructions)
+        registers = device.available()
+    if allocator in ('liveness', 'banked'):
+        from barebits.pic16.regalloc import LivenessAllocator
+        if device is None:
+            get_context().allocator = LivenessAllocator(registers, 
+                                                allocator == 'banked')
+        else:
+            get_context().allocator = LivenessAllocator(registers, 
+                        allocator == 'banked', None, device.ram, device.access)
+    else:
+        assert allocator == 'static'
+        get_context().allocator = StaticAllocator(registers)
+    get_context().alu = ALU(track_values, simplify, cse)
     get_context().var_manager = VariableManager()
+    stats = None
+    if cache is not None:
+        from barebits.pic16.cache import BlockCache, CacheStats
+        if cache is True:
+            cache = BlockCache()
+        stats = CacheStats()
+    get_context().block_cache = cache
+    get_context().cache_stats = stats
+    get_context().countdown = countdown
     with block():
         yield
+    code_maker = get_context().code_maker
+    code_maker.cache_stats = stats
+    if allocator != 'static':
+        from barebits.pic16.regalloc import assign
+        code_maker.allocation = assign(code_maker, get_context().allocator)
+    if peephole or relax:
+        from barebits.pic16 import peephole as _peephole
+    if peephole:
+        code_maker.savings = _peephole.optimize(code_maker, 
+                                None if peephole is True else peephole)
+    if relax:
+        code_maker.relaxation = _peephole.relax(code_maker)
+    if origin is not None:
+        code_maker.link(origin)
+    elif unresolved_labels(code_maker):
+        raise ValueError('the code has far jumps (GOTO), program() needs '
+                            'an origin to encode them')
+    if device is not None:
+        end = (origin or 0) + 2*len(code_maker.output)
+        if end > device.flash:
+            raise ValueError('the code ends at 0x%x, %s has 0x%x bytes '
+                    'of program memory' % (end, device.name, device.flash))
 
-@control_handler
-def if_(output, cond):
+""" Cycles of the conditional jumps over a body: (when the body is
+entered, when it is jumped over) """
+_branch_cycles = {
+    'short': (1, 2),        # conditional branch
+    'skip_bra': (2, 3),     # skip + BRA
+    'skip_goto': (3, 3),    # skip + GOTO
+}
+
+def _jump_over(to_check, length):
+    """ Jumps over the next length words unless condition to_check
+    holds, returns the form of the jump """
+    if length<=0x7f:
+        do(_instr_branch[_index_converse[to_check]], length)
+        return 'short'
+    do(_instr_skip[to_check], _status_reg, _status_bit[to_check])
+    if length<=0x3ff:
+        do('BRA', length)
+        return 'skip_bra'
+    code_maker = get_context().code_maker
+    do('GOTO', code_maker.label(len(code_maker.output) + 2 + length))
+    return 'skip_goto'
+
+@contextmanager
+def _body(knowledge):
+    """ Runs the body of a statement in child states, the ALU starting
+    with knowledge. Yields a list which receives the CodeMaker of the body
+    and what the ALU knows at its end. """
+    res = []
+    with manage('allocator', 'var_manager', 'code_maker'):
+        get_context().alu.restore(knowledge)
+        yield res
+        res += [get_context().code_maker, get_context().alu.snapshot()]
+
+@contextmanager
+def if_(cond, name=None):
     """ if statement
     
     Usage:
@@ -71,19 +192,26 @@ def if_(output, cond):
         <code>
     
     """
-    to_check = get_context().alu.compute_bool(cond)
-    length = len(output)
-    if length<=0x7f:
-        do(_instr_branch[_index_converse[to_check]], length)
-    elif length<=0x3ff:
-        do(_instr_skip[to_check], _status_reg, _status_bit[to_check])
-        do('BRA', length)
-    else:
-        assert False
-    plug(output)
+    code_maker = get_context().code_maker
+    alu = get_context().alu
+    report = code_maker.open_block('if', name)
+    to_check = alu.compute_bool(cond)
+    test = code_maker.block_cycles(report)
+    before = alu.snapshot()
+    with _body(before) as body:
+        yield
+    (code, after) = body
+    (enter, skip) = _branch_cycles[_jump_over(to_check, len(code.output))]
+    plug(code, report)
+    alu.restore(before, after)     # the branch lands here
+    (lo, hi) = add_cycles((enter, enter), code.cycles)
+    if hi is not None:
+        hi = max(hi, skip)
+    report.cycles = add_cycles(test, (min(lo, skip), hi))
+    code_maker.close_block(report)
     
-@control_handler
-def while_(output, cond):
+@contextmanager
+def while_(cond, name=None, iterations=None, kind='while'):
     """ while statement
     
     Usage:
@@ -91,24 +219,56 @@ def while_(output, cond):
     with while_(<condition>):
         <code>
     
+    iterations -- the number of iterations if it is known, used in the
+    report on the loop
+    
     """
-    p0 = len(get_context().code_maker.output)
-    to_check = get_context().alu.compute_bool(cond)
-    length = len(output)
-    if length<=0x7e:
-        do(_instr_branch[_index_converse[to_check]], length+1)
-    elif length<=0x3fe:
-        do(_instr_skip[to_check], _status_reg, _status_bit[to_check])
-        do('BRA', length+1)
+    code_maker = get_context().code_maker
+    alu = get_context().alu
+    report = code_maker.open_block(kind, name)
+    p0 = len(code_maker.output)
+    alu.invalidate()     # the loop starts here
+    to_check = alu.compute_bool(cond)
+    test = code_maker.block_cycles(report)
+    before = alu.snapshot()
+    with _body(before) as body:
+        yield
+    _close_loop(report, p0, to_check, test, body[0], before, iterations)
+
+def _close_loop(report, p0, to_check, test, code, before, iterations):
+    """ Finishes a while loop whose test starts at position p0: jumps out
+    of the loop unless to_check holds, plugs the body code and jumps back
+    to the test """
+    code_maker = get_context().code_maker
+    alu = get_context().alu
+    length = len(code.output)
+    # words of the jump back, counting the longest jump out of the loop
+    back = 1
+    if len(code_maker.output) - p0 + 3 + length + 1 > 0x400:
+        back = 2
+    (enter, skip) = _branch_cycles[_jump_over(to_check, length+back)]
+    report.body = len(code_maker.output) - report.offset
+    plug(code, report)
+    if back == 1:
+        jump = p0 - len(code_maker.output) - 1
+        assert jump >= -0x400
+        do('BRA', jump)
     else:
-        assert False
-    plug(output)
-    jump = p0 - len(get_context().code_maker.output) - 1
-    assert jump >= -0x400
-    do('BRA', jump)
+        do('GOTO', code_maker.label(p0))
+    alu.restore(before)     # the loop is left from its test
+    report.iteration = add_cycles(add_cycles(test, code.cycles), 
+                                    (enter+2, enter+2))
+    report.iterations = iterations
+    exit = add_cycles(test, (skip, skip))
+    if iterations is None:
+        report.cycles = (exit[0], None)
+    else:
+        report.cycles = add_cycles(mul_cycles(report.iteration, iterations),
+                                    exit)
+    code_maker.close_block(report)
 
 @contextmanager
-def for_(v, init, limit=None):
+def for_(v, init, limit=None, name=None):
     """ for statement
     
     Usage:
@@ -116,12 +276,267 @@ def for_(v, init, limit=None):
     with for_(<variable>, <initial value>, <limit value>):
         <code>
     
+    In a program with countdown=True, a loop from a constant to a constant
+    whose body does not use the variable counts the variable down to 0
+    instead (see _countdown).
+    
     """
     if limit is None:
         limit = init
         init = 0
+    iterations = None
+    if isinstance(init, int) and isinstance(limit, int):
+        iterations = max(limit - init, 0)
+        if get_context().countdown and 0 < iterations <= 0x100:
+            with _countdown(v, init, limit, iterations, name):
+                yield
+            return
     v <<= init
-    with while_(v < limit):
+    with while_(v < limit, name=name, iterations=iterations, kind='for'):
         yield
         v += 1
 
+def _uses(code, reg):
+    """ Whether the code of a CodeMaker may access register reg """
+    if code.comments is None:
+        return True
+    address = None
+    if getattr(reg, 'resolved', True):
+        address = fullAddress(reg)
+    for comment in code.comments.itervalues():
+        for arg in comment[1:]:
+            if arg is reg:
+                return True
+            if address is None:
+                continue
+            if isinstance(arg, Designator):
+                if (getattr(arg, 'resolved', True) and
+                        fullAddress(arg) == address):
+                    return True
+            elif comment[0] in _full_address_instrs and arg == address:
+                return True
+    return False
+
+""" Instructions with full addresses (ints) among their arguments """
+_full_address_instrs = set(['MOVFF', 'LFSR', 'MOVSF', 'MOVSS'])
+
+@contextmanager
+def _countdown(v, init, limit, iterations, name):
+    """ for_ with a constant number of iterations (1 to 256). The body is
+    compiled first; if it does not use v, the loop is
+
+        MOVLW iterations; MOVWF v
+    p0: <body>
+        DECFSZ v, F
+        BRA p0
+
+    taking 3 cycles per iteration besides the body, and v is 0 after it.
+    Otherwise the loop is compiled as for_ usually does. """
+    code_maker = get_context().code_maker
+    alu = get_context().alu
+    outer = alu.snapshot()
+    with _body(None) as body:
+        yield
+        counted = not _uses(get_context().code_maker, v.address)
+        if not counted:
+            v += 1
+    code = body[0]
+    alu.restore(outer)
+    if not counted:
+        v <<= init
+        report = code_maker.open_block('for', name)
+        p0 = len(code_maker.output)
+        alu.invalidate()     # the loop starts here
+        to_check = alu.compute_bool(v < limit)
+        test = code_maker.block_cycles(report)
+        _close_loop(report, p0, to_check, test, code, alu.snapshot(),
+                    iterations)
+        return
+    v <<= iterations & 0xff
+    report = code_maker.open_block('for', name)
+    p0 = len(code_maker.output)
+    report.body = 0
+    plug(code, report)
+    do('DECFSZ', v.address, True)
+    jump = p0 - len(code_maker.output) - 1
+    if jump >= -0x400:
+        do('BRA', jump)
+        last = (-1, -1)     # the last DECFSZ skips a one-word BRA
+    else:
+        do('GOTO', code_maker.label(p0))
+        last = (0, 0)
+    alu.invalidate()     # the loop is left from DECFSZ
+    report.iteration = add_cycles(code.cycles, (3, 3))
+    report.iterations = iterations
+    report.cycles = add_cycles(mul_cycles(report.iteration, iterations),
+                                last)
+    code_maker.close_block(report)
+
+
+""" Delays
+
+A delay is a plan: a list of items ('pad', cycles), made of BRA $+1 (2
+cycles) and NOP, and ('loop', k, body), a loop running body k times (1 to
+256) with a counter counted down by DECFSZ. The innermost loops count in
+WREG, the others in a register:
+
+    MOVLW k                     MOVLW k; MOVWF r
+L:  <body>                  L:  <body>
+    DECFSZ WREG, F              DECFSZ r, F
+    BRA L                       BRA L
+
+which take k*(body+3) and 1 + k*(body+3) cycles. """
+
+_plans = {}
+
+def _has_loop(plan):
+    return any(item[0] == 'loop' for item in plan)
+
+def _plan_cycles(plan):
+    res = 0
+    for item in plan:
+        if item[0] == 'pad':
+            res += item[1]
+        else:
+            (kind, k, body) = item
+            res += k*(_plan_cycles(body) + 3) + _has_loop(body)
+    return res
+
+def _plan_cost(plan):
+    """ Returns (words, RAM bytes) of a plan """
+    words = 0
+    ram = 0
+    for item in plan:
+        if item[0] == 'pad':
+            words += (item[1] + 1)//2
+        else:
+            (body_words, body_ram) = _plan_cost(item[2])
+            if _has_loop(item[2]):
+                words += 4 + body_words
+                ram = max(ram, 1 + body_ram)
+            else:
+                words += 3 + body_words
+                ram = max(ram, body_ram)
+    return (words, ram)
+
+def _pad(n):
+    if n:
+        return [('pad', n)]
+    return []
+
+def _loops(n, depth):
+    """ Yields the plans of depth nested loops with padding in their
+    bodies and after them which take n cycles """
+    if depth == 1:
+        for q in range(4):
+            k = min(n//(3 + q), 0x100)
+            if k:
+                yield [('loop', k, _pad(q))] + _pad(n - k*(3 + q))
+        return
+    if depth == 2:
+        for q in range(3):
+            for q2 in range(3):
+                for k2 in range(1, 0x101):
+                    m = k2*(3 + q) + 3 + q2
+                    k = min((n - 1)//m, 0x100)
+                    if k:
+                        yield ([('loop', k, [('loop', k2, _pad(q))] +
+                                _pad(q2))] + _pad(n - 1 - k*m))
+        return
+    # depth 3: the counts of the two inner loops are searched for the
+    # smallest rest, which is another delay after the loops
+    best = None
+    for k3 in range(1, 0x101):
+        for k2 in range(1, 0x101):
+            m = 1 + k2*(3*k3 + 3) + 3
+            k = (n - 1)//m
+            if k == 0:
+                break
+            if k > 0x100:
+                continue
+            rest = n - 1 - k*m
+            if best is None or rest < best[0]:
+                best = (rest, k, k2, k3)
+                if rest == 0:
+                    break
+        if best is not None and best[0] == 0:
+            break
+    if best is not None:
+        (rest, k, k2, k3) = best
+        yield ([('loop', k, [('loop', k2, [('loop', k3, [])])])] +
+                plan_delay(rest))
+
+""" Words of the shortest plan of each depth, with no padding """
+_min_words = [0, 3, 7, 11]
+
+def plan_delay(n):
+    """ Returns a plan taking exactly n cycles, with the fewest words and
+    then the fewest RAM bytes found """
+    plan = _plans.get(n)
+    if plan is not None:
+        return plan
+    best = _pad(n)
+    cost = _plan_cost(best)
+    for depth in (1, 2, 3):
+        if cost[0] <= _min_words[depth]:
+            break
+        for plan in _loops(n, depth):
+            c = _plan_cost(plan)
+            if c < cost:
+                (best, cost) = (plan, c)
+    if n > 0x100*(1 + 0x100*(3*0x100 + 3) + 3):
+        # longer than 3 loops can take: a loop around a shorter delay
+        m = (n - 1)//0x100 - 3
+        body = plan_delay(m)
+        loop = [('loop', 0x100, body)]
+        best = loop + plan_delay(n - _plan_cycles(loop))
+    assert _plan_cycles(best) == n
+    _plans[n] = best
+    return best
+
+def _emit_plan(plan):
+    code_maker = get_context().code_maker
+    for item in plan:
+        if item[0] == 'pad':
+            for i in range(item[1]//2):
+                do('BRA', 0)
+            if item[1] & 1:
+                do('NOP')
+            continue
+        (kind, k, body) = item
+        do('MOVLW', k & 0xff)
+        if _has_loop(body):
+            counter = alloc()
+            do('MOVWF', counter)
+        else:
+            counter = WREG
+        p0 = len(code_maker.output)
+        _emit_plan(body)
+        do('DECFSZ', counter, True)
+        do('BRA', p0 - len(code_maker.output) - 1)
+        if counter is not WREG:
+            free(counter)
+
+def delay_cycles(n, name=None):
+    """ Waits exactly n instruction cycles.
+    
+    The delay is made of loops and padding, found by plan_delay and kept
+    for later delays of the same length. It changes WREG and uses a byte
+    of RAM per loop level but the innermost one. The peephole optimizer
+    leaves it alone; with allocator='banked' a MOVLB may still be needed
+    for its counters.
+    
+    """
+    if n < 0:
+        raise ValueError('negative delay %d' % n)
+    code_maker = get_context().code_maker
+    report = code_maker.open_block('delay', name)
+    _emit_plan(plan_delay(n))
+    get_context().alu.invalidate()
+    report.cycles = (n, n)
+    code_maker.close_block(report)
+
+def delay_us(t, fosc, name=None):
+    """ Waits t microseconds with a clock of fosc Hz (4 clocks per
+    instruction cycle), rounded to the nearest cycle """
+    delay_cycles(int(round(t*fosc/4e6)), name)
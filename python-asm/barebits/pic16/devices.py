@@ -0,0 +1,220 @@
+# Copyright 2008 Anton Mellit
+
+""" Database of PIC18 devices
+
+The devices are described in devices.txt: their special registers, the
+size of their program and data memory, the part of the access bank which
+is RAM and whether they have the extended instruction set. The file is
+read when a device is first asked for, and the registers of a device are
+created when they are first used.
+
+Usage:
+
+    d = device('pic18f4520')
+    port = Variable(d.group('PORT')[3])
+    with program(device=d):
+        ...
+
+"""
+
+import os
+
+from barebits.pic16.instructions import standard, extended, Designator
+from barebits.pic16 import registers as _registers
+from barebits.pic16.registers import (SpecialRegister, LongRegister,
+        BitRegister, FieldRegister, FSRControl)
+
+_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'devices.txt')
+
+def _int(x):
+    return int(x, 0)
+
+_settings = {'flash': _int, 'ram': _int, 'access': _int,
+                'xinst': lambda x: x == 'yes'}
+
+def _fields(specs):
+    """ Converts 'A', 'B:3', '-' to ('A', 1), ('B', 3), (None, 1) """
+    for spec in specs:
+        (name, colon, nbits) = spec.partition(':')
+        yield (None if name == '-' else name, int(nbits or 1))
+
+def _register(kind, args):
+    """ Creates a register from a line of devices.txt """
+    if kind == 'sfr':
+        return SpecialRegister(args[0], _int(args[1]),
+                                *[int(x) for x in args[2:]])
+    if kind == 'long':
+        return LongRegister(args[0], _int(args[1]), int(args[2]))
+    if kind == 'bits':
+        return BitRegister(args[0], _int(args[1]), args[2])
+    if kind == 'fields':
+        return FieldRegister(args[0], _int(args[1]), _fields(args[2:]))
+    if kind == 'fsr':
+        return FSRControl(int(args[0]), _int(args[1]))
+    raise ValueError('unknown register kind %r' % kind)
+
+
+class Device:
+    """ A PIC18 part.
+
+    name -- e.g. 'pic18f4550'
+    flash -- bytes of program memory
+    ram -- bytes of data memory, at addresses 0-ram
+    access -- the RAM bytes at 0-access are in the access bank
+    xinst -- whether the part has the extended instruction set
+    instructions -- the instruction set (instructions.standard or
+    extended)
+
+    """
+    def __init__(self, name, settings, lines):
+        self.name = name
+        self.flash = settings['flash']
+        self.ram = settings['ram']
+        self.access = settings['access']
+        self.xinst = settings['xinst']
+        if self.xinst:
+            self.instructions = extended
+        else:
+            self.instructions = standard
+        self._lines = lines
+        self._registers = None
+
+    def __repr__(self):
+        return '<Device %s>' % self.name
+
+    def _build(self):
+        """ Creates the registers and groups, returns the dictionary
+        name -> register or group """
+        if self._registers is not None:
+            return self._registers
+        objects = {}
+        groups = {}
+        for (kind, args) in self._lines:
+            if kind == 'group':
+                groups[args[0]] = args[1:]
+            else:
+                obj = _register(kind, args)
+                if kind == 'fsr':
+                    objects['FSR_control%s' % args[0]] = obj
+                else:
+                    objects[args[0]] = obj
+        names = {}
+        fields = {}
+        for (key, obj) in sorted(objects.items()):
+            if isinstance(obj, FSRControl):
+                for x in vars(obj).values():
+                    names[x.name] = x
+            else:
+                names[key] = obj
+            if isinstance(obj, FieldRegister):
+                for field in obj.fields.values():
+                    fields.setdefault(field.name, field)
+        for (key, members) in groups.items():
+            groups[key] = [names[x] for x in members]
+        self._names = names
+        self._groups = groups
+        self._fields = fields
+        self._registers = objects
+        self._by_address = _registers._index(objects)
+        return objects
+
+    def register(self, name):
+        """ Returns the register called name (KeyError if there is
+        none) """
+        self._build()
+        return self._names[name]
+
+    __getitem__ = register
+
+    def group(self, name):
+        """ Returns a list of registers, e.g. group('PORT') """
+        self._build()
+        return self._groups[name]
+
+    def field(self, name):
+        """ Returns the Field called name, e.g. field('GIE') """
+        self._build()
+        return self._fields[name]
+
+    def find_register(self, address):
+        """ Returns the single-byte special register at given full address
+        or None """
+        self._build()
+        return self._by_address[0].get(address)
+
+    def find_bit(self, address, ind):
+        """ Returns the name of the bit ind of the register at given full
+        address or None """
+        self._build()
+        return self._by_address[1].get((address, ind))
+
+    def available(self):
+        """ Returns the addresses of bank 0 for the allocators which do
+        not use banks, in BSR mode """
+        return [Designator(x, True) for x in range(min(self.ram, 0x100))]
+
+
+_specs = None
+_devices = {}
+
+def _load():
+    """ Reads devices.txt, returns the dictionary name -> (base, list of
+    lines (keyword, arguments)) """
+    specs = {}
+    current = None
+    f = open(_path)
+    try:
+        for (n, line) in enumerate(f):
+            words = line.split('#', 1)[0].split()
+            if not words:
+                continue
+            if words[0] == 'device':
+                current = []
+                base = None
+                if len(words) > 2:
+                    base = words[2]
+                    if base not in specs:
+                        raise ValueError('line %d: unknown device %s' % (n+1,
+                                                                    base))
+                specs[words[1]] = (base, current)
+            elif current is None:
+                raise ValueError('line %d: no device' % (n+1))
+            else:
+                current.append((words[0], words[1:]))
+    finally:
+        f.close()
+    return specs
+
+def names():
+    """ Returns the names of the devices """
+    global _specs
+    if _specs is None:
+        _specs = _load()
+    return sorted(x for x in _specs if not x.startswith('_'))
+
+def device(name):
+    """ Returns the Device called name (ValueError if it is unknown) """
+    global _specs
+    res = _devices.get(name)
+    if res is not None:
+        return res
+    if _specs is None:
+        _specs = _load()
+    if name.startswith('_') or name not in _specs:
+        raise ValueError('unknown device %r' % name)
+    chain = []
+    x = name
+    while x is not None:
+        chain.append(x)
+        x = _specs[x][0]
+    settings = dict((key, None) for key in _settings)
+    lines = []
+    for x in reversed(chain):
+        for (kind, args) in _specs[x][1]:
+            if kind in _settings:
+                settings[kind] = _settings[kind](args[0])
+            else:
+                lines.append((kind, args))
+    res = _devices[name] = Device(name, settings, lines)
+    return res
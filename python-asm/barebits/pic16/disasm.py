@@ -0,0 +1,231 @@
+# Copyright 2008 Anton Mellit
+
+""" Disassembler for pic18fxxxx microcontrollers
+
+Each instruction set gets a decode table with an entry for every possible
+16-bit word, so finding the instruction of a word is a single array
+lookup. Tables are built once from the Instruction objects and kept for
+the life of the process. They are stored in a cache directory to be
+reused by later runs only when one is given, or $BAREBITS_CACHE is set.
+
+"""
+
+import os
+from array import array
+
+from barebits.utils import cache_dir
+from barebits.pic16.instructions import (extended, Designator, ArgInstr,
+        RelativeInstr, DesignatorInstr, DesignatorDestInstr, BitInstr,
+        MoveInstr, LongJumpInstr, FSRInstr, LongFSRInstr, MoveIndInstr)
+from barebits.pic16 import registers as _registers
+
+
+class DecodeTable:
+    """ Decode table of an instruction set
+
+    order -- names of the instructions, sorted
+    index -- array('H') of 65536 entries, for every word the position+1
+    in order of the instruction it encodes, 0 for invalid words
+    device -- Device naming the special registers in the text, the
+    module registers if it is None
+
+    """
+    def __init__(self, instructions, index=None, device=None):
+        self.instructions = instructions
+        self.order = sorted(instructions)
+        if index is None:
+            index = self._build()
+        self.index = index
+        self.names = device or _registers
+        self._text = {}
+
+    def _build(self):
+        """ Fills the table, instructions with longer opcodes are written
+        later so they take precedence """
+        index = array('H', [0]) * 0x10000
+        instrs = [self.instructions[name] for name in self.order]
+        order = sorted(range(len(instrs)), key=lambda i: instrs[i].nbits)
+        for i in order:
+            instr = instrs[i]
+            size = 1<<(16-instr.nbits)
+            start = instr.opcode*size
+            index[start:start+size] = array('H', [i+1]) * size
+        return index
+
+    def lookup(self, word):
+        """ Returns the instruction encoded by word or None """
+        n = self.index[word]
+        if n:
+            return self.instructions[self.order[n-1]]
+        return None
+
+    def decode(self, words, pos):
+        """ Decodes the instruction at position pos of a word sequence.
+
+        Returns (instruction, args, length) where args are the parameters
+        of instruction.write and length is in words. Words which are not
+        instructions are returned as (None, (word,), 1).
+
+        """
+        word = words[pos]
+        n = self.index[word]
+        if not n:
+            return (None, (word,), 1)
+        instr = self.instructions[self.order[n-1]]
+        if instr.length == 2:
+            return (instr, instr.read(word, 0), 1)
+        if pos+1 >= len(words) or words[pos+1]>>12 != 0xf:
+            return (None, (word,), 1)
+        return (instr, instr.read(word, words[pos+1]), 2)
+
+    def text(self, words, pos, address=0):
+        """ Returns (text, length) for the instruction at position pos,
+        address is the address of words[0] in bytes """
+        word = words[pos]
+        text = self._text.get(word)
+        if text is not None:
+            return (text, 1)
+        (instr, args, length) = self.decode(words, pos)
+        if instr is None:
+            return ('DW 0x%04x' % word, 1)
+        if isinstance(instr, RelativeInstr):
+            target = address + 2*(pos + 1 + args[0])
+            return ('%s 0x%04x' % (instr.name, target), 1)
+        text = _format(instr, args, self.names)
+        if length == 1:
+            self._text[word] = text
+        return (text, length)
+
+
+def _register(designator, names):
+    if designator.use_bsr:
+        return '0x%02x, BANKED' % designator.address
+    if designator.address >= getattr(names, 'access', 0x60):
+        reg = names.find_register(0xf00 | designator.address)
+        if reg is not None:
+            return reg.name
+    return '0x%02x' % designator.address
+
+def _full_register(address, names):
+    reg = names.find_register(address)
+    if reg is not None:
+        return reg.name
+    return '0x%03x' % address
+
+def _bit(designator, ind, names):
+    name = None
+    if (not designator.use_bsr and 
+            designator.address >= getattr(names, 'access', 0x60)):
+        name = names.find_bit(0xf00 | designator.address, ind)
+    return name or str(ind)
+
+def _format(instr, args, names):
+    """ Text of a non-relative instruction, names is the module registers
+    or a Device """
+    if isinstance(instr, DesignatorDestInstr):
+        (f, d) = args
+        if f.use_bsr:
+            return '%s 0x%02x, %s, BANKED' % (instr.name, f.address,
+                                            'WF'[d])
+        return '%s %s, %s' % (instr.name, _register(f, names), 'WF'[d])
+    if isinstance(instr, DesignatorInstr):
+        return '%s %s' % (instr.name, _register(args[0], names))
+    if isinstance(instr, BitInstr):
+        (f, b) = args
+        if f.use_bsr:
+            return '%s 0x%02x, %d, BANKED' % (instr.name, f.address, b)
+        return '%s %s, %s' % (instr.name, _register(f, names),
+                                _bit(f, b, names))
+    if isinstance(instr, MoveInstr):
+        return '%s %s, %s' % (instr.name, _full_register(args[0], names),
+                                _full_register(args[1], names))
+    if isinstance(instr, LongJumpInstr):
+        return '%s 0x%05x' % (instr.name, 2*args[0])
+    if isinstance(instr, (FSRInstr, LongFSRInstr)):
+        return '%s FSR%d, 0x%02x' % (instr.name, args[0], args[1])
+    if isinstance(instr, MoveIndInstr):
+        return '%s 0x%02x, %s' % (instr.name, args[0],
+                                    _full_register(args[1], names))
+    if isinstance(instr, ArgInstr):
+        return '%s 0x%02x' % (instr.name, args[0])
+    return instr.name
+
+
+_tables = {}
+
+def _table_dir(cache):
+    if cache is None:
+        cache = bool(os.environ.get('BAREBITS_CACHE'))
+    if cache is True:
+        return cache_dir('disasm')
+    if cache and not os.path.isdir(cache):
+        os.makedirs(cache)
+    return cache or None
+
+def decode_table(instructions=extended, device=None, cache=None):
+    """ Returns the DecodeTable of an instruction set, building it on
+    first use; with a device, the table names the registers of the
+    device.
+
+    cache -- directory the tables are loaded from and stored to, True for
+    cache_dir('disasm'), False for none; by default cache_dir('disasm')
+    if $BAREBITS_CACHE is set, none otherwise
+
+    """
+    stamp = instructions.stamp
+    if device is not None:
+        table = _tables.get((stamp, device.name))
+        if table is None:
+            table = DecodeTable(instructions,
+                                decode_table(instructions).index, device)
+            _tables[(stamp, device.name)] = table
+        return table
+    table = _tables.get(stamp)
+    if table is not None:
+        return table
+    path = _table_dir(cache)
+    if path is None:
+        table = DecodeTable(instructions)
+        _tables[stamp] = table
+        return table
+    path = os.path.join(path, stamp + '.bin')
+    index = array('H')
+    try:
+        f = open(path, 'rb')
+        try:
+            index.fromfile(f, 0x10000)
+        finally:
+            f.close()
+        table = DecodeTable(instructions, index)
+    except (IOError, EOFError):
+        table = DecodeTable(instructions)
+        tmp = '%s.%d' % (path, os.getpid())
+        f = open(tmp, 'wb')
+        try:
+            table.index.tofile(f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    _tables[stamp] = table
+    return table
+
+def disassemble(words, address=0, instructions=extended, device=None):
+    """ Disassembles a sequence of words (e.g. CodeMaker.output) placed at
+    address (in bytes), naming the registers of device if it is given.
+    Returns a list of triples (address, words, text) with one triple per
+    instruction """
+    table = decode_table(instructions, device)
+    res = []
+    pos = 0
+    end = len(words)
+    while pos < end:
+        (text, length) = table.text(words, pos, address)
+        res.append((address + 2*pos, words[pos:pos+length], text))
+        pos += length
+    return res
+
+def listing(words, address=0, instructions=extended, device=None):
+    """ Returns the disassembly as text, one instruction per line """
+    return '\n'.join('%04x: %-10s %s' % (a, ' '.join('%04x' % w for w in ws),
+                    text) for (a, ws, text) in
+                    disassemble(words, address, instructions, device))
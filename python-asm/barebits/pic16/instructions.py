@@ -2,7 +2,7 @@
 
 """ Instruction set of pic18fxxxx microcontrollers """
 
-from barebits.utils import bits_to_bin, list_to_dict
+from barebits.utils import bits_to_bin
 
 class Designator:
     """Address of a register
@@ -42,9 +42,13 @@ class Instruction:
     opcode -- the first bits which are fixed (given as a string of '0'
     and '1', but converted to int)
     nbits -- the number of fixed bits
+    cycles -- execution time in instruction cycles, a pair (cycles when
+    execution continues with the next instruction, maximal cycles)
 
-    Each subclass of Instruction implements method write with
-    particular parameters
+    Each subclass of Instruction implements method encoder, which
+    returns encode: the function of the particular parameters of the
+    instruction giving its words. encode raises ValueError if an operand
+    is out of range (see _out_of_range).
 
     """
     def __init__(self, name, length, opcode, nbits):
@@ -53,14 +57,34 @@ class Instruction:
         self.length = length
         self.opcode = bits_to_bin(opcode)
         self.nbits = nbits
+        self.cycles = (1, 1)
         assert (len(opcode)==nbits)
+        self.encode = self.encoder()
+
+    """ Returns a function which encodes the instruction and returns a
+    tuple of ints; everything which does not depend on the parameters is
+    computed once, here """
+    def encoder(self):
+        assert False # abstract
 
     """ Generator which encodes instruction and returnes instances of
     class Word """
     def write(self, *params):
+        for word in self.encode(*params):
+            yield Word(word)
+        
+    """ Decodes the parameters of write from the instruction word and
+    the following word (used by instructions of length 4) """
+    def read(self, word, next_word):
         assert False # abstract
         
         
+def _out_of_range(instr, what, value, lo, hi):
+    """ The ValueError of an operand which is not in lo..hi """
+    return ValueError('%s: %s %r out of range %d..%d' % (instr.name, what,
+                        value, lo, hi))
+
+
 class Word:
     def __init__(self, word):
         assert word>=0 and word<=0xffff
@@ -72,29 +96,57 @@ class SimpleInstr(Instruction):
     def __init__(self, name, opcode):
         Instruction.__init__(self, name, 2, opcode, 16)
         
-    def write(self, codeBytes):
-        yield Word(self.opcode)
+    def encoder(self):
+        words = (self.opcode,)
+        return lambda: words
+        
+    def read(self, word, next_word):
+        return ()
         
-
-def genInstrCode(opcode, address, nbits):
-    res = opcode<<nbits
-    res |= address&((1<<nbits)-1)
-    return Word(res)
-
 
 class ArgInstr(Instruction):
     
     def __init__(self, name, opcode, argbits):
         Instruction.__init__(self, name, 2, opcode, 16-argbits)
         
-    def write(self, arg):
-        yield genInstrCode(self.opcode, arg, 16-self.nbits)
+    def encoder(self):
+        argbits = 16-self.nbits
+        base = self.opcode<<argbits
+        mask = (1<<argbits)-1
+        def encode(arg):
+            if not 0 <= arg <= mask:
+                raise _out_of_range(self, 'literal', arg, 0, mask)
+            return (base | arg,)
+        return encode
+        
+    def read(self, word, next_word):
+        return (word & ((1<<(16-self.nbits))-1),)
+
+
+class RelativeInstr(ArgInstr):
+    """ Branch, the argument is a signed offset in words from the next
+    instruction """
+    
+    def encoder(self):
+        argbits = 16-self.nbits
+        base = self.opcode<<argbits
+        mask = (1<<argbits)-1
+        lo = -1<<(argbits-1)
+        hi = -lo-1
+        def encode(offset):
+            if not lo <= offset <= hi:
+                raise _out_of_range(self, 'offset', offset, lo, hi)
+            return (base | offset&mask,)
+        return encode
+        
+    def read(self, word, next_word):
+        argbits = 16-self.nbits
+        arg = word & ((1<<argbits)-1)
+        return (arg - ((arg>>(argbits-1))<<argbits),)
         
 
-def designatorInstrCode(opcode, designator):
-    res = opcode<<9
-    res |= designator.encode()
-    return Word(res)
+def readDesignator(word):
+    return Designator(word & 0xff, (word>>8) & 1 == 1)
 
 
 class DesignatorInstr(Instruction):
@@ -102,15 +154,13 @@ class DesignatorInstr(Instruction):
     def __init__(self, name, opcode):
         Instruction.__init__(self, name, 2, opcode, 16-9)
         
-    def write(self, designator):
-        yield designatorInstrCode(self.opcode, designator)
-
-
-def designatorDestInstrCode(opcode, designator, toSource):
-    res = opcode<<10
-    res |= toSource<<9
-    res |= designator.encode()
-    return Word(res)
+    def encoder(self):
+        base = self.opcode<<9
+        return lambda designator: (base | designator.use_bsr<<8 |
+                                    designator.address,)
+        
+    def read(self, word, next_word):
+        return (readDesignator(word),)
 
 
 class DesignatorDestInstr(Instruction):
@@ -118,25 +168,41 @@ class DesignatorDestInstr(Instruction):
     def __init__(self, name, opcode):
         Instruction.__init__(self, name, 2, opcode, 16-9-1)
         
-    def write(self, designator, toSource):
-        yield designatorDestInstrCode(self.opcode, designator, toSource)
+    def encoder(self):
+        base = self.opcode<<10
+        return lambda designator, toSource: (base | toSource<<9 |
+                        designator.use_bsr<<8 | designator.address,)
+        
+    def read(self, word, next_word):
+        return (readDesignator(word), (word>>9) & 1 == 1)
     
 
+def fullAddress(register):
+    """ Returns the 12-bit address of a register given as a number or a
+    Designator; the bank of a Designator in BSR mode is its attribute
+    bank if it has one, 0 otherwise """
+    if not isinstance(register, Designator):
+        return register
+    if register.use_bsr:
+        return (getattr(register, 'bank', 0)<<8) | register.address
+    if register.address < 0x60:
+        return register.address
+    return 0xf00 | register.address
+
+
 class MoveInstr(Instruction):
     
     def __init__(self, name, opcode):
         Instruction.__init__(self, name, 4, opcode, 16-12)
     
-    def write(self, srcAddress, dstAddress):
-        yield genInstrCode(self.opcode, srcAddress) # 1100 ffff ffff ffff
-        yield genInstrCode(NOPcode, dstAddress) # 1111 ffff ffff ffff
+    def encoder(self):
+        base = self.opcode<<12
+        return lambda srcAddress, dstAddress: (
+                base | fullAddress(srcAddress)&0xfff,
+                NOPcode<<12 | fullAddress(dstAddress)&0xfff)
         
-
-def bitInstrCode(opcode, designator, nbit):
-    res = opcode<<12
-    res |= nbit<<9
-    res |= designator.encode()
-    return Word(res)
+    def read(self, word, next_word):
+        return (word & 0xfff, next_word & 0xfff)
         
 
 class BitInstr(Instruction):
@@ -144,8 +210,17 @@ class BitInstr(Instruction):
     def __init__(self, name, opcode):
         Instruction.__init__(self, name, 2, opcode, 16-9-3)
         
-    def write(self, designator, nbit):
-        yield bitInstrCode(self.opcode, designator, nbit)
+    def encoder(self):
+        base = self.opcode<<12
+        def encode(designator, nbit):
+            if not 0 <= nbit <= 7:
+                raise _out_of_range(self, 'bit', nbit, 0, 7)
+            return (base | nbit<<9 | designator.use_bsr<<8 |
+                    designator.address,)
+        return encode
+        
+    def read(self, word, next_word):
+        return (readDesignator(word), (word>>9) & 7)
     
 
 class LongJumpInstr(Instruction):
@@ -153,138 +228,279 @@ class LongJumpInstr(Instruction):
     def __init__(self, name, opcode):
         Instruction.__init__(self, name, 4, opcode, 16-8)
     
-    def write(self, address):
-        yield genInstrCode(self.opcode, address&0xff, 8)
-        yield genInstrCode(NOPcode, (address>>8)&0xfff, 12)
+    def encoder(self):
+        base = self.opcode<<8
+        return lambda address: (base | address&0xff,
+                                NOPcode<<12 | (address>>8)&0xfff)
+        
+    def read(self, word, next_word):
+        return ((word & 0xff) | ((next_word & 0xfff)<<8),)
         
         
-def fsrInstrCode(opcode, fsr, val, argbits):
-    res = opcode<<(argbits+2)
-    res |= fsr<<argbits
-    res |= val
-    return Word(res)
-
-
 class FSRInstr(Instruction):
     
     def __init__(self, name, opcode):
         Instruction.__init__(self, name, 2, opcode, 16-6-2)
     
-    def write(self, fsr, value):
-        yield fsrInstrCode(self.opcode, fsr, value, 6)
+    def encoder(self):
+        base = self.opcode<<8
+        def encode(fsr, value):
+            if not 0 <= fsr <= 2:
+                raise _out_of_range(self, 'FSR', fsr, 0, 2)
+            if not 0 <= value <= 0x3f:
+                raise _out_of_range(self, 'literal', value, 0, 0x3f)
+            return (base | fsr<<6 | value,)
+        return encode
+        
+    def read(self, word, next_word):
+        return ((word>>6) & 3, word & 0x3f)
 
 class LongFSRInstr(Instruction):
     
     def __init__(self, name, opcode):
         Instruction.__init__(self, name, 4, opcode, 16-4-2)
     
-    def write(self, fsr, value):
-        yield fsrInstrCode(self.opcode, fsr, (value>>8)&0xf, 4)
-        yield genInstrCode(NOPcode, value&0xff, 8)
+    def encoder(self):
+        base = self.opcode<<6
+        def encode(fsr, value):
+            if not 0 <= fsr <= 2:
+                raise _out_of_range(self, 'FSR', fsr, 0, 2)
+            if not 0 <= value <= 0xfff:
+                raise _out_of_range(self, 'literal', value, 0, 0xfff)
+            return (base | fsr<<4 | value>>8, NOPcode<<12 | value&0xff)
+        return encode
+        
+    def read(self, word, next_word):
+        return ((word>>4) & 3, ((word & 0xf)<<8) | (next_word & 0xff))
         
 
 class MoveIndInstr(Instruction):
     def __init__(self, name, opcode):
         Instruction.__init__(self, name, 4, opcode, 16-7)
-    def write(self, offset, address):
-        yield genInstrCode(self.opcode, offset, 7)
-        yield genInstrCode(NOPcode, address)
+    def encoder(self):
+        base = self.opcode<<7
+        def encode(offset, address):
+            if not 0 <= offset <= 0x7f:
+                raise _out_of_range(self, 'offset', offset, 0, 0x7f)
+            return (base | offset, NOPcode<<12 | address&0xfff)
+        return encode
+        
+    def read(self, word, next_word):
+        return (word & 0x7f, next_word & 0xfff)
         
 
 NOPcode = 0xf
 
+class InstructionTable(dict):
+    """ Dictionary name -> Instruction, whose instructions are created
+    when they are first looked up, so that importing the module costs
+    little.
+
+    base -- table whose instructions are also in this one (the very same
+    instances)
+    specs -- list of tuples (class, name, parameters of the constructor)
+    stamp -- identifies the instruction set by its specs (computed on
+    first use, without creating the instructions)
+
+    """
+    def __init__(self, base, specs):
+        dict.__init__(self)
+        self.base = base
+        self.specs = dict((spec[1], spec) for spec in specs)
+        self.names = list(self.specs)
+        if base is not None:
+            self.names += base.names
+
+    def __missing__(self, name):
+        spec = self.specs.get(name)
+        if spec is not None:
+            instruction = spec[0](*spec[1:])
+            instruction.cycles = _cycles.get(name, (1, 1))
+        elif self.base is not None:
+            instruction = self.base[name]
+        else:
+            raise KeyError(name)
+        self[name] = instruction
+        return instruction
+
+    def __getattr__(self, name):
+        if name != 'stamp':
+            raise AttributeError(name)
+        import hashlib
+        desc = sorted('%s %s' % (spec[0].__name__,
+                        ' '.join(str(x) for x in spec[1:]))
+                        for spec in self.specs.itervalues())
+        if self.base is not None:
+            desc.append(self.base.stamp)
+        self.stamp = hashlib.sha1('\n'.join(desc)).hexdigest()[:16]
+        return self.stamp
+
+    def _create(self):
+        """ Creates all the instructions """
+        if dict.__len__(self) < len(self.names):
+            for name in self.names:
+                self[name]
+
+    def __contains__(self, name):
+        return name in self.specs or (self.base is not None and 
+                                        name in self.base)
+
+    has_key = __contains__
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+    iterkeys = __iter__
+
+    def values(self):
+        self._create()
+        return dict.values(self)
+
+    def itervalues(self):
+        self._create()
+        return dict.itervalues(self)
+
+    def items(self):
+        self._create()
+        return dict.items(self)
+
+    def iteritems(self):
+        self._create()
+        return dict.iteritems(self)
+
+    def copy(self):
+        self._create()
+        return dict(self)
+
+
 """ Standard instruction set """
-standard = list_to_dict([
-    SimpleInstr('NOP', 				'0000 0000 0000 0000'),
-    SimpleInstr('SLEEP', 			'0000 0000 0000 0011'),
-    SimpleInstr('CLRWDT', 			'0000 0000 0000 0100'),
-    SimpleInstr('PUSH', 			'0000 0000 0000 0101'),
-    SimpleInstr('POP', 				'0000 0000 0000 0110'),
-    SimpleInstr('DAW', 				'0000 0000 0000 0111'),
-    SimpleInstr('TBLRD', 			'0000 0000 0000 1000'),
-    SimpleInstr('TBLRDPOSTINC', 	'0000 0000 0000 1001'),
-    SimpleInstr('TBLRDPOSTDEC', 	'0000 0000 0000 1010'),
-    SimpleInstr('TBLRDPREINC', 		'0000 0000 0000 1011'),
-    SimpleInstr('TBLWT', 			'0000 0000 0000 1100'),
-    SimpleInstr('TBLWTPOSTINC',		'0000 0000 0000 1101'),
-    SimpleInstr('TBLWTPOSTDEC',		'0000 0000 0000 1110'),
-    SimpleInstr('TBLWTPREINC', 		'0000 0000 0000 1111'),
-    SimpleInstr('RETFIE', 			'0000 0000 0001 0000'),
-    SimpleInstr('RETFIEFAST',		'0000 0000 0001 0001'),
-    SimpleInstr('RETURN', 			'0000 0000 0001 0010'),
-    SimpleInstr('RETURNFAST',		'0000 0000 0001 0011'),
-    SimpleInstr('RESET', 			'0000 0000 1111 1111'),
-    ArgInstr('MOVLB', 				'0000 0001 0000', 4),
-    DesignatorInstr('MULWF', 		'0000 001'),
-    DesignatorDestInstr('DECF',		'0000 01'),
-    ArgInstr('SUBLW', 				'0000 1000', 8),
-    ArgInstr('IORLW', 				'0000 1001', 8),
-    ArgInstr('XORLW', 				'0000 1010', 8),
-    ArgInstr('ANDLW', 				'0000 1011', 8),
-    ArgInstr('RETLW', 				'0000 1100', 8),
-    ArgInstr('MULLW', 				'0000 1101', 8),
-    ArgInstr('MOVLW', 				'0000 1110', 8),
-    ArgInstr('ADDLW', 				'0000 1111', 8),
-    DesignatorDestInstr('IORWF', 	'0001 00'),
-    DesignatorDestInstr('ANDWF', 	'0001 01'),
-    DesignatorDestInstr('XORWF', 	'0001 10'),
-    DesignatorDestInstr('COMF', 	'0001 11'),
-    DesignatorDestInstr('ADDWFC', 	'0010 00'),
-    DesignatorDestInstr('ADDWF', 	'0010 01'),
-    DesignatorDestInstr('INCF', 	'0010 10'),
-    DesignatorDestInstr('DECFSZ', 	'0010 11'),
-    DesignatorDestInstr('RRCF', 	'0011 00'),
-    DesignatorDestInstr('RLCF', 	'0011 01'),
-    DesignatorDestInstr('SWAPF', 	'0011 10'),
-    DesignatorDestInstr('INCFSZ', 	'0011 11'),
-    DesignatorDestInstr('RRNCF', 	'0100 00'),
-    DesignatorDestInstr('RLNCF', 	'0100 01'),
-    DesignatorDestInstr('INFSNZ', 	'0100 10'),
-    DesignatorDestInstr('DCFSNZ', 	'0100 11'),
-    DesignatorDestInstr('MOVF', 	'0101 00'),
-    DesignatorDestInstr('SUBFWB', 	'0101 01'),
-    DesignatorDestInstr('SUBWFB', 	'0101 10'),
-    DesignatorDestInstr('SUBWF', 	'0101 11'),
-    DesignatorInstr('CPFSLT', 		'0110 000'),
-    DesignatorInstr('CPFSEQ', 		'0110 001'),
-    DesignatorInstr('CPFSGT', 		'0110 010'),
-    DesignatorInstr('TSTFSZ', 		'0110 011'),
-    DesignatorInstr('SETF', 		'0110 100'),
-    DesignatorInstr('CLRF', 		'0110 101'),
-    DesignatorInstr('NEGF', 		'0110 110'),
-    DesignatorInstr('MOVWF', 		'0110 111'),
-    BitInstr('BTG', 				'0111'),
-    BitInstr('BSF', 				'1000'),
-    BitInstr('BCF', 				'1001'),
-    BitInstr('BTFSS', 				'1010'),
-    BitInstr('BTFSC', 				'1011'),
-    MoveInstr('MOVFF', 				'1100'),
-    ArgInstr('BRA',					'1101 0', 11),
-    ArgInstr('RCALL', 				'1101 1', 11),
-    ArgInstr('BZ', 					'1110 0000', 8),
-    ArgInstr('BNZ', 				'1110 0001', 8),
-    ArgInstr('BC', 					'1110 0010', 8),
-    ArgInstr('BNC', 				'1110 0011', 8),
-    ArgInstr('BOV', 				'1110 0100', 8),
-    ArgInstr('BNOV', 				'1110 0101', 8),
-    ArgInstr('BN', 					'1110 0110', 8),
-    ArgInstr('BNN', 				'1110 0111', 8),
-    LongJumpInstr('CALL', 			'1110 1100'),
-    LongJumpInstr('CALLFAST', 		'1110 1101'),
-    LongJumpInstr('GOTO', 			'1110 1111'),
-    LongFSRInstr('LFSR', 				'1110 1110 00'),
-    ArgInstr('NOP1',				'1111', 12),
+standard = InstructionTable(None, [
+    (SimpleInstr, 'NOP', 				'0000 0000 0000 0000'),
+    (SimpleInstr, 'SLEEP', 			'0000 0000 0000 0011'),
+    (SimpleInstr, 'CLRWDT', 			'0000 0000 0000 0100'),
+    (SimpleInstr, 'PUSH', 			'0000 0000 0000 0101'),
+    (SimpleInstr, 'POP', 				'0000 0000 0000 0110'),
+    (SimpleInstr, 'DAW', 				'0000 0000 0000 0111'),
+    (SimpleInstr, 'TBLRD', 			'0000 0000 0000 1000'),
+    (SimpleInstr, 'TBLRDPOSTINC', 	'0000 0000 0000 1001'),
+    (SimpleInstr, 'TBLRDPOSTDEC', 	'0000 0000 0000 1010'),
+    (SimpleInstr, 'TBLRDPREINC', 		'0000 0000 0000 1011'),
+    (SimpleInstr, 'TBLWT', 			'0000 0000 0000 1100'),
+    (SimpleInstr, 'TBLWTPOSTINC',		'0000 0000 0000 1101'),
+    (SimpleInstr, 'TBLWTPOSTDEC',		'0000 0000 0000 1110'),
+    (SimpleInstr, 'TBLWTPREINC', 		'0000 0000 0000 1111'),
+    (SimpleInstr, 'RETFIE', 			'0000 0000 0001 0000'),
+    (SimpleInstr, 'RETFIEFAST',		'0000 0000 0001 0001'),
+    (SimpleInstr, 'RETURN', 			'0000 0000 0001 0010'),
+    (SimpleInstr, 'RETURNFAST',		'0000 0000 0001 0011'),
+    (SimpleInstr, 'RESET', 			'0000 0000 1111 1111'),
+    (ArgInstr, 'MOVLB', 				'0000 0001 0000', 4),
+    (DesignatorInstr, 'MULWF', 		'0000 001'),
+    (DesignatorDestInstr, 'DECF',		'0000 01'),
+    (ArgInstr, 'SUBLW', 				'0000 1000', 8),
+    (ArgInstr, 'IORLW', 				'0000 1001', 8),
+    (ArgInstr, 'XORLW', 				'0000 1010', 8),
+    (ArgInstr, 'ANDLW', 				'0000 1011', 8),
+    (ArgInstr, 'RETLW', 				'0000 1100', 8),
+    (ArgInstr, 'MULLW', 				'0000 1101', 8),
+    (ArgInstr, 'MOVLW', 				'0000 1110', 8),
+    (ArgInstr, 'ADDLW', 				'0000 1111', 8),
+    (DesignatorDestInstr, 'IORWF', 	'0001 00'),
+    (DesignatorDestInstr, 'ANDWF', 	'0001 01'),
+    (DesignatorDestInstr, 'XORWF', 	'0001 10'),
+    (DesignatorDestInstr, 'COMF', 	'0001 11'),
+    (DesignatorDestInstr, 'ADDWFC', 	'0010 00'),
+    (DesignatorDestInstr, 'ADDWF', 	'0010 01'),
+    (DesignatorDestInstr, 'INCF', 	'0010 10'),
+    (DesignatorDestInstr, 'DECFSZ', 	'0010 11'),
+    (DesignatorDestInstr, 'RRCF', 	'0011 00'),
+    (DesignatorDestInstr, 'RLCF', 	'0011 01'),
+    (DesignatorDestInstr, 'SWAPF', 	'0011 10'),
+    (DesignatorDestInstr, 'INCFSZ', 	'0011 11'),
+    (DesignatorDestInstr, 'RRNCF', 	'0100 00'),
+    (DesignatorDestInstr, 'RLNCF', 	'0100 01'),
+    (DesignatorDestInstr, 'INFSNZ', 	'0100 10'),
+    (DesignatorDestInstr, 'DCFSNZ', 	'0100 11'),
+    (DesignatorDestInstr, 'MOVF', 	'0101 00'),
+    (DesignatorDestInstr, 'SUBFWB', 	'0101 01'),
+    (DesignatorDestInstr, 'SUBWFB', 	'0101 10'),
+    (DesignatorDestInstr, 'SUBWF', 	'0101 11'),
+    (DesignatorInstr, 'CPFSLT', 		'0110 000'),
+    (DesignatorInstr, 'CPFSEQ', 		'0110 001'),
+    (DesignatorInstr, 'CPFSGT', 		'0110 010'),
+    (DesignatorInstr, 'TSTFSZ', 		'0110 011'),
+    (DesignatorInstr, 'SETF', 		'0110 100'),
+    (DesignatorInstr, 'CLRF', 		'0110 101'),
+    (DesignatorInstr, 'NEGF', 		'0110 110'),
+    (DesignatorInstr, 'MOVWF', 		'0110 111'),
+    (BitInstr, 'BTG', 				'0111'),
+    (BitInstr, 'BSF', 				'1000'),
+    (BitInstr, 'BCF', 				'1001'),
+    (BitInstr, 'BTFSS', 				'1010'),
+    (BitInstr, 'BTFSC', 				'1011'),
+    (MoveInstr, 'MOVFF', 				'1100'),
+    (RelativeInstr, 'BRA',			'1101 0', 11),
+    (RelativeInstr, 'RCALL',			'1101 1', 11),
+    (RelativeInstr, 'BZ',				'1110 0000', 8),
+    (RelativeInstr, 'BNZ',			'1110 0001', 8),
+    (RelativeInstr, 'BC',				'1110 0010', 8),
+    (RelativeInstr, 'BNC',			'1110 0011', 8),
+    (RelativeInstr, 'BOV',			'1110 0100', 8),
+    (RelativeInstr, 'BNOV',			'1110 0101', 8),
+    (RelativeInstr, 'BN',				'1110 0110', 8),
+    (RelativeInstr, 'BNN',			'1110 0111', 8),
+    (LongJumpInstr, 'CALL', 			'1110 1100'),
+    (LongJumpInstr, 'CALLFAST', 		'1110 1101'),
+    (LongJumpInstr, 'GOTO', 			'1110 1111'),
+    (LongFSRInstr, 'LFSR', 				'1110 1110 00'),
+    (ArgInstr, 'NOP1',				'1111', 12),
 ])
 
 """ Extended instruction set (enabled if XINST configuration bit is set) """
-extended = list_to_dict([
-    SimpleInstr('CALLW', 			'0000 0000 0001 0100'),
-    FSRInstr('ADDFSR', 				'1110 1000'),
-    FSRInstr('SUBFSR', 				'1110 1001'),
-    ArgInstr('ADDULNK',				'1110 1000 11', 6),
-    ArgInstr('SUBULNK',				'1110 1001 11', 6),
-    ArgInstr('PUSHL',				'1110 1010', 8),
-    MoveIndInstr('MOVSF',			'1110 1011 0'),
-    MoveIndInstr('MOVSS',			'1110 1011 1'),
+extended = InstructionTable(standard, [
+    (SimpleInstr, 'CALLW', 			'0000 0000 0001 0100'),
+    (FSRInstr, 'ADDFSR', 				'1110 1000'),
+    (FSRInstr, 'SUBFSR', 				'1110 1001'),
+    (ArgInstr, 'ADDULNK',				'1110 1000 11', 6),
+    (ArgInstr, 'SUBULNK',				'1110 1001 11', 6),
+    (ArgInstr, 'PUSHL',				'1110 1010', 8),
+    (MoveIndInstr, 'MOVSF',			'1110 1011 0'),
+    (MoveIndInstr, 'MOVSS',			'1110 1011 1'),
 ])
-extended.update(standard)
+""" Instructions which skip the next one when their condition holds """
+skips = frozenset(['BTFSS', 'BTFSC', 'CPFSEQ', 'CPFSGT', 'CPFSLT',
+        'TSTFSZ', 'DECFSZ', 'INCFSZ', 'DCFSNZ', 'INFSNZ'])
+
+""" Conditional branches: name -> (mask of the STATUS flag they test, the
+value of the flag which takes the branch) """
+branch_flags = {}
+for (_mask, _set, _clear) in [(1, 'BC', 'BNC'), (4, 'BZ', 'BNZ'),
+                                (8, 'BOV', 'BNOV'), (16, 'BN', 'BNN')]:
+    branch_flags[_set] = (_mask, True)
+    branch_flags[_clear] = (_mask, False)
+
+""" Execution time of the instructions which take more than one cycle.
+Conditional branches take 2 cycles if taken, skips take 2 cycles if they
+skip a one-word instruction and 3 if they skip a two-word one. """
+_timing = {
+    (2, 2): ['MOVFF', 'LFSR', 'MOVSF', 'MOVSS', 'GOTO', 'CALL', 'CALLFAST',
+        'BRA', 'RCALL', 'RETURN', 'RETURNFAST', 'RETFIE', 'RETFIEFAST',
+        'RETLW', 'CALLW', 'TBLRD', 'TBLRDPOSTINC', 'TBLRDPOSTDEC',
+        'TBLRDPREINC', 'TBLWT', 'TBLWTPOSTINC', 'TBLWTPOSTDEC',
+        'TBLWTPREINC', 'ADDULNK', 'SUBULNK'],
+    (1, 2): list(branch_flags),
+    (1, 3): list(skips),
+}
+_cycles = dict((name, cycles) for (cycles, names) in _timing.items()
+                for name in names)
@@ -0,0 +1,491 @@
+# Copyright 2008 Anton Mellit
+
+""" Lane-parallel execution of generated code with NumPy
+
+Every lane is an independent run of the same code on its own data. WREG,
+the file registers and STATUS hold one byte per lane in NumPy arrays, so a
+snippet is executed for all input combinations at once. Lanes may take
+different branches: at each step the instruction with the lowest address
+among the unfinished lanes is executed for the lanes which are there.
+
+The code is taken from a CodeMaker, the instructions are read from its
+comments table.
+
+"""
+
+from __future__ import with_statement
+
+import numpy
+
+from barebits import operations
+from barebits.context import isolated
+from barebits.code import Fixup
+from barebits.pic16.registers import WREG, STATUS, BSR, PROD
+from barebits.pic16.instructions import fullAddress, branch_flags
+
+C, DC, Z, OV, N = 1, 2, 4, 8, 16
+ALL = C | DC | Z | OV | N
+
+def _address(reg):
+    """ Full address of a special register """
+    return 0xf00 | reg.address
+
+_wreg = _address(WREG)
+_status = _address(STATUS)
+_bsr = _address(BSR)
+_prodl = _address(PROD)
+
+
+def _signed(value, nbits):
+    value &= (1<<nbits) - 1
+    return value - ((value>>(nbits-1))<<nbits)
+
+
+class LaneMachine:
+    """ Executes code for many lanes at once.
+
+    lanes -- number of lanes
+    regs -- dictionary full address -> numpy.uint8 array of values,
+    registers which were never written are zero
+    steps -- number of instructions executed by the last run
+
+    """
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self.regs = {}
+        self.steps = 0
+
+    def __getitem__(self, reg):
+        """ Values of a register given by a Designator or a full address """
+        return self._read(self._resolve(reg))
+
+    def __setitem__(self, reg, values):
+        if isinstance(reg, Fixup) and not reg.resolved:
+            return      # a register the code does not use got no address
+        self.regs[self._resolve(reg)] = self._spread(numpy.asarray(values) &
+                                                    0xff)
+
+    def _spread(self, values):
+        """ Converts values (an array or a scalar) to one byte per lane """
+        values = numpy.asarray(values)
+        if values.shape != (self.lanes,):
+            values = numpy.broadcast_to(values, (self.lanes,))
+        return values.astype(numpy.uint8)
+
+    def _resolve(self, reg):
+        if isinstance(reg, (int, long)):
+            return reg
+        if not reg.use_bsr:
+            if reg.address < 0x60:
+                return reg.address
+            return 0xf00 | reg.address
+        bsr = self._read(_bsr)
+        if (bsr != bsr[0]).any():
+            raise NotImplementedError('BSR differs between lanes')
+        return (int(bsr[0] & 0xf)<<8) | reg.address
+
+    def _read(self, address):
+        values = self.regs.get(address)
+        if values is None:
+            values = self.regs[address] = numpy.zeros(self.lanes, numpy.uint8)
+        return values
+
+    def _write(self, address, values, mask):
+        if mask is not None:
+            values = numpy.where(mask, values, self._read(address))
+        self.regs[address] = self._spread(values)
+
+    def _flags(self, mask, affected, flags):
+        status = self._read(_status).astype(numpy.int32)
+        self._write(_status, (status & ~affected) | (flags & affected), mask)
+
+    def _logic_flags(self, mask, res):
+        self._flags(mask, Z | N, numpy.where(res == 0, Z, 0) |
+                    ((res>>3) & N))
+
+    def _add(self, mask, a, b, carry):
+        """ a + b + carry with all flags, returns the result """
+        res = a + b + carry
+        dc = ((a & 0xf) + (b & 0xf) + carry) & 0x10
+        low = res & 0xff
+        ov = ((a ^ low) & (b ^ low) & 0x80)>>4
+        self._flags(mask, ALL, ((res>>8) & C) | (dc>>3) | ov |
+                    numpy.where(low == 0, Z, 0) | ((low>>3) & N))
+        return low
+
+    def _sub(self, mask, a, b, carry=1):
+        """ a - b - (1-carry) with all flags """
+        return self._add(mask, a, (~b) & 0xff, carry)
+
+    def _carry(self):
+        return self._read(_status).astype(numpy.int32) & C
+
+    def _f(self, f):
+        return self._read(self._resolve(f)).astype(numpy.int32)
+
+    def _w(self):
+        return self._read(_wreg).astype(numpy.int32)
+
+    def _dest(self, mask, f, d, res):
+        if d:
+            self._write(self._resolve(f), res, mask)
+        else:
+            self._write(_wreg, res, mask)
+
+    # Instructions. Each method takes the lane mask (None for all the
+    # lanes) and the arguments of the instruction, skip and branch
+    # instructions return the lanes where the skip or jump happens.
+
+    def i_NOP(self, mask):
+        pass
+
+    def i_MOVLB(self, mask, k):
+        self._write(_bsr, k & 0xf, mask)
+
+    def i_MOVLW(self, mask, k):
+        self._write(_wreg, k & 0xff, mask)
+
+    def i_MOVWF(self, mask, f):
+        self._write(self._resolve(f), self._w(), mask)
+
+    def i_MOVF(self, mask, f, d):
+        res = self._f(f)
+        self._dest(mask, f, d, res)
+        self._logic_flags(mask, res)
+
+    def i_MOVFF(self, mask, src, dst):
+        value = self._read(fullAddress(src)).astype(numpy.int32)
+        self._write(fullAddress(dst), value, mask)
+
+    def i_CLRF(self, mask, f):
+        self._write(self._resolve(f), 0, mask)
+        self._flags(mask, Z, Z)
+
+    def i_SETF(self, mask, f):
+        self._write(self._resolve(f), 0xff, mask)
+
+    def i_SWAPF(self, mask, f, d):
+        res = self._f(f)
+        self._dest(mask, f, d, ((res<<4) | (res>>4)) & 0xff)
+
+    def i_COMF(self, mask, f, d):
+        res = (~self._f(f)) & 0xff
+        self._dest(mask, f, d, res)
+        self._logic_flags(mask, res)
+
+    def _logic(op):
+        def wreg_reg(self, mask, f, d):
+            res = op(self._f(f), self._w())
+            self._dest(mask, f, d, res)
+            self._logic_flags(mask, res)
+        def lit_wreg(self, mask, k):
+            res = op(self._w(), k & 0xff)
+            self._write(_wreg, res, mask)
+            self._logic_flags(mask, res)
+        return (wreg_reg, lit_wreg)
+
+    (i_ANDWF, i_ANDLW) = _logic(numpy.bitwise_and)
+    (i_IORWF, i_IORLW) = _logic(numpy.bitwise_or)
+    (i_XORWF, i_XORLW) = _logic(numpy.bitwise_xor)
+
+    def i_ADDWF(self, mask, f, d):
+        self._dest(mask, f, d, self._add(mask, self._f(f), self._w(), 0))
+
+    def i_ADDWFC(self, mask, f, d):
+        self._dest(mask, f, d, self._add(mask, self._f(f), self._w(),
+                    self._carry()))
+
+    def i_ADDLW(self, mask, k):
+        self._write(_wreg, self._add(mask, self._w(), k & 0xff, 0), mask)
+
+    def i_SUBWF(self, mask, f, d):
+        self._dest(mask, f, d, self._sub(mask, self._f(f), self._w()))
+
+    def i_SUBWFB(self, mask, f, d):
+        self._dest(mask, f, d, self._sub(mask, self._f(f), self._w(),
+                    self._carry()))
+
+    def i_SUBFWB(self, mask, f, d):
+        self._dest(mask, f, d, self._sub(mask, self._w(), self._f(f),
+                    self._carry()))
+
+    def i_SUBLW(self, mask, k):
+        self._write(_wreg, self._sub(mask, k & 0xff, self._w()), mask)
+
+    def i_NEGF(self, mask, f):
+        self._write(self._resolve(f), self._sub(mask, 0, self._f(f)), mask)
+
+    def i_INCF(self, mask, f, d):
+        self._dest(mask, f, d, self._add(mask, self._f(f), 1, 0))
+
+    def i_DECF(self, mask, f, d):
+        self._dest(mask, f, d, self._sub(mask, self._f(f), 1))
+
+    def i_RLCF(self, mask, f, d):
+        value = self._f(f)
+        res = ((value<<1) | self._carry()) & 0xff
+        self._dest(mask, f, d, res)
+        self._flags(mask, C | Z | N, (value>>7) |
+                    numpy.where(res == 0, Z, 0) | ((res>>3) & N))
+
+    def i_RRCF(self, mask, f, d):
+        value = self._f(f)
+        res = (value>>1) | (self._carry()<<7)
+        self._dest(mask, f, d, res)
+        self._flags(mask, C | Z | N, (value & 1) |
+                    numpy.where(res == 0, Z, 0) | ((res>>3) & N))
+
+    def i_RLNCF(self, mask, f, d):
+        value = self._f(f)
+        res = ((value<<1) | (value>>7)) & 0xff
+        self._dest(mask, f, d, res)
+        self._logic_flags(mask, res)
+
+    def i_RRNCF(self, mask, f, d):
+        value = self._f(f)
+        res = ((value>>1) | (value<<7)) & 0xff
+        self._dest(mask, f, d, res)
+        self._logic_flags(mask, res)
+
+    def i_MULWF(self, mask, f):
+        self._product(mask, self._f(f))
+
+    def i_MULLW(self, mask, k):
+        self._product(mask, k & 0xff)
+
+    def _product(self, mask, value):
+        res = self._w() * value
+        self._write(_prodl, res & 0xff, mask)
+        self._write(_prodl+1, res>>8, mask)
+
+    def i_BSF(self, mask, f, b):
+        self._write(self._resolve(f), self._f(f) | (1<<b), mask)
+
+    def i_BCF(self, mask, f, b):
+        self._write(self._resolve(f), self._f(f) & ~(1<<b), mask)
+
+    def i_BTG(self, mask, f, b):
+        self._write(self._resolve(f), self._f(f) ^ (1<<b), mask)
+
+    def i_BTFSS(self, mask, f, b):
+        return (self._f(f)>>b) & 1 == 1
+
+    def i_BTFSC(self, mask, f, b):
+        return (self._f(f)>>b) & 1 == 0
+
+    def i_TSTFSZ(self, mask, f):
+        return self._f(f) == 0
+
+    def i_CPFSEQ(self, mask, f):
+        return self._f(f) == self._w()
+
+    def i_CPFSGT(self, mask, f):
+        return self._f(f) > self._w()
+
+    def i_CPFSLT(self, mask, f):
+        return self._f(f) < self._w()
+
+    def _count_skip(step, skip_on_zero):
+        def f(self, mask, reg, d):
+            res = (self._f(reg) + step) & 0xff
+            self._dest(mask, reg, d, res)
+            return (res == 0) == skip_on_zero
+        return f
+
+    i_INCFSZ = _count_skip(1, True)
+    i_DECFSZ = _count_skip(-1, True)
+    i_INFSNZ = _count_skip(1, False)
+    i_DCFSNZ = _count_skip(-1, False)
+
+    del _logic, _count_skip
+
+    def i_BRA(self, mask, n):
+        return True
+
+    def i_GOTO(self, mask, label):
+        return True
+
+    def _branch(self, name):
+        (flag, value) = branch_flags[name]
+        return ((self._read(_status) & flag) != 0) == value
+
+    def run(self, code, max_steps=100000):
+        """ Runs the code of a CodeMaker (which must keep comments) from
+        its first instruction until every lane leaves it """
+        instructions = code.instructions
+        program = {}
+        for (pos, comment) in code.comments.iteritems():
+            name = comment[0]
+            program[pos] = (name, comment[1:],
+                            instructions[name].length//2)
+        end = len(code.output)
+        pc = numpy.zeros(self.lanes, numpy.int32)
+        self.steps = 0
+        while True:
+            live = (pc >= 0) & (pc < end)
+            if not live.any():
+                break
+            self.steps += 1
+            if self.steps > max_steps:
+                raise RuntimeError('code did not finish in %d steps' %
+                                    max_steps)
+            p = pc[live].min()
+            mask = pc == p
+            if mask.all():
+                mask = None
+            (name, args, length) = program[p]
+            following = p + length
+            if name in branch_flags:
+                taken = self._branch(name)
+            else:
+                taken = getattr(self, 'i_' + name)(mask, *args)
+            if taken is None:
+                target = following
+            elif name == 'BRA' or name in branch_flags:
+                bits = 11 if name == 'BRA' else 8
+                target = numpy.where(taken, following +
+                                    _signed(args[0], bits), following)
+            elif name == 'GOTO':
+                target = args[0].pos
+            else:
+                skip = following
+                if following in program:
+                    skip += program[following][2]
+                target = numpy.where(taken, skip, following)
+            if mask is None:
+                pc[:] = target
+            else:
+                pc[mask] = numpy.broadcast_to(target, pc.shape)[mask]
+        return self
+
+
+def _compile(make, options):
+    """ Compiles make(a, b, r), where a, b and r are variables, with the
+    given options of program, returns the code and the addresses of a, b
+    and r """
+    from barebits.pic16.control import program
+    from barebits.pic16.alu import var
+
+    with isolated() as context:
+        with program(**options):
+            (a, b, r) = (var(), var(), var())
+            make(a, b, r)
+            addresses = (a.address, b.address, r.address)
+    return (context.code_maker,) + addresses
+
+def _assign(expr):
+    def make(a, b, r):
+        r <<= expr(a, b)
+    return make
+
+def _branch_on(expr):
+    def make(a, b, r):
+        from barebits.pic16.control import if_
+        with if_(expr(a, b)):
+            r <<= 1
+    return make
+
+def _forms(name):
+    """ Pairs (form name, function of two operands) producing the
+    expressions which exercise different code paths of the ALU """
+    op = lambda x, y: operations.Operation(name, (x, y))
+    wreg = lambda x: x ^ 0
+    return [
+        ('reg, reg', op),
+        ('wreg, reg', lambda a, b: op(wreg(a), b)),
+        ('reg, wreg', lambda a, b: op(a, wreg(b))),
+        ('temp, wreg', lambda a, b: op(wreg(a), wreg(b))),
+    ]
+
+def _mismatch(form, a, b, got, expected, known):
+    bad = numpy.flatnonzero((got != expected) & ~known)
+    if not len(bad):
+        return []
+    i = bad[0]
+    return [(form, len(bad), (int(numpy.asarray(a)[i]),
+                int(numpy.asarray(b)[i]), int(got[i]), int(expected[i])))]
+
+def ordering_overflow(a, b):
+    """ The pairs of operands where the ALU may get an ordering comparison
+    wrong: it compares the sign of the 8-bit difference, which overflows
+    for unsigned operands 0x80 or more apart """
+    a = numpy.asarray(a).astype(numpy.int32)
+    b = numpy.asarray(b).astype(numpy.int32)
+    return abs(a - b) >= 0x80
+
+def verify(name, values=range(256), known=None, **options):
+    """ Checks the code the ALU generates for operation name against
+    operations.evaluate for all pairs of operands taken from values.
+    known(a, b) tells the pairs which are expected to fail, these are not
+    reported. options are passed to program.
+
+    Returns a list of mismatches (form, count, (a, b, got, expected)),
+    where form tells which operands were registers, WREG or literals,
+    count is the number of failing input pairs, the last element is an
+    example. The second operand of operations.literal_ops is only a
+    literal other than 0.
+
+    """
+    values = numpy.asarray(values)
+    n = len(values)
+    a = numpy.repeat(values, n)
+    b = numpy.tile(values, n)
+    with numpy.errstate(divide='ignore'):
+        expected = operations.evaluate(name, (a, b))
+    if known is None:
+        known = numpy.zeros(n*n, dtype=bool)
+    else:
+        known = numpy.asarray(known(a, b), dtype=bool)
+    is_comp = name in operations.comp_ops
+    if is_comp:
+        expected = expected.astype(numpy.int32)
+        make = _branch_on
+    else:
+        make = _assign
+    failures = []
+    by_literal = name in operations.literal_ops
+    for (form, expr) in ([] if by_literal else _forms(name)):
+        (code, ra, rb, rr) = _compile(make(expr), options)
+        machine = LaneMachine(n*n)
+        machine[ra] = a
+        machine[rb] = b
+        got = machine.run(code)[rr]
+        failures += _mismatch(form, a, b, got, expected, known)
+    for k in values:
+        k = int(k)
+        if by_literal and k == 0:
+            continue
+        forms = [('reg, literal', lambda x, y:
+                    operations.Operation(name, (x, k)), b),
+                ('literal, reg', lambda x, y:
+                    operations.Operation(name, (k, y)), a)]
+        if by_literal:
+            forms = forms[:1]
+        for (form, expr, fixed) in forms:
+            lanes = numpy.flatnonzero(fixed == k)
+            (code, ra, rb, rr) = _compile(make(expr), options)
+            machine = LaneMachine(n)
+            machine[ra] = a[lanes]
+            machine[rb] = b[lanes]
+            got = machine.run(code)[rr]
+            failures += _mismatch(form, a[lanes], b[lanes], got,
+                                    expected[lanes], known[lanes])
+    return failures
+
+def check_alu(**options):
+    """ Verifies all the binary operations of the ALU, returns a list of
+    failures (operation, mismatch) with mismatches as in verify. options
+    are passed to program.
+
+    Ordering comparisons are computed from the sign of the difference,
+    the pairs of operands where it overflows are expected failures
+    (ordering_overflow). All the other pairs must compare right.
+
+    """
+    failures = []
+    for name in operations.binary_ops + ['==', '<>']:
+        failures += [(name, m) for m in verify(name, **options)]
+    for name in ['<', '<=', '>', '>=']:
+        failures += [(name, m) for m in verify(name,
+                        known=ordering_overflow, **options)]
+    return failures
@@ -0,0 +1,264 @@
+# Copyright 2008 Anton Mellit
+
+""" Multiplications and divisions by literals
+
+The functions return plans: lists of instructions (name, args) as given
+to CodeMaker.do, which run straight through. Operands are lists of bytes,
+the lowest first, each a register or a literal. The ALU builds the
+candidate plans of an operation and emits the cheapest one (cost).
+
+A product of several bytes is the sum of the 8x8 products of MULWF and
+MULLW (PRODH:PRODL), each added at its position with the carry going up
+to the highest byte. A multiplication by a literal may instead shift and
+add following the bits of the literal, or only shift for a power of two.
+A division by a literal d is a multiplication by its reciprocal m taken
+at a precision which makes it exact (magic), followed by a shift.
+
+"""
+
+from barebits.pic16.registers import WREG, STATUS, PROD
+
+def _is_literal(x):
+    return isinstance(x, (int, long))
+
+def cost(plan):
+    """ (cycles, words) of a plan """
+    from barebits.pic16.instructions import standard
+    cycles = words = 0
+    for instr in plan:
+        instruction = standard[instr[0]]
+        cycles += instruction.cycles[0]
+        words += instruction.length // 2
+    return (cycles, words)
+
+def magic(d, nbits):
+    """ Returns (m, s) such that x//d == x*m >> (nbits + s) for all
+    0 <= x < 2**nbits, with the smallest s found; m < 2**(nbits + 1).
+
+    m = ceil(2**(nbits + s)/d) exceeds 2**(nbits + s)/d by e/d, which adds
+    less than 1/d to x/d if e <= 2**s. This holds for 2**s >= d.
+
+    """
+    s = 0
+    while True:
+        m = -(-(1 << nbits + s) // d)
+        if m*d - (1 << nbits + s) <= 1 << s:
+            return (m, s)
+        s += 1
+
+def _rotate(x, s):
+    """ Instructions leaving x rotated left by s bits in WREG """
+    s %= 8
+    if s == 0:
+        return [('MOVF', x, False)]
+    names = min((['RLNCF']*s, ['RRNCF']*(8 - s),
+                ['SWAPF'] + (['RLNCF']*(s - 4) if s > 4 else
+                                ['RRNCF']*(4 - s))), key=len)
+    return ([(names[0], x, False)] +
+            [(name, WREG, False) for name in names[1:]])
+
+def shift_byte(x, s):
+    """ Plan leaving x << s in WREG, x >> -s if s is negative; x is a
+    register """
+    if s >= 0:
+        mask = (0xff << s) & 0xff
+    else:
+        mask = 0xff >> -s
+    if mask == 0:
+        return [('MOVLW', 0)]
+    plan = _rotate(x, s)
+    if mask != 0xff:
+        plan.append(('ANDLW', mask))
+    return plan
+
+def mul_byte_plans(x, k):
+    """ Plans leaving the low byte of x*k in WREG, x is a register and k
+    a literal byte above 1 """
+    (prodl, prodh) = PROD.regs
+    plans = []
+    s = k.bit_length() - 1
+    if k == 1 << s:
+        plans.append(shift_byte(x, s))
+    elif k == (1 << s) + 1:
+        plans.append(shift_byte(x, s) + [('ADDWF', x, False)])
+    # doubling WREG for every bit of k after the highest, adding x for
+    # the bits set
+    plan = [('MOVF', x, False)]
+    for bit in bin(k)[3:]:
+        plan.append(('ADDWF', WREG, False))
+        if bit == '1':
+            plan.append(('ADDWF', x, False))
+    plans.append(plan)
+    plans.append([('MOVF', x, False), ('MULLW', k), ('MOVF', prodl, False)])
+    return plans
+
+def div_byte_plan(x, d):
+    """ Plan leaving x//d in WREG, x is a register and d a literal from 2
+    to 255 """
+    s = d.bit_length() - 1
+    if d == 1 << s:
+        return shift_byte(x, -s)
+    (m, s) = magic(d, 8)
+    (prodl, prodh) = PROD.regs
+    plan = [('MOVF', x, False), ('MULLW', m & 0xff)]
+    if m < 0x100:
+        return plan + shift_byte(prodh, -s)
+    # x*m = x*(m - 256) + x*256: x is added to PRODH, the carry is the
+    # ninth bit of the sum and comes back with RRCF (s is at least 1)
+    plan += [('ADDWF', prodh, False), ('RRCF', WREG, False)]
+    if s > 1:
+        plan += shift_byte(WREG, 1 - s)
+    return plan
+
+def _copy(t, src):
+    """ Instructions copying a register or a literal into the register t """
+    if not _is_literal(src):
+        if src is t:
+            return []
+        return [('MOVFF', src, t)]
+    if src in (0, 0xff):
+        return [('CLRF' if src == 0 else 'SETF', t)]
+    return [('MOVLW', src), ('MOVWF', t)]
+
+def _add_at(t, p, src):
+    """ Instructions adding the bytes src (registers or literals) to the
+    registers t from t[p], with the carry up to the highest byte """
+    plan = []
+    w = None
+    carry = False
+    for q in range(p, len(t)):
+        x = src[q - p] if q - p < len(src) else 0
+        if not carry and _is_literal(x) and x == 0:
+            continue
+        if w is None or _is_literal(w) != _is_literal(x) or w != x:
+            if _is_literal(x):
+                plan.append(('MOVLW', x))
+            else:
+                plan.append(('MOVF', x, False))
+            w = x
+        plan.append(('ADDWFC' if carry else 'ADDWF', t[q], True))
+        carry = True
+    return plan
+
+def _partial(x, y):
+    """ Instructions computing the product of the bytes x and y and its
+    bytes, the lowest first; None if it is 0 """
+    if _is_literal(x) and not _is_literal(y):
+        (x, y) = (y, x)
+    if _is_literal(y):
+        if y == 0 or (_is_literal(x) and x == 0):
+            return None
+        if _is_literal(x):
+            return ([], [(x*y) & 0xff, (x*y) >> 8])
+        if y == 1:
+            return ([], [x])
+        return ([('MOVF', x, False), ('MULLW', y)], list(PROD.regs))
+    return ([('MOVF', x, False), ('MULWF', y)], list(PROD.regs))
+
+def mul_plan(t, a, b):
+    """ Plan leaving in the registers t the low len(t) bytes of a*b; the
+    registers of a and b are not in t """
+    n = len(t)
+    partials = []
+    for (i, x) in enumerate(a):
+        for (j, y) in enumerate(b):
+            if i + j < n:
+                partial = _partial(x, y)
+                if partial is not None:
+                    partials.append((i + j,) + partial)
+    if not partials:
+        return [('CLRF', x) for x in t]
+    partials.sort(key=lambda partial: partial[0])
+    # the lowest product is copied, the others added
+    (p, plan, src) = partials[0]
+    plan = list(plan)
+    for (q, x) in enumerate(t):
+        if p <= q < p + len(src):
+            plan += _copy(x, src[q - p])
+        else:
+            plan.append(('CLRF', x))
+    for (p, instrs, src) in partials[1:]:
+        plan += instrs
+        plan += _add_at(t, p, src)
+    return plan
+
+def _rotate_through(regs, r, left):
+    """ Instructions shifting the bytes regs (the lowest first) by r bits
+    to the left or to the right """
+    plan = []
+    for k in range(r):
+        plan.append(('BCF', STATUS, STATUS.C.ind))
+        if left:
+            plan += [('RLCF', x, True) for x in regs]
+        else:
+            plan += [('RRCF', x, True) for x in reversed(regs)]
+    return plan
+
+def shift_plan(t, a, s):
+    """ Plan leaving in t the bytes of a shifted left by s bits, right by
+    -s bits if s is negative; a has as many bytes as t and may be t """
+    n = len(t)
+    (q, r) = divmod(abs(s), 8)
+    plan = []
+    if s >= 0:
+        src = [0]*q + list(a)
+        for i in reversed(range(n)):
+            plan += _copy(t[i], src[i])
+        return plan + _rotate_through(t[q:], r, True)
+    src = list(a)[q:] + [0]*n
+    for i in range(n):
+        plan += _copy(t[i], src[i])
+    return plan + _rotate_through(t[:n - q], r, False)
+
+def _horner_plan(t, a, k):
+    """ Plan leaving a*k in t, shifting t and adding a following the bits
+    of k from the highest; the registers of a are not in t """
+    plan = []
+    for (x, y) in zip(t, a):
+        plan += _copy(x, y)
+    for bit in bin(k)[3:]:
+        plan += _rotate_through(t, 1, True)
+        if bit == '1':
+            plan += _add_at(t, 0, a)
+    return plan
+
+def mul_plans(t, a, k):
+    """ Plans leaving in t the low bytes of a*k, k is a literal; the
+    registers of a, which has as many bytes as t, are not in t """
+    n = len(t)
+    k &= (1 << 8*n) - 1
+    plans = [mul_plan(t, a, [(k >> 8*i) & 0xff for i in range(n)])]
+    if k:
+        s = k.bit_length() - 1
+        if k == 1 << s:
+            plans.append(shift_plan(t, a, s))
+        plans.append(_horner_plan(t, a, k))
+    return plans
+
+def div_temps(d, nbytes):
+    """ Number of temporary registers div_plan needs to divide nbytes
+    bytes by d """
+    if d & (d - 1) == 0 or d >> 8*nbytes:
+        return 0
+    (m, s) = magic(d, 8*nbytes)
+    return nbytes + (m.bit_length() + 7)//8
+
+def div_plan(t, a, d, temps):
+    """ Plan leaving in t the quotient a//d, d is a literal above 0 and a
+    has as many bytes as t. temps are div_temps(d, len(t)) registers
+    which are not in a. """
+    n = len(t)
+    s = d.bit_length() - 1
+    if d == 1 << s:
+        return shift_plan(t, a, -s)
+    if d >> 8*n:
+        return [('CLRF', x) for x in t]
+    (m, s) = magic(d, 8*n)
+    m = [(m >> 8*i) & 0xff for i in range(len(temps) - n)]
+    plan = mul_plan(temps, a, m)
+    (q, r) = divmod(8*n + s, 8)
+    high = temps[q:]
+    plan += _rotate_through(high, r, False)
+    for i in range(n):
+        plan += _copy(t[i], high[i] if i < len(high) else 0)
+    return plan
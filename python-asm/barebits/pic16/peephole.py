@@ -0,0 +1,804 @@
+# Copyright 2008 Anton Mellit
+
+""" Peephole optimizer for pic18fxxxx code
+
+The finished output of a CodeMaker is decoded into a list of Items in
+which branches point to Items instead of offsets. Rules look at short
+windows of consecutive instructions and replace them with cheaper
+equivalents, using the liveness of WREG and the STATUS flags to decide
+what may be dropped. At the end the instructions are laid out again, the
+branch offsets recomputed and the side tables of the CodeMaker (comments
+and block reports) brought up to date.
+
+A window is only rewritten if no instruction inside it, other than the
+first one, is a branch target and the window does not follow a skip.
+Registers of the access bank above 0x5f are special function registers
+and are never touched by the rules, nor are the instructions of delays
+(blocks of kind 'delay'), whose cycles must stay exact.
+
+Before the layout, jumps are relaxed: a conditional jump is a short
+conditional branch, a skip on a STATUS bit followed by BRA or by GOTO
+(absolute, to a Label), an unconditional one is BRA or GOTO. Every jump
+starts with its current form and those which do not reach their targets
+are made longer until the positions settle. relax() starts instead from
+the shortest forms, including a single skip for a conditional jump over
+one instruction, which gives the cheapest valid encoding of every jump.
+
+"""
+
+from array import array
+from bisect import bisect_left
+
+from barebits.code import add_cycles, mul_cycles, Label
+from barebits.pic16.instructions import RelativeInstr, LongJumpInstr, \
+        Designator, skips, branch_flags
+from barebits.pic16.disasm import decode_table
+
+# Resources whose liveness is tracked
+C, DC, Z, OV, N, W = 1, 2, 4, 8, 16, 32
+FLAGS = C | DC | Z | OV | N
+ALL = FLAGS | W
+
+_flag_bits = [C, DC, Z, OV, N]
+
+_branch_flags = dict((name, flag) for (name, (flag, value))
+                        in branch_flags.iteritems())
+_converse = {'BZ': 'BNZ', 'BNZ': 'BZ', 'BC': 'BNC', 'BNC': 'BC',
+        'BOV': 'BNOV', 'BNOV': 'BOV', 'BN': 'BNN', 'BNN': 'BN'}
+# Branch taken when a STATUS bit is set, indexed by the bit
+_branch_set = ['BC', None, 'BZ', 'BOV', 'BN']
+_branch_clear = ['BNC', None, 'BNZ', 'BNOV', 'BNN']
+
+_ends = set(['RETURN', 'RETURNFAST', 'RETFIE', 'RETFIEFAST', 'RETLW',
+        'RESET'])
+
+""" Resources (read, written) by the instructions, not counting their
+register operand and the destination of the result """
+_effects = {
+    'NOP': (0, 0), 'CLRWDT': (0, 0), 'MOVLB': (0, 0), 'LFSR': (0, 0),
+    'BRA': (0, 0), 'GOTO': (0, 0), 'DAW': (W | C | DC, W | C),
+    'MOVLW': (0, W), 'ADDLW': (W, W | FLAGS), 'SUBLW': (W, W | FLAGS),
+    'ANDLW': (W, W | Z | N), 'IORLW': (W, W | Z | N),
+    'XORLW': (W, W | Z | N), 'MULLW': (W, 0),
+    'MOVWF': (W, 0), 'CLRF': (0, Z), 'SETF': (0, 0), 'NEGF': (0, FLAGS),
+    'MULWF': (W, 0), 'CPFSEQ': (W, 0), 'CPFSGT': (W, 0),
+    'CPFSLT': (W, 0), 'TSTFSZ': (0, 0),
+    'MOVF': (0, Z | N), 'ADDWF': (W, FLAGS), 'ADDWFC': (W | C, FLAGS),
+    'SUBWF': (W, FLAGS), 'SUBWFB': (W | C, FLAGS),
+    'SUBFWB': (W | C, FLAGS), 'ANDWF': (W, Z | N), 'IORWF': (W, Z | N),
+    'XORWF': (W, Z | N), 'COMF': (0, Z | N), 'INCF': (0, FLAGS),
+    'DECF': (0, FLAGS), 'RRCF': (C, C | Z | N), 'RLCF': (C, C | Z | N),
+    'RRNCF': (0, Z | N), 'RLNCF': (0, Z | N), 'SWAPF': (0, 0),
+    'DECFSZ': (0, 0), 'INCFSZ': (0, 0), 'DCFSNZ': (0, 0),
+    'INFSNZ': (0, 0),
+    'BSF': (0, 0), 'BCF': (0, 0), 'BTG': (0, 0), 'BTFSS': (0, 0),
+    'BTFSC': (0, 0), 'MOVFF': (0, 0),
+}
+for name in _branch_flags:
+    _effects[name] = (_branch_flags[name], 0)
+
+_wreg = 0xe8
+_status = 0xd8
+_plusw = [0xeb, 0xe3, 0xdb]
+
+""" Operations with a destination which may be folded with a following
+MOVWF to the same register """
+_fold = set(['ADDWF', 'ADDWFC', 'ANDWF', 'IORWF', 'XORWF', 'COMF', 'INCF',
+        'DECF', 'RRCF', 'RLCF', 'RRNCF', 'RLNCF', 'SWAPF', 'SUBWF',
+        'SUBWFB', 'SUBFWB'])
+
+
+def _register_effects(address):
+    """ Resources read by an access to a register of the access bank given
+    by its full address; writes are never counted, which is safe """
+    address &= 0xff
+    if address == _wreg or address in _plusw:
+        return W
+    if address == _status:
+        return FLAGS
+    return 0
+
+
+class Item:
+    """ An instruction of the code being optimized.
+
+    name, args -- as given to CodeMaker.do, except that branches have the
+    target Item instead of an offset and registers are Designators
+    pos -- position in the original output of the instruction it comes
+    from
+    comment -- the original comment, None if the instruction changed
+    live -- resources live after the instruction
+    frozen -- True for the instructions of delays (see control.delay_cycles),
+    which the rules leave alone
+
+    """
+    def __init__(self, name, args, pos, comment=None):
+        self.name = name
+        self.args = args
+        self.pos = pos
+        self.comment = comment
+        self.live = ALL
+        self.frozen = False
+
+    def reads_writes(self):
+        """ Returns the resources (read, written) by the instruction """
+        name = self.name
+        effects = _effects.get(name)
+        if effects is None:
+            return (ALL, 0)
+        (reads, writes) = effects
+        args = self.args
+        if name == 'MOVFF':
+            return (_register_effects(args[0]) if args[0] >= 0xf00 else 0,
+                    0)
+        if not args or not hasattr(args[0], 'use_bsr'):
+            return (reads, writes)
+        f = args[0]
+        if len(args) == 2 and args[1] is False:
+            writes |= W
+        if f.use_bsr or f.address < 0x60:
+            return (reads, writes)
+        if f.address == _status and name in ('BSF', 'BCF'):
+            return (reads, writes | _flag_bits[args[1]])
+        if f.address == _status and name in ('BTFSS', 'BTFSC'):
+            return (reads | _flag_bits[args[1]], writes)
+        return (reads | _register_effects(f.address), writes)
+
+
+class Savings:
+    """ What the peephole pass saved.
+
+    words -- number of words removed from the output
+    cycles -- pair (min, max) of instruction cycles saved in the execution
+    of the whole program, as estimated from the block reports; max is None
+    if the savings in a loop without a known trip count are not bounded
+    rules -- dictionary rule name -> number of times it was applied
+
+    """
+    def __init__(self):
+        self.words = 0
+        self.cycles = (0, 0)
+        self.rules = {}
+
+    def __repr__(self):
+        return '<Savings: %d bytes, %s cycles>' % (2*self.words,
+                '%d-%s' % (self.cycles[0], '?' if self.cycles[1] is None
+                    else self.cycles[1]))
+
+
+# Rules. Each rule gets the list of Items, the position i where the window
+# starts and a Pass, it returns None or (k, name, args, cycles) meaning
+# that items[i:i+k] is replaced by one instruction (or nothing if name is
+# None) which saves cycles per execution of the window (None to compute
+# it from the instruction timings).
+
+def _is_file(f):
+    """ True if f is a general purpose register """
+    return hasattr(f, 'use_bsr') and (f.use_bsr or f.address < 0x60)
+
+def _same(f, g):
+    return (_is_file(f) and _is_file(g) and f.address == g.address and
+            f.use_bsr == g.use_bsr)
+
+def _load(item):
+    """ Returns the register of MOVF f, W or None """
+    if item.name == 'MOVF' and item.args[1] is False:
+        return item.args[0]
+    return None
+
+def _store(item):
+    """ Returns the register of MOVWF f or None """
+    if item.name == 'MOVWF':
+        return item.args[0]
+    return None
+
+def store_load(items, i, state):
+    """ MOVWF f; MOVF f, W -> MOVWF f, if Z and N are dead """
+    (a, b) = items[i:i+2]
+    f = _store(a)
+    if f is not None and _same(f, _load(b)) and not b.live & (Z | N):
+        return (2, 'MOVWF', [f], None)
+
+def load_store(items, i, state):
+    """ MOVF f, W; MOVWF f -> MOVF f, W """
+    (a, b) = items[i:i+2]
+    f = _load(a)
+    if f is not None and _same(f, _store(b)):
+        return (2, 'MOVF', [f, False], None)
+
+def load_load(items, i, state):
+    """ MOVF f, W; MOVF f, W -> MOVF f, W """
+    (a, b) = items[i:i+2]
+    f = _load(a)
+    if f is not None and _same(f, _load(b)):
+        return (2, 'MOVF', [f, False], None)
+
+def store_store(items, i, state):
+    """ MOVWF f; MOVWF f -> MOVWF f """
+    (a, b) = items[i:i+2]
+    f = _store(a)
+    if f is not None and _same(f, _store(b)):
+        return (2, 'MOVWF', [f], None)
+
+def clear_set(items, i, state):
+    """ MOVLW 0; MOVWF f -> CLRF f, if WREG and Z are dead;
+    MOVLW 0xff; MOVWF f -> SETF f, if WREG is dead """
+    (a, b) = items[i:i+2]
+    f = _store(b)
+    if a.name != 'MOVLW' or not _is_file(f) or b.live & W:
+        return None
+    if a.args[0] & 0xff == 0 and not b.live & Z:
+        return (2, 'CLRF', [f], None)
+    if a.args[0] & 0xff == 0xff:
+        return (2, 'SETF', [f], None)
+
+def increment(items, i, state):
+    """ MOVF f, W; ADDLW 1 -> INCF f, W and MOVF f, W; ADDLW 0xff ->
+    DECF f, W (the flags are the same) """
+    (a, b) = items[i:i+2]
+    f = _load(a)
+    if not _is_file(f) or b.name != 'ADDLW':
+        return None
+    if b.args[0] & 0xff == 1:
+        return (2, 'INCF', [f, False], None)
+    if b.args[0] & 0xff == 0xff:
+        return (2, 'DECF', [f, False], None)
+
+def fold_store(items, i, state):
+    """ OP f, W; MOVWF f -> OP f, F, if WREG is dead """
+    (a, b) = items[i:i+2]
+    if a.name not in _fold or a.args[1] is not False:
+        return None
+    f = a.args[0]
+    if _same(f, _store(b)) and not b.live & W:
+        return (2, a.name, [f, True], None)
+
+def branch_next(items, i, state):
+    """ BRA to the next instruction is removed """
+    a = items[i]
+    if a.name == 'BRA' and a.args[0] is items[i+1]:
+        return (1, None, None, None)
+
+def branch_chain(items, i, state):
+    """ A branch to BRA goes directly to the target of BRA """
+    a = items[i]
+    if a.name != 'BRA' and a.name not in _branch_flags:
+        return None
+    b = a.args[0]
+    if b.name != 'BRA' or b is a or b.args[0] is b or b.frozen:
+        return None
+    if not state.in_range(a, b.args[0]):
+        return None
+    if a.name == 'BRA':
+        return (1, 'BRA', [b.args[0]], (2, 2))
+    # saves 2 cycles when the branch is taken, which the reports can't
+    # tell apart from the straight execution
+    return (1, a.name, [b.args[0]], (0, 0))
+
+def branch_over(items, i, state):
+    """ Bcc L1; BRA L2; L1: -> B!cc L2 and a skip on a STATUS bit
+    followed by BRA L -> a conditional branch to L """
+    (a, b) = items[i:i+2]
+    if b.name != 'BRA' or not state.in_range(a, b.args[0]):
+        return None
+    if a.name in _branch_flags and a.args[0] is items[i+2]:
+        return (2, _converse[a.name], [b.args[0]], (1, 1))
+    if a.name not in ('BTFSS', 'BTFSC'):
+        return None
+    (f, bit) = a.args
+    if f.use_bsr or f.address != _status or bit >= 5 or bit == 1:
+        return None
+    if a.name == 'BTFSS':
+        name = _branch_clear[bit]
+    else:
+        name = _branch_set[bit]
+    return (2, name, [b.args[0]], (1, 1))
+
+""" All the rules with the size of their windows """
+RULES = [
+    ('store_load', 2, store_load),
+    ('load_store', 2, load_store),
+    ('load_load', 2, load_load),
+    ('store_store', 2, store_store),
+    ('clear_set', 2, clear_set),
+    ('increment', 2, increment),
+    ('fold_store', 2, fold_store),
+    ('branch_next', 1, branch_next),
+    ('branch_chain', 1, branch_chain),
+    ('branch_over', 2, branch_over),
+]
+
+
+# Forms of jumps: (words, cycles when the jump is not taken)
+_forms = {'short': (1, 1), 'skip': (1, 1), 'skip_bra': (2, 2),
+        'skip_goto': (3, 3), 'bra': (1, 2), 'goto': (2, 2)}
+_longer = {'short': 'skip_bra', 'skip_bra': 'skip_goto', 'bra': 'goto'}
+
+def _status_skip(item):
+    """ Returns the branch taken when the instruction after item runs,
+    if item is a skip on a STATUS bit, otherwise None """
+    if item.name not in ('BTFSS', 'BTFSC'):
+        return None
+    (f, bit) = item.args
+    if f.use_bsr or f.address != _status or bit >= 5 or bit == 1:
+        return None
+    if item.name == 'BTFSS':
+        return _branch_clear[bit]
+    return _branch_set[bit]
+
+def _skip_on(cond):
+    """ Returns the skip over the next instruction when the branch cond
+    would be taken """
+    if cond in _branch_set:
+        return ('BTFSS', _branch_set.index(cond))
+    return ('BTFSC', _branch_clear.index(cond))
+
+
+class _Jump:
+    """ A jump of the code being relaxed.
+
+    items -- its instructions
+    skipped -- True if it follows a skip, so it must stay one instruction
+    cond -- the branch taken when the jump is, None if it always is
+    target -- the Item it jumps to
+    old, form -- its form in the code and the one chosen (see _forms)
+
+    """
+    def __init__(self, items, skipped):
+        self.items = items
+        self.skipped = skipped
+        last = items[-1]
+        self.target = last.args[0]
+        if len(items) == 2:
+            self.cond = _status_skip(items[0])
+            self.old = 'skip_bra' if last.name == 'BRA' else 'skip_goto'
+        elif last.name in _branch_flags:
+            self.cond = last.name
+            self.old = 'short'
+        else:
+            self.cond = None
+            self.old = last.name.lower()
+        self.form = self.old
+
+    def reaches(self):
+        form = self.form
+        if form in ('skip', 'skip_goto', 'goto'):
+            return True
+        offset = self.target.at - self.items[0].at - 1
+        if form == 'short':
+            return -0x80 <= offset < 0x80
+        if form == 'skip_bra':
+            offset -= 1
+        return -0x400 <= offset < 0x400
+
+    def instructions(self):
+        """ Returns the list of (name, args) of the chosen form """
+        form = self.form
+        target = self.target
+        if form == 'short':
+            return [(self.cond, [target])]
+        if form in ('bra', 'goto'):
+            return [(form.upper(), [target])]
+        status = Designator(_status, False)
+        if form == 'skip':
+            (name, bit) = _skip_on(self.cond)
+            return [(name, [status, bit])]
+        (name, bit) = _skip_on(_converse[self.cond])
+        return [(name, [status, bit]),
+                ('BRA' if form == 'skip_bra' else 'GOTO', [target])]
+
+
+class Pass:
+    """ State of the peephole pass over the code of a CodeMaker """
+
+    def __init__(self, code, rules=None):
+        self.code = code
+        self.instructions = code.instructions
+        self.rules = [r for r in RULES if rules is None or r[0] in rules]
+        self.savings = Savings()
+        self.saved = []     # (pos, cycles) for the block reports
+
+    def decode(self):
+        """ Decodes the output into self.items, the last Item (with name
+        None) stands for the end of the code. Returns False if the code
+        contains data, absolute jumps other than GOTO to a Label or
+        unresolved fixups. """
+        code = self.code
+        for fixup in code.fixups.itervalues():
+            if fixup[0] != 'GOTO' or not isinstance(fixup[1], Label):
+                return False
+        table = decode_table(self.instructions)
+        comments = code.comments or {}
+        words = code.output
+        items = []
+        at = {}
+        pos = 0
+        while pos < len(words):
+            (instr, args, length) = table.decode(words, pos)
+            if instr is None or instr.name not in self.instructions:
+                return False
+            if isinstance(instr, LongJumpInstr):
+                if pos not in code.fixups:
+                    return False
+                args = code.fixups[pos][1:]
+            item = Item(instr.name, list(args), pos, comments.get(pos))
+            at[pos] = item
+            items.append(item)
+            pos += length
+        at[pos] = Item(None, [], pos)
+        items.append(at[pos])
+        for item in items:
+            if isinstance(self.instructions.get(item.name), RelativeInstr):
+                target = at.get(item.pos + 1 + item.args[0])
+            elif item.name == 'GOTO':
+                target = at.get(item.args[0].pos)
+            else:
+                continue
+            if target is None:
+                return False
+            item.args = [target]
+        for (start, end) in _delays(code.blocks, 0):
+            for item in items:
+                if start <= item.pos < end:
+                    item.frozen = True
+        self.items = items
+        return True
+
+    def _length(self, item):
+        return self.instructions[item.name].length//2
+
+    def number(self):
+        """ Computes the positions and numbers of the items and the set
+        of branch targets """
+        items = self.items
+        at = 0
+        for (i, item) in enumerate(items):
+            item.index = i
+            item.at = at
+            if item.name is not None:
+                at += self._length(item)
+        self.targets = set(id(item.args[0]) for item in items
+                            if item.args and isinstance(item.args[0], Item))
+
+    def successors(self):
+        """ Returns for every item but the last the numbers of the items
+        which may follow it, number must be called before """
+        items = self.items
+        end = len(items) - 1
+        succs = []
+        for (i, item) in enumerate(items[:-1]):
+            name = item.name
+            if name in _ends:
+                succs.append(())
+            elif name in ('BRA', 'GOTO'):
+                succs.append((item.args[0].index,))
+            elif name in _branch_flags:
+                succs.append((i+1, item.args[0].index))
+            elif name in skips:
+                succs.append((i+1, min(i+2, end)))
+            else:
+                succs.append((i+1,))
+        return succs
+
+    def analyze(self):
+        """ Computes positions, branch targets and liveness """
+        self.number()
+        items = self.items
+        end = len(items) - 1
+        succs = self.successors()
+        effects = [item.reads_writes() for item in items[:-1]]
+        live_in = [0]*end + [ALL]
+        changed = True
+        while changed:
+            changed = False
+            for i in xrange(end-1, -1, -1):
+                out = 0
+                for s in succs[i]:
+                    out |= live_in[s]
+                items[i].live = out
+                (reads, writes) = effects[i]
+                new = reads | (out & ~writes)
+                if new != live_in[i]:
+                    live_in[i] = new
+                    changed = True
+
+    def in_range(self, branch, target):
+        """ True if branch can reach target, positions only get closer as
+        the pass goes on """
+        offset = target.at - branch.at - 1
+        if branch.name == 'GOTO':
+            return True
+        if branch.name == 'BRA':
+            return -0x400 <= offset < 0x400
+        return -0x80 <= offset < 0x80
+
+    def _window(self, i, k):
+        """ True if items[i:i+k] may be rewritten """
+        items = self.items
+        if i + k >= len(items):
+            return False
+        if i > 0 and items[i-1].name in skips:
+            return False
+        for item in items[i+1:i+k]:
+            if id(item) in self.targets:
+                return False
+        for item in items[i:i+k]:
+            if item.frozen:
+                return False
+        return True
+
+    def _cycles(self, items):
+        return sum(self.instructions[item.name].cycles[0] for item in items)
+
+    def _apply(self, i, k, name, args, cycles, rule):
+        items = self.items
+        old = items[i:i+k]
+        first = old[0]
+        if name is None:
+            following = items[i+k]
+            for item in items:
+                if item.args and item.args[0] is first:
+                    item.args[0] = following
+            self.targets.add(id(following))
+            if cycles is None:
+                cycles = self._cycles(old)
+                cycles = (cycles, cycles)
+            del items[i:i+k]
+        else:
+            if cycles is None:
+                cycles = self._cycles(old) - self.instructions[name].cycles[0]
+                cycles = (cycles, cycles)
+            first.live = old[-1].live
+            first.name = name
+            first.args = args
+            first.comment = None
+            del items[i+1:i+k]
+        words = sum(self._length(item) for item in old)
+        if name is not None:
+            words -= self._length(first)
+        self.savings.words += words
+        self.savings.rules[rule] = self.savings.rules.get(rule, 0) + 1
+        self.saved.append((first.pos, cycles))
+
+    def sweep(self):
+        """ Applies the rules once along the code, returns True if
+        something changed """
+        self.analyze()
+        items = self.items
+        changed = False
+        i = 0
+        while i < len(items) - 1:
+            for (rule, k, f) in self.rules:
+                if not self._window(i, k):
+                    continue
+                res = f(items, i, self)
+                if res is not None:
+                    self._apply(i, *(res + (rule,)))
+                    changed = True
+                    i = max(i-2, -1)
+                    break
+            i += 1
+        return changed
+
+    def _jumps(self, shrink):
+        """ Finds the jumps among the items, with their shortest forms if
+        shrink is set, number must be called before """
+        items = self.items
+        jumps = []
+        i = 0
+        while i < len(items) - 1:
+            a = items[i]
+            b = items[i+1]
+            skipped = i > 0 and items[i-1].name in skips
+            if a.name in _branch_flags or a.name in ('BRA', 'GOTO'):
+                jumps.append(_Jump([a], skipped))
+            elif (not skipped and _status_skip(a) and
+                    b.name in ('BRA', 'GOTO') and id(b) not in self.targets):
+                jumps.append(_Jump([a, b], False))
+                i += 1
+            i += 1
+        members = set(id(x) for j in jumps for x in j.items)
+        for j in jumps:
+            if not shrink:
+                continue
+            if j.cond is None:
+                j.form = 'bra'
+                continue
+            j.form = 'short'
+            k = j.items[0].index
+            if j.skipped or k + 2 >= len(items) or j.target is not items[k+2]:
+                continue
+            b = items[k+1]
+            if b.name is not None and id(b) not in members:
+                j.form = 'skip'
+        return jumps
+
+    def relax(self, shrink=False):
+        """ Makes the jumps which do not reach their targets longer until
+        they all do, starting from the shortest forms if shrink is set.
+        number must be called before. """
+        jumps = self._jumps(shrink)
+        if not jumps:
+            return
+        first = dict((id(j.items[0]), j) for j in jumps)
+        others = set(id(x) for j in jumps for x in j.items[1:])
+        changed = True
+        while changed:
+            at = 0
+            for item in self.items:
+                if id(item) in others:
+                    continue
+                item.at = at
+                j = first.get(id(item))
+                if j is not None:
+                    at += _forms[j.form][0]
+                elif item.name is not None:
+                    at += self._length(item)
+            changed = False
+            for j in jumps:
+                if j.reaches():
+                    continue
+                if j.form not in _longer or (j.skipped and j.cond):
+                    raise ValueError('%s at %d can not reach %d' % (
+                            j.items[0].name, j.items[0].pos, j.target.pos))
+                j.form = _longer[j.form]
+                changed = True
+        res = []
+        for item in self.items:
+            if id(item) in others:
+                continue
+            res.append(item)
+            j = first.get(id(item))
+            if j is None:
+                continue
+            if j.form == j.old:
+                res += j.items[1:]
+                continue
+            instrs = j.instructions()
+            (item.name, item.args) = instrs[0]
+            item.comment = None
+            for (name, args) in instrs[1:]:
+                res.append(Item(name, args, item.pos))
+            (words, cycles) = _forms[j.old]
+            words -= _forms[j.form][0]
+            cycles -= _forms[j.form][1]
+            self.savings.words += words
+            self.savings.rules[j.form] = self.savings.rules.get(j.form, 0) + 1
+            self.saved.append((item.pos, (cycles, cycles)))
+        self.items = res
+        self.number()
+
+    def layout(self):
+        """ Writes the items back to the CodeMaker """
+        code = self.code
+        self.number()
+        self.relax()
+        items = self.items
+        at = 0
+        for item in items:
+            item.at = at
+            if item.name is not None:
+                at += self._length(item)
+        output = array('H')
+        comments = {}
+        code.fixups = {}
+        code.labels = []
+        for item in items[:-1]:
+            args = item.args
+            comment = item.comment
+            encoded = None
+            if item.name == 'GOTO':
+                args = [code.label(args[0].at)]
+                code.fixups[item.at] = ['GOTO'] + args
+                encoded = [0]   # until the code is linked
+                comment = None
+            elif args and isinstance(args[0], Item):
+                target = args[0]
+                if not self.in_range(item, target):
+                    raise ValueError('%s at %d can not reach %d' % (
+                                    item.name, item.at, target.at))
+                args = [target.at - item.at - 1]
+                comment = None
+            if comment is None:
+                comment = [item.name] + args
+            comments[item.at] = comment
+            output.extend(self.instructions[item.name].encode(
+                                                *(encoded or args)))
+        code.output = output
+        if code.comments is not None:
+            code.comments = comments
+        self._update_reports()
+
+    def _update_reports(self):
+        """ Moves the block reports to the new positions and takes the
+        saved cycles off their execution times """
+        code = self.code
+        positions = [item.pos for item in self.items]
+        ats = [item.at for item in self.items]
+        def new_position(pos):
+            return ats[bisect_left(positions, pos)]
+        total = (0, 0)
+        for (pos, cycles) in self.saved:
+            total = add_cycles(total, _take_cycles(code.blocks, 0, pos,
+                                                    cycles))
+        code.cycles = _sub_cycles(code.cycles, total)
+        self.savings.cycles = total
+        _move_blocks(code.blocks, 0, 0, new_position)
+
+    def run(self):
+        if not self.decode():
+            return self.savings
+        while self.sweep():
+            pass
+        self.layout()
+        return self.savings
+
+
+def _delays(blocks, address):
+    """ Yields the ranges (start, end) of positions of the delay blocks
+    (blocks are relative to address) """
+    for block in blocks:
+        start = address + block.offset
+        if block.kind == 'delay':
+            yield (start, start + block.words)
+        else:
+            for r in _delays(block.children, start):
+                yield r
+
+def _sub_cycles(a, b):
+    if a[1] is None or b[1] is None:
+        return (a[0]-b[0], a[1])
+    return (a[0]-b[0], a[1]-b[1])
+
+def _take_cycles(blocks, address, pos, cycles):
+    """ Takes cycles saved at position pos off the block containing it
+    (blocks are relative to address), returns the cycles saved in one
+    execution of the enclosing code """
+    for block in blocks:
+        start = address + block.offset
+        if not start <= pos < start + block.words:
+            continue
+        cycles = _take_cycles(block.children, start, pos, cycles)
+        if block.iteration is not None:
+            block.iteration = _sub_cycles(block.iteration, cycles)
+            in_test = pos - start < block.body
+            if block.iterations is None:
+                cycles = (cycles[0] if in_test else 0, None)
+            else:
+                cycles = mul_cycles(cycles, block.iterations + in_test)
+        block.cycles = _sub_cycles(block.cycles, cycles)
+        break
+    return cycles
+
+def _move_blocks(blocks, address, new_address, new_position):
+    for block in blocks:
+        start = address + block.offset
+        new_start = new_position(start)
+        _move_blocks(block.children, start, new_start, new_position)
+        if block.body is not None:
+            block.body = new_position(start + block.body) - new_start
+        block.words = new_position(start + block.words) - new_start
+        block.offset = new_start - new_address
+
+
+def relax(code):
+    """ Gives every jump in the output of a CodeMaker its cheapest form,
+    returns Savings with the number of jumps changed to each form as the
+    rules. Code which can not be decoded is left unchanged. """
+    state = Pass(code, [])
+    if state.decode():
+        state.number()
+        state.relax(True)
+        state.layout()
+    return state.savings
+
+def optimize(code, rules=None):
+    """ Runs the peephole optimizer over the output of a CodeMaker.
+
+    rules -- names of the rules to use (see RULES), all by default
+
+    Returns Savings. Code which contains data, absolute jumps other than
+    GOTO to a Label or unresolved fixups is left unchanged.
+
+    """
+    return Pass(code, rules).run()
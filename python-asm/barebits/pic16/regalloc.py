@@ -0,0 +1,323 @@
+# Copyright 2008 Anton Mellit
+
+""" Register allocation by liveness
+
+With LivenessAllocator, variables and temporaries get VirtualRegisters
+instead of addresses. When the program is finished, assign computes the
+instructions where every virtual register is live and gives the same
+address to registers whose live ranges do not overlap.
+
+A live range runs from the first to the last instruction (in the order of
+the code) where the register is live or written, so the ranges form an
+interval graph which is colored optimally by a linear scan. The bytes
+found this way are taken from a list of addresses, or placed anywhere in
+RAM by banks.place.
+
+"""
+
+import heapq
+
+from barebits import events
+from barebits.context import State
+from barebits.code import Fixup
+from barebits.pic16.instructions import Designator, RelativeInstr, skips
+from barebits.pic16.disasm import decode_table
+from barebits.pic16.peephole import _ends
+from barebits.pic16 import banks
+
+
+class VirtualRegister(Designator, Fixup):
+    """ Register whose address is given by assign(). Until then it is
+    encoded as address 0 in BSR mode. group is the list of the registers
+    of a variable of several bytes it belongs to (see
+    LivenessAllocator.alloc_long), None for a single byte. """
+
+    group = None
+
+    def __init__(self, number):
+        Designator.__init__(self, 0, True)
+        self.number = number
+        self.bank = 0
+
+    def __repr__(self):
+        if self.resolved:
+            return 'v%d=%s' % (self.number, Designator.__repr__(self))
+        return 'v%d' % self.number
+
+
+class LivenessAllocator(State):
+    """ Allocator which hands out VirtualRegisters
+
+    available -- the list of addresses (Designators) assign may use
+    banked -- if set, available is not used: assign places the registers
+    anywhere in RAM and adds the MOVLB instructions (see banks)
+    registers -- all the VirtualRegisters handed out
+    ram, access -- the bytes of RAM and the bytes of it in the access bank
+    used by banked allocation
+
+    """
+    def __init__(self, available, banked=False, registers=None,
+                    ram=banks.RAM, access=banks.ACCESS):
+        self.available = available
+        self.banked = banked
+        if registers is None:
+            registers = []
+        self.registers = registers
+        self.ram = ram
+        self.access = access
+
+    def alloc(self):
+        reg = VirtualRegister(len(self.registers))
+        self.registers.append(reg)
+        if events.alloc.fire is not None:
+            events.alloc.fire(self, reg)
+        return reg
+
+    def alloc_long(self, nbytes):
+        """ Hands out nbytes VirtualRegisters which assign places at
+        consecutive addresses, the first one lowest """
+        regs = [self.alloc() for i in range(nbytes)]
+        for reg in regs:
+            reg.group = regs
+        return regs
+
+    def free(self, address):
+        """ Nothing to do, the live range ends with the last use """
+        assert isinstance(address, VirtualRegister)
+        if events.free.fire is not None:
+            events.free.fire(self, address)
+
+    def child(self):
+        return LivenessAllocator(self.available, self.banked,
+                                    self.registers, self.ram, self.access)
+
+
+class Allocation:
+    """ Result of assign.
+
+    registers -- number of virtual registers used by the code
+    peak -- the largest number of them live at once, i.e. the bytes of
+    RAM used
+    ranges -- dictionary VirtualRegister -> (first, last) instruction
+    index of its live range
+    movlb -- number of MOVLB instructions added for banked registers
+    movlb_cycles -- pair (min, max) of cycles they add to the execution
+    of the program
+
+    """
+    def __init__(self, registers, peak, ranges):
+        self.registers = registers
+        self.peak = peak
+        self.ranges = ranges
+        self.movlb = 0
+        self.movlb_cycles = (0, 0)
+
+    def __repr__(self):
+        return '<Allocation: %d registers in %d bytes>' % (self.registers,
+                                                            self.peak)
+
+
+def _flow(code):
+    """ Decodes the output, returns (index, successors): index maps the
+    positions of instructions to their numbers, successors lists for every
+    instruction the numbers of the instructions which may follow it (the
+    number of instructions stands for the end of the code) """
+    table = decode_table(code.instructions)
+    words = code.output
+    index = {}
+    decoded = []
+    pos = 0
+    while pos < len(words):
+        (instr, args, length) = table.decode(words, pos)
+        index[pos] = len(decoded)
+        decoded.append((pos, instr, args))
+        pos += length
+    end = len(decoded)
+    index[pos] = end
+    successors = []
+    for (i, (pos, instr, args)) in enumerate(decoded):
+        name = instr and instr.name
+        if name in _ends:
+            successors.append(())
+        elif isinstance(instr, RelativeInstr) and name != 'RCALL':
+            target = index.get(pos + 1 + args[0], end)
+            if name == 'BRA':
+                successors.append((target,))
+            else:
+                successors.append((i+1, target))
+        elif name == 'GOTO' and pos in code.fixups:
+            label = code.fixups[pos][1]
+            successors.append((index.get(label.pos, end),))
+        elif name in skips:
+            successors.append((i+1, min(i+2, end)))
+        else:
+            successors.append((i+1,))
+    return (index, successors)
+
+""" Instructions which overwrite their register without reading it """
+_kills = set(['MOVWF', 'CLRF', 'SETF'])
+
+def _bits(x):
+    """ Numbers of the bits set in x """
+    while x:
+        low = x & -x
+        yield low.bit_length() - 1
+        x ^= low
+
+def live_ranges(code, flow=None):
+    """ Returns a dictionary VirtualRegister -> (first, last) numbers of
+    the instructions of its live range, flow is the result of _flow if it
+    is known """
+    if flow is None:
+        flow = _flow(code)
+    (index, successors) = flow
+    n = len(successors)
+    uses = [0]*n
+    kills = [0]*n
+    registers = {}
+    numbers = []
+    for (pos, fixup) in code.fixups.iteritems():
+        i = index[pos]
+        name = fixup[0]
+        for (k, arg) in enumerate(fixup[1:]):
+            if not isinstance(arg, VirtualRegister):
+                continue
+            bit = registers.get(arg)
+            if bit is None:
+                bit = registers[arg] = 1<<len(numbers)
+                numbers.append(arg)
+            if name in _kills or (name == 'MOVFF' and k == 1):
+                kills[i] |= bit
+            else:
+                uses[i] |= bit
+    live = [0]*(n+1)
+    changed = True
+    while changed:
+        changed = False
+        for i in xrange(n-1, -1, -1):
+            out = 0
+            for s in successors[i]:
+                out |= live[s]
+            new = uses[i] | (out & ~kills[i])
+            if new != live[i]:
+                live[i] = new
+                changed = True
+    first = {}
+    seen = 0
+    for i in xrange(n):
+        new = (live[i] | kills[i]) & ~seen
+        if new:
+            seen |= new
+            for b in _bits(new):
+                first[b] = i
+    ranges = {}
+    seen = 0
+    for i in xrange(n-1, -1, -1):
+        new = (live[i] | kills[i]) & ~seen
+        if new:
+            seen |= new
+            for b in _bits(new):
+                ranges[numbers[b]] = (first[b], i)
+    return ranges
+
+def _run(free, n):
+    """ Removes n consecutive numbers from the heap free and returns them,
+    None if there are none """
+    numbers = sorted(free)
+    for i in range(len(numbers) - n + 1):
+        if numbers[i+n-1] - numbers[i] == n - 1:
+            run = numbers[i:i+n]
+            free[:] = numbers[:i] + numbers[i+n:]
+            return run
+    return None
+
+def _color(ranges):
+    """ Numbers the bytes so that registers with overlapping live ranges
+    get different bytes, returns (dictionary VirtualRegister -> byte
+    number, number of bytes). The registers of a group get consecutive
+    numbers for the union of their live ranges. """
+    free = []
+    active = []
+    colors = {}
+    ncolors = 0
+    for (reg, (first, last)) in sorted(ranges.iteritems(),
+                                        key=lambda x: x[1]):
+        if reg in colors:
+            continue
+        while active and active[0][0] < first:
+            heapq.heappush(free, heapq.heappop(active)[1])
+        group = reg.group
+        if group is None:
+            if free:
+                k = heapq.heappop(free)
+            else:
+                k = ncolors
+                ncolors += 1
+            heapq.heappush(active, (last, k))
+            colors[reg] = k
+            continue
+        last = max(ranges[x][1] for x in group if x in ranges)
+        run = _run(free, len(group))
+        if run is None:
+            run = range(ncolors, ncolors + len(group))
+            ncolors += len(group)
+        for (x, k) in zip(group, run):
+            heapq.heappush(active, (last, k))
+            colors[x] = k
+    return (colors, ncolors)
+
+def assign(code, allocator):
+    """ Gives addresses to the virtual registers used in the output of
+    code and encodes their instructions again. Returns an Allocation. """
+    flow = _flow(code)
+    ranges = live_ranges(code, flow)
+    (colors, ncolors) = _color(ranges)
+    groups = []
+    for reg in colors:
+        if reg.group is not None and reg is reg.group[0]:
+            groups.append(reg.group)
+    if allocator.banked:
+        accesses = sorted((pos, arg) for (pos, fixup) in
+                    code.fixups.iteritems() for arg in fixup[1:]
+                    if isinstance(arg, VirtualRegister))
+        addresses = banks.place(flow, accesses, colors, ncolors,
+                        allocator.ram, allocator.access,
+                        [[colors[x] for x in group] for group in groups])
+        places = [(address & 0xff, address >= allocator.access,
+                    address >> 8) for address in addresses]
+    else:
+        available = allocator.available
+        if ncolors > len(available):
+            raise ValueError('%d registers are live at once, %d available'
+                    % (ncolors, len(available)))
+        places = [(available[-1-k].address, available[-1-k].use_bsr, 0)
+                    for k in range(ncolors)]
+    for (reg, k) in colors.iteritems():
+        (reg.address, reg.use_bsr, reg.bank) = places[k]
+        reg.resolved = True
+    for group in groups:
+        # the bytes of a variable go up from its first register
+        run = sorted((places[colors[x]] for x in group),
+                        key=lambda (a, use_bsr, bank): bank<<8 | a)
+        full = [bank<<8 | a for (a, use_bsr, bank) in run]
+        if full != range(full[0], full[0] + len(full)):
+            raise ValueError('no %d consecutive bytes for a variable' %
+                                len(group))
+        for (x, place) in zip(group, run):
+            (x.address, x.use_bsr, x.bank) = place
+    code.encode_fixups(labels=False)
+    needs = {}
+    for (pos, fixup) in code.fixups.iteritems():
+        if fixup[0] == 'MOVFF':
+            continue    # full addresses, BSR is not used
+        for arg in fixup[1:]:
+            if isinstance(arg, VirtualRegister) and arg.use_bsr:
+                needs[pos] = arg.bank
+    code.drop_resolved()
+    allocation = Allocation(len(ranges), ncolors, ranges)
+    if allocator.banked:
+        savings = banks.BankPass(code, needs).run()
+        allocation.movlb = -savings.words
+        allocation.movlb_cycles = (-savings.cycles[0], None if
+                savings.cycles[1] is None else -savings.cycles[1])
+    return allocation
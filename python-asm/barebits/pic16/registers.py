@@ -24,13 +24,30 @@ class LongRegister(SpecialRegister):
     nbytes -- number of bytes
     regs -- single-byte registers
 
+    The parts of registers (regs, and bits or fields of the subclasses)
+    are created by _parts when one of them is first used, so that
+    importing the module costs little.
+
     """
     def __init__(self, name, address, nbits):
         SpecialRegister.__init__(self, name, address, nbits)
         self.nbytes = (nbits - 1) // 8 + 1
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._part_names():
+            raise AttributeError(name)
+        self._parts()
+        return self.__dict__[name]
+
+    def _part_names(self):
+        return ('regs',)
+
+    def _parts(self):
+        nbits = self.nbits
         self.regs = []
         for i in range(self.nbytes):
-            self.regs.append(SpecialRegister(name + str(i), address + i,
+            self.regs.append(SpecialRegister(self.name + str(i), 
+                            0xf00 | self.address + i,
                             8 if i < self.nbytes-1 else nbits%8))
 
 
@@ -57,8 +74,14 @@ class BitRegister(LongRegister):
     def __init__(self, name, address, mask):
         LongRegister.__init__(self, name, address, len(mask))
         self.mask = bits_to_bin(mask)
-        self.bits = [None] * len(mask)
-        for i in range(len(mask)):
+
+    def _part_names(self):
+        return ('regs', 'bits')
+
+    def _parts(self):
+        LongRegister._parts(self)
+        self.bits = [None] * self.nbits
+        for i in range(self.nbits):
             if (self.mask&(1<<i)) != 0:
                 self.bits[i] = Bit(self.regs[i//8], i%8)
 
@@ -91,16 +114,25 @@ class FieldRegister(LongRegister):
 
     """
     def __init__(self, name, address, fields):
-        self.fields = {}
+        fields = list(fields)
+        self._fields = fields
         nbits = 0
         for f in fields:
             nbits += f[1]
         LongRegister.__init__(self, name, address, nbits)
+
+    def _part_names(self):
+        return ['regs', 'fields'] + [f[0] for f in self._fields if f[0]]
+
+    def _parts(self):
+        LongRegister._parts(self)
+        self.fields = {}
         pos = 0
-        for f in fields:
+        for f in self._fields:
             if f[0]:
-                setattr(self, f[0], Field(self.regs[pos//8], f[0],
-                                    pos, pos + f[1]))
+                self.fields[f[0]] = Field(self.regs[pos//8], f[0],
+                                    pos, pos + f[1])
+                setattr(self, f[0], self.fields[f[0]])
             pos += f[1]
         
 
@@ -209,3 +241,50 @@ T0CON = FieldRegister('T0CON', 0xfd5, [('T0PS', 3), ('PSA', 1),
 OSCCON = FieldRegister('OSCCON', 0xfd3, [('SCS', 2), ('IOFS', 1),
                     ('OSTS', 1), ('IRCF', 3), ('IDLEN', 1)])
 
+
+_by_address = None
+
+def _index(namespace=None):
+    """ Builds the dictionaries full address -> single-byte register and
+    (full address, bit index) -> name of a single-bit field from the
+    registers in namespace (a dictionary, the globals of the module by
+    default) """
+    regs = {}
+    bits = {}
+    def add(obj):
+        if isinstance(obj, LongRegister) and obj.nbytes > 1:
+            for reg in obj.regs:
+                add(reg)
+        elif isinstance(obj, SpecialRegister):
+            regs.setdefault(0xf00 | obj.address, obj)
+        elif isinstance(obj, list):
+            for x in obj:
+                add(x)
+        elif isinstance(obj, FSRControl):
+            for name in sorted(vars(obj)):
+                add(getattr(obj, name))
+        if isinstance(obj, FieldRegister):
+            for field in obj.fields.values():
+                if field.nbits == 1:
+                    bits[(0xf00 | field.reg.address, field.pos1%8)] = field.name
+    if namespace is None:
+        namespace = globals()
+    for name in sorted(namespace):
+        add(namespace[name])
+    return (regs, bits)
+
+def find_register(address):
+    """ Returns the single-byte special register at given full address
+    (0xf60-0xfff) or None """
+    global _by_address
+    if _by_address is None:
+        _by_address = _index()
+    return _by_address[0].get(address)
+
+def find_bit(address, ind):
+    """ Returns the name of the bit ind of the register at given full
+    address or None """
+    global _by_address
+    if _by_address is None:
+        _by_address = _index()
+    return _by_address[1].get((address, ind))
@@ -0,0 +1,416 @@
+# Copyright 2008 Anton Mellit
+
+""" Instruction-level simulation of generated code
+
+Machine runs the words of a program (e.g. CodeMaker.output) as the chip
+would, one instruction at a time, and counts the instruction cycles. The
+instructions are decoded from the words with the disassembler's table,
+so the code which runs is exactly the code which is flashed. It is the
+scalar counterpart of lanes.LaneMachine and needs no NumPy.
+
+Usage:
+
+    machine = Machine()
+    machine[x.address] = 5
+    machine.run(code_maker.output)
+    print machine[y.address], machine.cycles
+
+"""
+
+from barebits.pic16.instructions import (standard, Designator, skips,
+        branch_flags)
+from barebits.pic16.registers import WREG, STATUS, BSR, PROD
+
+C, DC, Z, OV, N = 1, 2, 4, 8, 16
+ALL = C | DC | Z | OV | N
+
+_wreg = 0xf00 | WREG.address
+_status = 0xf00 | STATUS.address
+_bsr = 0xf00 | BSR.address
+_prodl = 0xf00 | PROD.address
+
+""" Indirect registers: address -> (address of FSRnL, change of FSR
+before the access, change after it); PLUSWn adds WREG as a signed
+offset """
+_indirect = {}
+for (_fsr, _base) in [(0xfe9, 0xfef), (0xfe1, 0xfe7), (0xfd9, 0xfdf)]:
+    _indirect[_base] = (_fsr, 0, 0)         # INDFn
+    _indirect[_base-1] = (_fsr, 0, 1)       # POSTINCn
+    _indirect[_base-2] = (_fsr, 0, -1)      # POSTDECn
+    _indirect[_base-3] = (_fsr, 1, 0)       # PREINCn
+    _indirect[_base-4] = (_fsr, None, 0)    # PLUSWn
+
+
+class Machine:
+    """ The data memory and the state of a PIC18.
+
+    mem -- bytearray of the 4096 bytes of data memory, the special
+    registers included (WREG is mem[0xfe8])
+    access -- the file registers 0-access are in the access bank
+    used -- the general purpose registers (below 0xf00) the last run
+    read or wrote
+    cycles -- instruction cycles of the last run
+    steps -- instructions executed by the last run
+
+    """
+    def __init__(self, access=0x60):
+        self.mem = bytearray(0x1000)
+        self.access = access
+        self.used = set()
+        self.cycles = 0
+        self.steps = 0
+        self.stack = []
+        self._current = None
+
+    def __getitem__(self, reg):
+        """ Value of a register given by a Designator or a full address """
+        return self.mem[self._resolve(reg)]
+
+    def __setitem__(self, reg, value):
+        self.mem[self._resolve(reg)] = value & 0xff
+
+    def _resolve(self, reg):
+        """ Full address of a register, Designators in BSR mode use the
+        current BSR """
+        if not isinstance(reg, Designator):
+            return reg
+        if reg.use_bsr:
+            return (self.mem[_bsr] & 0xf)<<8 | reg.address
+        if reg.address < self.access:
+            return reg.address
+        return 0xf00 | reg.address
+
+    def _address(self, address):
+        """ The address accessed through address, following the
+        indirect registers (and updating their FSR) """
+        if address < 0xf00:
+            self.used.add(address)
+            return address
+        ind = _indirect.get(address)
+        if ind is None:
+            return address
+        (fsr, before, after) = ind
+        mem = self.mem
+        value = mem[fsr] | (mem[fsr+1] & 0xf)<<8
+        if before is None:
+            w = mem[_wreg]
+            target = (value + w - ((w & 0x80)<<1)) & 0xfff
+        else:
+            value = (value + before) & 0xfff
+            target = value
+        value = (value + after) & 0xfff
+        mem[fsr] = value & 0xff
+        mem[fsr+1] = value>>8
+        return self._address(target)
+
+    def _target(self, f):
+        """ The address accessed through the register operand f of the
+        current instruction: an instruction which reads and writes an
+        indirect register moves its FSR once """
+        current = self._current
+        if current is not None and current[0] is f:
+            return current[1]
+        address = self._address(self._resolve(f))
+        self._current = (f, address)
+        return address
+
+    def _f(self, f):
+        return self.mem[self._target(f)]
+
+    def _write(self, f, value):
+        self.mem[self._target(f)] = value & 0xff
+
+    def _flags(self, affected, flags):
+        mem = self.mem
+        mem[_status] = (mem[_status] & ~affected) | (flags & affected)
+
+    def _logic_flags(self, res):
+        self._flags(Z | N, (res == 0)*Z | (res>>3) & N)
+
+    def _add(self, a, b, carry):
+        """ a + b + carry with all flags, returns the result """
+        res = a + b + carry
+        dc = ((a & 0xf) + (b & 0xf) + carry) & 0x10
+        low = res & 0xff
+        ov = ((a ^ low) & (b ^ low) & 0x80)>>4
+        self._flags(ALL, (res>>8) & C | dc>>3 | ov | (low == 0)*Z |
+                    (low>>3) & N)
+        return low
+
+    def _sub(self, a, b, carry=1):
+        """ a - b - (1-carry) with all flags """
+        return self._add(a, (~b) & 0xff, carry)
+
+    def _carry(self):
+        return self.mem[_status] & C
+
+    def _w(self):
+        return self.mem[_wreg]
+
+    def _dest(self, f, d, res):
+        if d:
+            self._write(f, res)
+        else:
+            self.mem[_wreg] = res & 0xff
+
+    # Instructions. Each method takes the arguments of the instruction as
+    # decoded from its words, skip and branch instructions return whether
+    # the skip or jump happens.
+
+    def i_NOP(self):
+        pass
+
+    i_NOP1 = i_CLRWDT = i_NOP
+
+    def i_MOVLB(self, k):
+        self.mem[_bsr] = k & 0xf
+
+    def i_MOVLW(self, k):
+        self.mem[_wreg] = k
+
+    def i_MOVWF(self, f):
+        self._write(f, self._w())
+
+    def i_MOVF(self, f, d):
+        res = self._f(f)
+        self._dest(f, d, res)
+        self._logic_flags(res)
+
+    def i_MOVFF(self, src, dst):
+        value = self.mem[self._address(src)]
+        self.mem[self._address(dst)] = value
+
+    def i_LFSR(self, fsr, k):
+        address = [0xfe9, 0xfe1, 0xfd9][fsr]
+        self.mem[address] = k & 0xff
+        self.mem[address+1] = k>>8
+
+    def i_CLRF(self, f):
+        self._write(f, 0)
+        self._flags(Z, Z)
+
+    def i_SETF(self, f):
+        self._write(f, 0xff)
+
+    def i_SWAPF(self, f, d):
+        res = self._f(f)
+        self._dest(f, d, (res<<4 | res>>4) & 0xff)
+
+    def i_COMF(self, f, d):
+        res = ~self._f(f) & 0xff
+        self._dest(f, d, res)
+        self._logic_flags(res)
+
+    def _logic(op):
+        def wreg_reg(self, f, d):
+            res = op(self._f(f), self._w())
+            self._dest(f, d, res)
+            self._logic_flags(res)
+        def lit_wreg(self, k):
+            res = op(self._w(), k)
+            self.mem[_wreg] = res
+            self._logic_flags(res)
+        return (wreg_reg, lit_wreg)
+
+    (i_ANDWF, i_ANDLW) = _logic(lambda a, b: a & b)
+    (i_IORWF, i_IORLW) = _logic(lambda a, b: a | b)
+    (i_XORWF, i_XORLW) = _logic(lambda a, b: a ^ b)
+
+    def i_ADDWF(self, f, d):
+        self._dest(f, d, self._add(self._f(f), self._w(), 0))
+
+    def i_ADDWFC(self, f, d):
+        self._dest(f, d, self._add(self._f(f), self._w(), self._carry()))
+
+    def i_ADDLW(self, k):
+        self.mem[_wreg] = self._add(self._w(), k, 0)
+
+    def i_SUBWF(self, f, d):
+        self._dest(f, d, self._sub(self._f(f), self._w()))
+
+    def i_SUBWFB(self, f, d):
+        self._dest(f, d, self._sub(self._f(f), self._w(), self._carry()))
+
+    def i_SUBFWB(self, f, d):
+        self._dest(f, d, self._sub(self._w(), self._f(f), self._carry()))
+
+    def i_SUBLW(self, k):
+        self.mem[_wreg] = self._sub(k, self._w())
+
+    def i_NEGF(self, f):
+        self._write(f, self._sub(0, self._f(f)))
+
+    def i_INCF(self, f, d):
+        self._dest(f, d, self._add(self._f(f), 1, 0))
+
+    def i_DECF(self, f, d):
+        self._dest(f, d, self._sub(self._f(f), 1))
+
+    def i_RLCF(self, f, d):
+        value = self._f(f)
+        res = (value<<1 | self._carry()) & 0xff
+        self._dest(f, d, res)
+        self._flags(C | Z | N, value>>7 | (res == 0)*Z | (res>>3) & N)
+
+    def i_RRCF(self, f, d):
+        value = self._f(f)
+        res = value>>1 | self._carry()<<7
+        self._dest(f, d, res)
+        self._flags(C | Z | N, value & 1 | (res == 0)*Z | (res>>3) & N)
+
+    def i_RLNCF(self, f, d):
+        value = self._f(f)
+        res = (value<<1 | value>>7) & 0xff
+        self._dest(f, d, res)
+        self._logic_flags(res)
+
+    def i_RRNCF(self, f, d):
+        value = self._f(f)
+        res = (value>>1 | value<<7) & 0xff
+        self._dest(f, d, res)
+        self._logic_flags(res)
+
+    def i_MULWF(self, f):
+        self._product(self._f(f))
+
+    def i_MULLW(self, k):
+        self._product(k)
+
+    def _product(self, value):
+        res = self._w() * value
+        self.mem[_prodl] = res & 0xff
+        self.mem[_prodl+1] = res>>8
+
+    def i_BSF(self, f, b):
+        self._write(f, self._f(f) | 1<<b)
+
+    def i_BCF(self, f, b):
+        self._write(f, self._f(f) & ~(1<<b))
+
+    def i_BTG(self, f, b):
+        self._write(f, self._f(f) ^ 1<<b)
+
+    def i_BTFSS(self, f, b):
+        return self._f(f)>>b & 1 == 1
+
+    def i_BTFSC(self, f, b):
+        return self._f(f)>>b & 1 == 0
+
+    def i_TSTFSZ(self, f):
+        return self._f(f) == 0
+
+    def i_CPFSEQ(self, f):
+        return self._f(f) == self._w()
+
+    def i_CPFSGT(self, f):
+        return self._f(f) > self._w()
+
+    def i_CPFSLT(self, f):
+        return self._f(f) < self._w()
+
+    def _count_skip(step, skip_on_zero):
+        def f(self, reg, d):
+            res = (self._f(reg) + step) & 0xff
+            self._dest(reg, d, res)
+            return (res == 0) == skip_on_zero
+        return f
+
+    i_INCFSZ = _count_skip(1, True)
+    i_DECFSZ = _count_skip(-1, True)
+    i_INFSNZ = _count_skip(1, False)
+    i_DCFSNZ = _count_skip(-1, False)
+
+    del _logic, _count_skip
+
+    def _decode(self, words, instructions):
+        """ Returns the program as a list with, for every position of an
+        instruction, (name, method, args, length in words, cycles) """
+        from barebits.pic16.disasm import decode_table
+        table = decode_table(instructions)
+        program = [None]*len(words)
+        pos = 0
+        while pos < len(words):
+            (instr, args, length) = table.decode(words, pos)
+            if instr is None:
+                raise ValueError('invalid instruction 0x%04x at position '
+                                    '%d' % (words[pos], pos))
+            program[pos] = (instr.name, getattr(self, 'i_' + instr.name,
+                            None), args, length, instr.cycles[0])
+            pos += length
+        return program
+
+    def run(self, words, origin=0, instructions=standard,
+            max_cycles=10**8):
+        """ Runs the words placed at origin (in bytes) from the first one
+        until execution leaves them, a RETURN finds the stack empty or a
+        SLEEP is reached. Returns self. """
+        program = self._decode(words, instructions)
+        end = len(program)
+        mem = self.mem
+        self.used = set()
+        self.stack = []
+        cycles = 0
+        steps = 0
+        pc = 0
+        while 0 <= pc < end:
+            (name, method, args, length, cost) = program[pc]
+            self._current = None
+            steps += 1
+            cycles += cost
+            following = pc + length
+            if name in branch_flags:
+                (flag, value) = branch_flags[name]
+                if (mem[_status] & flag != 0) == value:
+                    pc = following + args[0]
+                    cycles += 1
+                else:
+                    pc = following
+            elif method is not None:
+                if method(*args) and name in skips:
+                    skipped = None
+                    if following < end:
+                        skipped = program[following]
+                    if skipped is None:
+                        # past the end, counted as a one-word skip
+                        pc = following + 1
+                        cycles += 1
+                    else:
+                        pc = following + skipped[3]
+                        cycles += skipped[3]
+                else:
+                    pc = following
+            elif name in ('BRA', 'RCALL'):
+                if name == 'RCALL':
+                    self.stack.append(following)
+                pc = following + args[0]
+            elif name in ('GOTO', 'CALL', 'CALLFAST'):
+                if name != 'GOTO':
+                    self.stack.append(following)
+                pc = args[0] - origin//2
+            elif name in ('RETURN', 'RETURNFAST', 'RETLW'):
+                if name == 'RETLW':
+                    mem[_wreg] = args[0]
+                if not self.stack:
+                    break
+                pc = self.stack.pop()
+            elif name == 'SLEEP':
+                break
+            else:
+                raise ValueError('%s is not simulated' % name)
+            if cycles > max_cycles:
+                raise RuntimeError('code did not finish in %d cycles' %
+                                    max_cycles)
+        self.cycles = cycles
+        self.steps = steps
+        return self
+
+
+def simulate(code_maker, origin=0, values=None, access=0x60):
+    """ Runs the output of a CodeMaker linked at origin on a new Machine,
+    values is a dictionary register -> initial value. Returns the
+    Machine. """
+    machine = Machine(access)
+    if values is not None:
+        for (reg, value) in values.items():
+            machine[reg] = value
+    return machine.run(code_maker.output, origin, code_maker.instructions)
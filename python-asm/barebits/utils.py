@@ -2,6 +2,8 @@
 
 """ Utility functions """
 
+import os
+
 def bits_to_bin(str):
     """ Converts a string of '0' and '1' to a number """
     res = 0
@@ -21,3 +23,17 @@ def list_to_dict(L):
     for x in L:
         res[x.name] = x
     return res
+
+def cache_dir(*names):
+    """ Returns a directory for cached data, created if needed. The root
+    is $BAREBITS_CACHE or ~/.cache/barebits, names are subdirectories. """
+    path = os.environ.get('BAREBITS_CACHE') or os.path.join(
+                    os.path.expanduser('~'), '.cache', 'barebits')
+    path = os.path.join(path, *names)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    return path
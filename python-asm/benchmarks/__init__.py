@@ -0,0 +1,7 @@
+# Copyright 2008 Anton Mellit
+
+""" Benchmarks, run as modules from the python-asm directory, e.g.
+
+python -m benchmarks.hex_writer
+
+"""
@@ -0,0 +1,63 @@
+# Copyright 2008 Anton Mellit
+
+""" Measures the build driver on many variants of a firmware """
+
+from __future__ import with_statement
+
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+from barebits.pic16.alu import Variable, var
+from barebits.pic16.control import block, if_, for_
+from barebits.pic16.registers import TRIS28p, PORT28p, TRIS40p, PORT40p
+from barebits.pic16.build import Variant, build
+
+def firmware(tris, port, nblocks):
+    """ Blocks of loops and expressions, about 30 instructions each """
+    Variable(tris).clear_bit(7)
+    port = Variable(port)
+    total = var()
+    for i in range(nblocks):
+        with block():
+            x = var()
+            with for_(x, 10):
+                y = var(x + i)
+                with if_(y == port):
+                    total <<= total + y
+            port <<= (total + 3) ^ (port + x)
+
+def variants(nblocks):
+    parts = [('28p', TRIS28p[1], PORT28p[1]), ('40p', TRIS40p[3], PORT40p[3])]
+    options = [('plain', {}), ('peephole', dict(peephole=True, relax=True)),
+                ('liveness', dict(allocator='liveness', peephole=True))]
+    res = []
+    for (part, tris, port) in parts:
+        for offset in (0x100, 0x800):
+            for (kind, opts) in options:
+                res.append(Variant('%s_%x_%s' % (part, offset, kind),
+                        firmware, dict(tris=tris, port=port, nblocks=nblocks),
+                        offset, **opts))
+    return res
+
+def main(nblocks=100):
+    path = tempfile.mkdtemp()
+    try:
+        jobs = variants(nblocks)
+        base = None
+        processes = 1
+        while processes <= multiprocessing.cpu_count():
+            t = time.time()
+            build(jobs, path, processes)
+            t = time.time() - t
+            if base is None:
+                base = t
+            print '%2d processes: %d variants in %.2f s (x%.1f)' % (
+                    processes, len(jobs), t, base/t)
+            processes *= 2
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
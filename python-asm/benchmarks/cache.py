@@ -0,0 +1,51 @@
+# Copyright 2008 Anton Mellit
+
+""" Measures cold and warm builds with the block cache """
+
+from __future__ import with_statement
+
+import time
+import shutil
+import tempfile
+
+from barebits.pic16.alu import Variable, var
+from barebits.pic16.control import program, for_, if_
+from barebits.pic16.registers import PORT28p
+from barebits.pic16.cache import cached, BlockCache
+from barebits.context import get_context
+
+@cached
+def driver(port, bit, n):
+    """ A routine of about 60 instructions """
+    x = var()
+    with for_(x, n):
+        for i in range(8):
+            y = var(x + port)
+            with if_(y & (1<<i) != 0):
+                port.set_bit(bit)
+
+def firmware(nroutines):
+    port = Variable(PORT28p[1])
+    for i in range(nroutines):
+        driver(port, i % 8, i + 1)
+
+def build(nroutines, **options):
+    t = time.time()
+    with program(**options):
+        firmware(nroutines)
+    return (time.time() - t, get_context().code_maker)
+
+def main(nroutines=200):
+    path = tempfile.mkdtemp()
+    try:
+        cache = BlockCache(path)
+        (plain, code_maker) = build(nroutines)
+        print 'no cache  %.3f s, %d words' % (plain, len(code_maker.output))
+        for name in ('cold', 'warm'):
+            (t, code_maker) = build(nroutines, cache=cache)
+            print '%-9s %.3f s, %s' % (name, t, code_maker.cache_stats)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# Copyright 2008 Anton Mellit
+
+""" Compares the emission of instructions through Instruction.write (the
+way CodeMaker.do worked before the encoders) with do and emit """
+
+from __future__ import with_statement
+
+import time
+
+from barebits import events
+from barebits.code import CodeMaker, Fixup, add_cycles
+from barebits.pic16.control import program
+from barebits.pic16.instructions import standard, Designator
+from barebits.pic16.registers import PORT28p
+from benchmarks.regalloc import firmware
+
+def legacy_do(self, name, *args):
+    """ CodeMaker.do as it was, with the Words of write """
+    output = self.output
+    if events.instruction.fire is not None:
+        events.instruction.fire(self, len(output), name, args)
+    if self.comments is not None:
+        self.comments[len(output)] = [name]+list(args)
+    for arg in args:
+        if isinstance(arg, Fixup):
+            self.fixups[len(output)] = [name]+list(args)
+            break
+    instruction = self.instructions[name]
+    for word in instruction.write(*args):
+        output.append(word.word)
+    self.cycles = add_cycles(self.cycles, instruction.cycles)
+
+def sequence(n):
+    r = Designator(0x3f, True)
+    port = PORT28p[1]
+    body = [('MOVF', (r, False)), ('ADDLW', (3,)), ('MOVWF', (r,)),
+            ('BSF', (port, 7)), ('ANDWF', (r, True)), ('BNZ', (-5,)),
+            ('MOVFF', (r, port)), ('BRA', (-8,))]
+    return body*(n//len(body))
+
+def best(f, repeat=3):
+    times = []
+    for i in range(repeat):
+        t = time.time()
+        f()
+        times.append(time.time() - t)
+    return min(times)
+
+def main(ninstructions=200000, nblocks=300):
+    instructions = sequence(ninstructions)
+    bound = [(standard[name], args) for (name, args) in instructions]
+    def with_write():
+        code = CodeMaker(standard, comments=False)
+        for (name, args) in instructions:
+            legacy_do(code, name, *args)
+    def with_do():
+        code = CodeMaker(standard, comments=False)
+        for (name, args) in instructions:
+            code.do(name, *args)
+    def with_emit():
+        CodeMaker(standard, comments=False).emit(bound)
+    base = None
+    for (name, f) in [('write', with_write), ('do', with_do),
+                        ('emit', with_emit)]:
+        t = best(f)
+        if base is None:
+            base = t
+        print '%-6s %8.0f instructions/s (x%.1f)' % (name,
+                len(instructions)/t, base/t)
+    def build():
+        with program():
+            firmware(nblocks)
+    do = CodeMaker.do
+    CodeMaker.do = legacy_do
+    try:
+        t_old = best(build)
+    finally:
+        CodeMaker.do = do
+    t_new = best(build)
+    print 'firmware of %d blocks: %.3f s with write, %.3f s with do' % (
+            nblocks, t_old, t_new)
+
+if __name__ == '__main__':
+    main()
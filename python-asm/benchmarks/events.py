@@ -0,0 +1,46 @@
+# Copyright 2008 Anton Mellit
+
+""" Measures the cost of the events of the compiler with and without
+subscribers """
+
+from __future__ import with_statement
+
+import os
+import time
+from cStringIO import StringIO
+
+from barebits.pic16.control import program
+from barebits.events import subscribed, TextTrace, Counters, BinaryTrace
+from benchmarks.regalloc import firmware
+
+def measure(subscriber, nblocks, repeat=3):
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        if subscriber is None:
+            with program():
+                firmware(nblocks)
+        else:
+            with subscribed(subscriber()):
+                with program():
+                    firmware(nblocks)
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+def main(nblocks=300):
+    devnull = open(os.devnull, 'w')
+    subscribers = [('none', None), ('counters', Counters),
+                ('binary', lambda: BinaryTrace(StringIO())),
+                ('text', lambda: TextTrace(devnull))]
+    base = None
+    for (name, subscriber) in subscribers:
+        t = measure(subscriber, nblocks)
+        if base is None:
+            base = t
+        print '%-9s %.3f s (+%d%%)' % (name, t, round(100*(t/base - 1)))
+    devnull.close()
+
+if __name__ == '__main__':
+    main()
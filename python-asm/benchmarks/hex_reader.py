@@ -0,0 +1,34 @@
+# Copyright 2008 Anton Mellit
+
+""" Measures the speed of reading HEX files into a Memory image """
+
+import random
+import time
+from array import array
+from cStringIO import StringIO
+
+from barebits.hex import write_hex, read_hex, write_memory
+
+def main(sizes=(1<<14, 1<<17, 1<<20)):
+    random.seed(0)
+    for nwords in sizes:
+        output = array('H', (random.randrange(0x10000) for i in xrange(nwords)))
+        stream = StringIO()
+        write_hex(stream, output, 0x100)
+        text = stream.getvalue()
+        best = None
+        for i in range(3):
+            t = time.time()
+            memory = read_hex(StringIO(text))
+            t = time.time() - t
+            if best is None or t < best:
+                best = t
+        stream = StringIO()
+        write_memory(stream, memory)
+        assert stream.getvalue() == text
+        print '%8d words, %5.1f MB of HEX: %7.2f MB/s, %d segments' % (
+                nwords, len(text)/1e6, len(text)/1e6/best, 
+                len(memory.segments()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Copyright 2008 Anton Mellit
+
+""" Compares the streaming HEX writer with the original gen_hex """
+
+import random
+import time
+from array import array
+from cStringIO import StringIO
+
+from barebits.hex import write_hex
+
+hex = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'a', 'b', 'c', 
+        'd', 'e', 'f']
+
+def to_hex(val, len):
+    s = ''
+    for i in range(len):
+        s = hex[val&0xf] + s
+        val = val>>4
+    return s
+
+def hex_line(address, type, data):
+    s = ':'
+    sum = 0
+    s += to_hex(len(data), 2)
+    sum -= len(data)
+    s += to_hex(address, 4)
+    sum -= address&0xff
+    sum -= (address>>8)&0xff
+    s += to_hex(type, 2)
+    sum -= type
+    sum &= 0xff
+    for c in data:
+        s += to_hex(c, 2)
+        sum -= c
+        sum &= 0xff
+    s += to_hex(sum, 2)
+    return s
+
+def legacy_gen_hex(output, offset):
+    """ gen_hex as it was before the streaming writer (the GOTO record
+    is precomputed) """
+    yield hex_line(0, 4, [0, 0])
+    yield hex_line(0, 0, [offset>>1 & 0xff, 0xef, offset>>9 & 0xff, 0xf0])
+    bytes = []
+    for w in output:
+        bytes.append(w & 0xff)
+        bytes.append((w>>8) & 0xff)
+    count = (len(bytes)+15)//16
+    for i in range(count):
+        buf = [bytes[x] for x in range(i*16, min((i+1)*16, len(bytes)))]
+        yield hex_line(offset+i*16, 0, buf)
+    yield hex_line(0, 1, [])
+
+def legacy(output):
+    return '\n'.join(legacy_gen_hex(output, 0x100)) + '\n'
+
+def streaming(output):
+    stream = StringIO()
+    write_hex(stream, output, 0x100)
+    return stream.getvalue()
+
+def measure(f, output, repeat=3):
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        res = f(output)
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return (best, res)
+
+def main(sizes=(1<<10, 1<<14, 1<<16)):
+    random.seed(0)
+    for nwords in sizes:
+        output = array('H', (random.randrange(0x10000) for i in xrange(nwords)))
+        (t_old, old) = measure(legacy, output)
+        (t_new, new) = measure(streaming, output)
+        assert old == new or nwords*2 + 0x100 > 0x10000
+        mb = nwords*2/1e6
+        print '%6d words: legacy %7.2f MB/s, streaming %7.2f MB/s (x%.1f)' % (
+                nwords, mb/t_old, mb/t_new, t_old/t_new)
+
+if __name__ == '__main__':
+    main()
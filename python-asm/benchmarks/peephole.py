@@ -0,0 +1,74 @@
+# Copyright 2008 Anton Mellit
+
+""" Reports what the peephole optimizer saves on the sample firmware """
+
+from __future__ import with_statement
+
+from barebits.pic16.alu import Variable, var
+from barebits.pic16.control import program, block, if_, while_, for_
+from barebits.pic16.registers import TRIS28p, PORT28p
+from barebits.context import get_context
+
+def expressions():
+    portTRIS = Variable(TRIS28p[1])
+    port = Variable(PORT28p[1])
+    portTRIS.clear_bit(7)
+    port.set_bit(7)
+    port <<= (port+3)+(portTRIS+6)-(5-port)
+    x = var()
+    y = var()
+    x <<= 2
+    y <<= 3
+    z = var(x-y)
+
+def pause():
+    with block():
+        x = var()
+        with for_(x, 100):
+            y = var()
+            with for_(y, 100):
+                z = var()
+                with for_(z, 10):
+                    pass
+
+def blink():
+    portTRIS = Variable(TRIS28p[1])
+    port = Variable(PORT28p[1])
+    portTRIS.clear_bit(7)
+    portTRIS.clear_bit(6)
+    port.clear_bit(6)
+    with block():
+        x = var()
+        y = var()
+        with while_(x == x):
+            y <<= y + 1
+            with if_(y&1 != 0):
+                port.set_bit(7)
+            with if_(y&1 == 0):
+                port.clear_bit(7)
+            with if_(y&2 != 0):
+                port.set_bit(6)
+            with if_(y&2 == 0):
+                port.clear_bit(6)
+            pause()
+
+def _cycles(cycles):
+    return '%d-%s' % (cycles[0], '?' if cycles[1] is None else cycles[1])
+
+def main(firmware=(expressions, pause, blink)):
+    for f in firmware:
+        with program():
+            f()
+        before = get_context().code_maker
+        with program(peephole=True):
+            f()
+        after = get_context().code_maker
+        savings = after.savings
+        print '%-12s %4d -> %4d bytes, %s -> %s cycles, saved %s' % (
+                f.__name__, 2*len(before.output), 2*len(after.output),
+                _cycles(before.cycles), _cycles(after.cycles), savings)
+        for (rule, count) in sorted(savings.rules.items()):
+            print '    %-12s %d' % (rule, count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# Copyright 2008 Anton Mellit
+
+""" Measures the code the compiler generates for a corpus of programs
+
+For every program of the corpus and every set of options of program() it
+reports the size of the code in bytes, the RAM it uses and the cycles it
+takes, run from start to end on sim.Machine. The results are stored as
+JSON in a directory, one file per git revision, with the time of the run,
+and compared with a baseline: the file given by --baseline, by default
+the other file of the directory with the latest time recorded in it (the
+dates of the files, which copies and checkouts change, are not used). A
+measure which grew by more than the threshold is reported as a
+regression and makes the exit status 1.
+
+python -m benchmarks.quality
+python -m benchmarks.quality --baseline old.json --threshold 0.01
+
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import json
+import time
+from optparse import OptionParser
+
+from barebits.utils import cache_dir
+from barebits.context import isolated
+from barebits.pic16.alu import Variable, var
+from barebits.pic16.control import program, block, if_, for_
+from barebits.pic16.registers import TRIS28p, PORT28p
+from barebits.pic16.sim import simulate
+from benchmarks.throughput import _revision
+
+ORIGIN = 0x100
+
+def pause():
+    """ The delay loop of test.py """
+    with block():
+        x = var()
+        with for_(x, 100):
+            y = var()
+            with for_(y, 100):
+                z = var()
+                with for_(z, 10):
+                    pass
+
+def bitbang():
+    """ Pins set from the bits of a counter, as in test3 of test.py, for
+    64 steps """
+    portTRIS = Variable(TRIS28p[1])
+    port = Variable(PORT28p[1])
+    portTRIS.clear_bit(7)
+    portTRIS.clear_bit(6)
+    portTRIS.clear_bit(4)
+    with block():
+        y = var()
+        with for_(y, 64):
+            for (bit, pin) in [(1, 7), (2, 6), (4, 4)]:
+                with if_(y&bit != 0):
+                    port.set_bit(pin)
+                with if_(y&bit == 0):
+                    port.clear_bit(pin)
+            z = var()
+            with for_(z, 10):
+                pass
+
+def arithmetic():
+    """ Chains of operations on values in registers """
+    port = Variable(PORT28p[1])
+    a = var(port + 17)
+    b = var(a ^ 0x5a)
+    c = var((a + b) - (b & 0x0f))
+    d = var(((c | a) + 3) ^ (b - c))
+    x = var()
+    with for_(x, 20):
+        a <<= (a + x) ^ (d - b)
+        b <<= (b - a) & (c + x)
+        d <<= d + (a ^ b)
+    port <<= a + b + c + d
+
+def nested_for():
+    """ Loops in loops accumulating their counters """
+    port = Variable(PORT28p[1])
+    total = var(0)
+    x = var()
+    with for_(x, 10):
+        y = var()
+        with for_(y, x, 12):
+            z = var()
+            with for_(z, 5):
+                total <<= total + (y ^ z)
+        total <<= total - x
+    port <<= total
+
+CORPUS = [('pause', pause), ('bitbang', bitbang), ('arithmetic', arithmetic),
+            ('nested_for', nested_for)]
+
+OPTIONS = [('plain', {}), ('peephole', dict(peephole=True, relax=True)),
+            ('liveness', dict(allocator='liveness', peephole=True,
+                                relax=True)),
+            ('cse', dict(simplify=True, cse=True)),
+            ('countdown', dict(allocator='liveness', peephole=True,
+                                relax=True, countdown=True))]
+
+MEASURES = ['bytes', 'ram', 'cycles']
+
+def measure(source, options):
+    """ Compiles and runs source, returns the dictionary of measures """
+    with isolated() as context:
+        with program(origin=ORIGIN, **options):
+            source()
+    code_maker = context.code_maker
+    machine = simulate(code_maker, ORIGIN)
+    return {'bytes': 2*len(code_maker.output), 'ram': len(machine.used),
+            'cycles': machine.cycles}
+
+def run():
+    """ Measures the corpus, returns a dictionary 'program/options' ->
+    measures """
+    res = {}
+    for (name, source) in CORPUS:
+        for (kind, options) in OPTIONS:
+            res['%s/%s' % (name, kind)] = measure(source, options)
+    return res
+
+def regressions(old, new, threshold):
+    """ Returns a list of (key, measure, old value, new value) where the
+    new value is larger than the old one by more than threshold (a
+    fraction) """
+    res = []
+    for key in sorted(new):
+        if key not in old:
+            continue
+        for m in MEASURES:
+            (a, b) = (old[key][m], new[key][m])
+            if b > a*(1 + threshold):
+                res.append((key, m, a, b))
+    return res
+
+def _load(path):
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def _baseline(directory, revision):
+    """ Path of the result in directory, other than revision's, with the
+    latest time recorded in it (then the greatest name) """
+    paths = [os.path.join(directory, x) for x in sorted(os.listdir(directory))
+                if x.endswith('.json') and x != '%s.json' % revision]
+    if not paths:
+        return None
+    return max(paths, key=lambda path: (_load(path).get('time', 0), path))
+
+def main(directory=None, baseline=None, threshold=0.02):
+    if directory is None:
+        directory = cache_dir('quality')
+    revision = _revision() or 'unknown'
+    results = run()
+    if baseline is None:
+        baseline = _baseline(directory, revision)
+    old = None
+    if baseline is not None:
+        old = _load(baseline)['results']
+    print '%-24s %8s %6s %10s' % ('', 'bytes', 'ram', 'cycles')
+    for key in sorted(results):
+        r = results[key]
+        line = '%-24s %8d %6d %10d' % (key, r['bytes'], r['ram'],
+                                        r['cycles'])
+        if old is not None and key in old:
+            line += '   (%s)' % ', '.join('%+d' % (r[m] - old[key][m])
+                                            for m in MEASURES)
+        print line
+    path = os.path.join(directory, revision + '.json')
+    f = open(path, 'w')
+    try:
+        json.dump({'revision': revision, 'time': time.time(),
+                    'results': results}, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    print 'stored in %s' % path
+    if old is None:
+        return []
+    found = regressions(old, results, threshold)
+    print 'compared with %s' % baseline
+    for (key, m, a, b) in found:
+        print 'REGRESSION %s %s: %d -> %d' % (key, m, a, b)
+    return found
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-d', '--directory',
+                        help='where the results are stored')
+    parser.add_option('--baseline', help='result file to compare with')
+    parser.add_option('--threshold', type='float', default=0.02,
+                        help='allowed growth, as a fraction')
+    (options, args) = parser.parse_args()
+    if main(options.directory, options.baseline, options.threshold):
+        sys.exit(1)
@@ -0,0 +1,46 @@
+# Copyright 2008 Anton Mellit
+
+""" Measures the liveness register allocator on large generated programs """
+
+from __future__ import with_statement
+
+import time
+
+from barebits.pic16 import regalloc
+from barebits.pic16.alu import Variable, var
+from barebits.pic16.control import program, block, if_, for_
+from barebits.pic16.registers import PORT28p
+from barebits.context import get_context
+
+def firmware(nblocks):
+    """ Blocks of loops and expressions, about 30 instructions each """
+    port = Variable(PORT28p[1])
+    total = var()
+    for i in range(nblocks):
+        with block():
+            x = var()
+            with for_(x, 10):
+                y = var(x + i)
+                with if_(y == port):
+                    total <<= total + y
+            z = var(total - x)
+            port <<= (z + 3) ^ (port + x)
+
+def main(sizes=(100, 300, 1000)):
+    times = []
+    assign = regalloc.assign
+    def timed(code, allocator):
+        t = time.time()
+        res = assign(code, allocator)
+        times.append(time.time() - t)
+        return res
+    regalloc.assign = timed
+    for nblocks in sizes:
+        with program(allocator='liveness'):
+            firmware(nblocks)
+        code_maker = get_context().code_maker
+        print '%6d instructions, %s: %.3f s' % (len(code_maker.comments),
+                code_maker.allocation, times[-1])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Copyright 2008 Anton Mellit
+
+""" Measures the time to import the compiler in a new interpreter """
+
+import os
+import sys
+import subprocess
+
+_probe = '''
+import time
+t = time.time()
+import %s
+t1 = time.time()
+%s
+t2 = time.time()
+print (t1 - t)*1e3, (t2 - t1)*1e3
+'''
+
+_first_use = '''
+from barebits.pic16.control import program
+from barebits.pic16.alu import var
+with program():
+    x = var(3)
+'''
+
+def measure(module, use='', runs=21):
+    """ Returns the medians of the import time and of the time of use in
+    milliseconds, the modules being compiled to .pyc files by a first run
+    which is not counted """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    code = 'from __future__ import with_statement\n' + _probe % (module, use)
+    subprocess.check_output([sys.executable, '-c', code], env=env)
+    imports = []
+    uses = []
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', code], env=env)
+        (t_import, t_use) = map(float, out.split())
+        imports.append(t_import)
+        uses.append(t_use)
+    return (sorted(imports)[runs//2], sorted(uses)[runs//2])
+
+def main():
+    for module in ('barebits.pic16.instructions', 'barebits.pic16.registers',
+                    'barebits.pic16.alu', 'barebits.pic16.control'):
+        print '%-28s %5.1f ms' % (module, measure(module)[0])
+    (t_import, t_use) = measure('barebits.pic16.control', _first_use)
+    print '%-28s %5.1f ms' % ('first program', t_use)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+# Copyright 2008 Anton Mellit
+
+""" Measures the throughput of the compiler on synthetic workloads
+
+Every workload generates a program of about the given number of
+instructions:
+
+nesting -- deeply nested block, if_ and while_ statements
+expressions -- long chains of binary operations (ALU._binary)
+churn -- many short-lived variables, allocated and freed
+hex -- gen_hex of a large output
+
+The time of a run is split into phases:
+
+lowering -- the body of program() without the emission of instructions
+emission -- CodeMaker.do of the instructions produced, timed by replaying
+them into a new CodeMaker
+finish -- the end of program() (allocation, linking)
+hex -- gen_hex of the output
+
+Every measurement runs in a process of its own, so that its peak memory
+(ru_maxrss) is its own. The results are printed and stored as JSON:
+
+python -m benchmarks.throughput -o new.json
+python -m benchmarks.throughput --compare old.json new.json
+
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import json
+import resource
+import subprocess
+from optparse import OptionParser
+
+from barebits.hex import gen_hex
+from barebits.code import CodeMaker
+from barebits.pic16.alu import Variable, var
+from barebits.pic16.control import program, block, if_, while_
+from barebits.pic16.instructions import standard
+from barebits.pic16.registers import PORT28p
+from barebits.context import get_context
+
+def nesting(n):
+    """ Statements nested 8 deep, about 40 instructions per nest """
+    port = Variable(PORT28p[1])
+    def nest(depth, x, port):
+        if depth == 0:
+            port <<= port + x
+            return
+        kind = depth % 3
+        if kind == 0:
+            with block():
+                y = var(x + depth)
+                nest(depth - 1, y, port)
+        elif kind == 1:
+            with if_(x != port):
+                nest(depth - 1, x, port)
+        else:
+            with while_(x == port):
+                x <<= x - 1
+                nest(depth - 1, x, port)
+    for i in range(n//40 + 1):
+        with block():
+            nest(8, var(port + i), port)
+
+def expressions(n):
+    """ Chains of 20 binary operations, about 60 instructions each """
+    port = Variable(PORT28p[1])
+    x = var(port)
+    y = var(port + 1)
+    for i in range(n//60 + 1):
+        e = x
+        for j in range(20):
+            if j % 4 == 0:
+                e = e + y
+            elif j % 4 == 1:
+                e = e ^ (port + j)
+            elif j % 4 == 2:
+                e = e - i
+            else:
+                e = e & (y - j)
+        x <<= e
+
+def churn(n):
+    """ Blocks of 10 variables living for a few instructions each """
+    port = Variable(PORT28p[1])
+    for i in range(n//30 + 1):
+        with block():
+            xs = [var(port + j) for j in range(10)]
+            port <<= xs[i % 10]
+
+WORKLOADS = {'nesting': nesting, 'expressions': expressions, 'churn': churn,
+                'hex': None}
+
+def _best(f, repeat):
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        res = f()
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return (best, res)
+
+def _compile(source, n):
+    """ Returns the code maker and the times of the body and of the end of
+    program() """
+    times = []
+    t = time.time()
+    with program(origin=0x100):
+        source(n)
+        times.append(time.time() - t)
+    times.append(time.time() - t - times[0])
+    return (get_context().code_maker, times)
+
+def _replay(comments):
+    """ Emits the instructions recorded in comments into a new CodeMaker """
+    code_maker = CodeMaker(standard, comments=False)
+    do = code_maker.do
+    for pos in sorted(comments):
+        line = comments[pos]
+        do(line[0], *line[1:])
+    return code_maker
+
+def _output(n):
+    """ An output of n words for the hex workload """
+    with program():
+        nesting(n)
+    output = list(get_context().code_maker.output)
+    return (output * (n//len(output) + 1))[:n]
+
+def measure(workload, n, repeat=3):
+    """ Runs workload on n instructions, returns a dictionary of results """
+    base_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    phases = {}
+    if workload == 'hex':
+        output = _output(n)
+    else:
+        source = WORKLOADS[workload]
+        best = None
+        for i in range(repeat):
+            (code_maker, times) = _compile(source, n)
+            if best is None or sum(times) < sum(best):
+                best = times
+        output = code_maker.output
+        (emission, replayed) = _best(lambda: _replay(code_maker.comments),
+                                    repeat)
+        phases['lowering'] = max(best[0] - emission, 0.0)
+        phases['emission'] = emission
+        phases['finish'] = best[1]
+    (phases['hex'], lines) = _best(lambda: list(gen_hex(output, 0x100)),
+                                    repeat)
+    total = sum(phases.values())
+    return {'workload': workload, 'size': n, 'instructions': len(output),
+            'seconds': total, 'instructions_per_second': len(output)/total,
+            'phases': phases, 'base_kb': base_kb,
+            'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def measure_in_process(workload, n, repeat=3):
+    """ Runs measure in a new interpreter """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    out = subprocess.check_output([sys.executable, '-m',
+                'benchmarks.throughput', '--run', workload, '--size', str(n),
+                '--repeat', str(repeat)], env=env)
+    return json.loads(out)
+
+def _revision():
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                        cwd=root, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _print(result):
+    phases = result['phases']
+    print '%-12s %6d instructions %9.0f instr/s %7.1f MB peak  %s' % (
+            result['workload'], result['instructions'],
+            result['instructions_per_second'], result['peak_kb']/1024.0,
+            ' '.join('%s %.3f s' % (name, phases[name])
+                        for name in ('lowering', 'emission', 'finish', 'hex')
+                        if name in phases))
+
+def compare(old, new):
+    """ Prints the ratios of the throughputs of two JSON result files """
+    def key(r):
+        return (r['workload'], r['size'])
+    old_results = dict((key(r), r) for r in old['results'])
+    print 'old %s, new %s' % (old.get('revision'), new.get('revision'))
+    for r in new['results']:
+        o = old_results.get(key(r))
+        if o is None:
+            continue
+        print '%-12s %6d: x%.2f instr/s, x%.2f peak memory' % (
+                r['workload'], r['size'], r['instructions_per_second'] /
+                o['instructions_per_second'], float(r['peak_kb']) /
+                o['peak_kb'])
+
+def main(sizes=(1000, 10000, 40000), workloads=None, path=None, repeat=3):
+    if workloads is None:
+        workloads = sorted(WORKLOADS)
+    results = []
+    for workload in workloads:
+        for n in sizes:
+            result = measure_in_process(workload, n, repeat)
+            _print(result)
+            results.append(result)
+    res = {'revision': _revision(), 'python': sys.version.split()[0],
+            'time': time.time(), 'results': results}
+    if path is not None:
+        f = open(path, 'w')
+        try:
+            json.dump(res, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+    return res
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-o', '--output', help='write the results to a file')
+    parser.add_option('--compare', nargs=2, metavar='OLD NEW',
+                        help='compare two result files')
+    parser.add_option('--run', help='measure one workload, print JSON')
+    parser.add_option('--size', type='int', action='append',
+                        help='number of instructions (repeatable)')
+    parser.add_option('--repeat', type='int', default=3)
+    (options, args) = parser.parse_args()
+    if options.compare:
+        (old, new) = [json.load(open(x)) for x in options.compare]
+        compare(old, new)
+    elif options.run:
+        print json.dumps(measure(options.run, options.size[0],
+                                    options.repeat))
+    else:
+        main(options.size or (1000, 10000, 40000), args or None,
+                options.output, options.repeat)
@@ -3,8 +3,8 @@
 from __future__ import with_statement
 
 from barebits.pic16.alu import Variable, var
-from barebits.hex import gen_hex
-from barebits.pic16.control import code, block, if_, while_, for_
+from barebits.hex import gen_hex, write_hex, read_hex, write_memory
+from barebits.pic16.control import program as code, block, if_, while_, for_
 from barebits.pic16.registers import TRIS28p, PORT28p
 from barebits.context import get_context
 
@@ -104,6 +104,1196 @@ def test3():
 :00000001ff
 '''.strip()
 
+def test_code_buffer():
+    with code():
+        x = var()
+        x <<= 2
+        with block():
+            y = var(x+1)
+
+    code_maker = get_context().code_maker
+    assert code_maker.output.typecode == 'H'
+    assert len(code_maker.output) == 5
+    assert sorted(code_maker.comments) == [0, 1, 2, 3, 4]
+    assert code_maker.comments[3] == ['ADDLW', 1]
+
+def test_write_hex():
+    from array import array
+    from cStringIO import StringIO
+    
+    output = array('H', range(8))
+    stream = StringIO()
+    write_hex(stream, output, 0xfff8, chunk_size=8)
+    res = stream.getvalue()
+    assert res == '\n'.join(gen_hex(output, 0xfff8)) + '\n'
+    assert res == '''
+:020000040000fa
+:04000000fcef7ff0a2
+:08fff8000000010002000300fb
+:020000040001f9
+:080000000400050006000700e2
+:00000001ff
+'''.lstrip()
+
+def test_read_hex():
+    from array import array
+    from cStringIO import StringIO
+    
+    text = '\n'.join(gen_hex(array('H', range(0x100)), 0xff80)) + '\n'
+    memory = read_hex(StringIO(text))
+    assert [(a, len(d)) for (a, d) in memory.segments()] == [
+                                    (0, 4), (0xff80, 0x200)]
+    assert memory[0x10000] == 0x40 and 0x10180 not in memory
+    memory.write(0x4, 'ab')
+    assert len(memory.segments()) == 2 and memory.read(4, 3) == 'ab\xff'
+    
+    stream = StringIO()
+    write_memory(stream, read_hex(StringIO(text)))
+    assert stream.getvalue() == text
+    
+    try:
+        read_hex(StringIO(':020000040000fb\n'))
+    except ValueError:
+        pass
+    else:
+        assert False
+    # the error names the line which is wrong
+    good = ':020000040000fa'
+    for bad in [':02000004000fa', '020000040000fa0', ':0200000400x0fa',
+                ':0000']:
+        try:
+            read_hex(StringIO('\n'.join([good, bad, good]) + '\n'))
+        except ValueError, e:
+            assert repr(bad) in str(e), str(e)
+        else:
+            assert False
+
+def test_alu_lanes():
+    from barebits.pic16.lanes import check_alu, verify, ordering_overflow
+    
+    assert check_alu() == []
+    # the expected failures of the ordering comparisons are still there
+    for name in ['<', '<=', '>', '>=']:
+        failures = verify(name)
+        assert failures
+        for (form, count, (a, b, got, expected)) in failures:
+            assert ordering_overflow(a, b)
+    assert check_alu(track_values=True) == []
+    assert check_alu(peephole=True) == []
+    assert check_alu(simplify=True) == []
+
+def test_disassemble():
+    from barebits.pic16.disasm import listing, decode_table
+    
+    with code():
+        port = Variable(PORT28p[1])
+        x = var()
+        with if_(x != 0):
+            port.set_bit(7)
+        x <<= (x ^ 0) - port
+    
+    res = listing(get_context().code_maker.output, 0x100)
+    print res
+    assert res == '''
+0100: 513f       MOVF 0x3f, W, BANKED
+0102: 0800       SUBLW 0x00
+0104: e001       BZ 0x0108
+0106: 8e81       BSF PORTB, 7
+0108: 513f       MOVF 0x3f, W, BANKED
+010a: 0a00       XORLW 0x00
+010c: 80d8       BSF STATUS, C
+010e: 5481       SUBFWB PORTB, W
+0110: 6f3f       MOVWF 0x3f, BANKED
+'''.strip()
+    table = decode_table()
+    assert table.lookup(0xe8c5).name == 'ADDULNK'
+    assert table.lookup(0xe845).name == 'ADDFSR'
+    assert listing([0xc081, 0xf03f, 0xf123]) == '''
+0000: c081 f03f  MOVFF 0x081, 0x03f
+0004: f123       NOP1 0x123'''.strip()
+    
+    # the tables are stored only in a cache directory given or set
+    import os, shutil, tempfile
+    from barebits.pic16 import disasm
+    path = tempfile.mkdtemp()
+    (environ, tables) = (dict(os.environ), disasm._tables)
+    try:
+        os.environ.pop('BAREBITS_CACHE', None)
+        os.environ['HOME'] = path
+        disasm._tables = {}
+        decode_table()
+        assert os.listdir(path) == []
+        disasm._tables = {}
+        decode_table(cache=os.path.join(path, 'tables'))
+        assert len(os.listdir(os.path.join(path, 'tables'))) == 1
+        disasm._tables = {}
+        table = decode_table(cache=os.path.join(path, 'tables'))
+        assert table.lookup(0xe8c5).name == 'ADDULNK'
+        # a stored table creates only the instructions it decodes
+        from barebits.pic16.instructions import InstructionTable, standard
+        decode_table(standard, cache=os.path.join(path, 'tables'))
+        fresh = InstructionTable(None, standard.specs.values())
+        disasm._tables = {}
+        table = decode_table(fresh, cache=os.path.join(path, 'tables'))
+        assert table.lookup(0x0e05).name == 'MOVLW'
+        assert dict.__len__(fresh) == 1
+        os.environ['BAREBITS_CACHE'] = path
+        disasm._tables = {}
+        decode_table()
+        assert len(os.listdir(os.path.join(path, 'disasm'))) == 1
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        disasm._tables = tables
+        shutil.rmtree(path)
+
+def test_report():
+    with code():
+        port = Variable(PORT28p[1])
+        pause()
+        with if_(port == 0, name='check'):
+            port.set_bit(3)
+    
+    report = get_context().code_maker.report()
+    print '\n'.join(report.listing(0x100))
+    [main] = report.children
+    [pause_block, check] = main.children
+    assert (check.name, check.kind, check.words, check.cycles) == (
+                'check', 'if', 4, (4, 4))
+    loop = report.to_dict(0x100)
+    for i in range(5):
+        loop = loop['children'][0]
+    assert loop == {'kind': 'for', 'address': 0x11c, 
+        'bytes': 16, 'cycles': [95, 95], 'iteration': [9, 9], 
+        'iterations': 10, 'children': []}
+    assert report.cycles == (1061611, 1061611)
+
+def test_peephole():
+    from barebits.pic16.lanes import LaneMachine
+    from barebits.pic16.disasm import listing
+    
+    def firmware(peephole):
+        with code(peephole=peephole):
+            port = Variable(PORT28p[1])
+            x = var()
+            y = var()
+            z = var()
+            regs = (x.address, y.address, z.address)
+            y <<= x + 1
+            z <<= (x - 1) ^ y
+            with if_(x == 0):
+                z <<= 0xff
+            w = var()
+            with for_(w, 3):
+                y <<= y + 1
+                port.set_bit(1)
+        return (get_context().code_maker, regs)
+    
+    (plain, regs) = firmware(False)
+    (optimized, regs) = firmware(True)
+    savings = optimized.savings
+    print savings, savings.rules
+    assert savings.words == 8 and savings.cycles == (16, 16)
+    assert len(optimized.output) == len(plain.output) - 8
+    assert plain.cycles[0] - optimized.cycles[0] == 16
+    print listing(optimized.output)
+    assert listing(optimized.output).split('\n')[7] == '000e: e101       BNZ 0x0012'
+    
+    results = []
+    for code_maker in [plain, optimized]:
+        machine = LaneMachine(256)
+        machine[regs[0]] = range(256)
+        machine.run(code_maker)
+        results.append([list(machine[r]) for r in regs])
+    assert results[0] == results[1]
+    
+    with code(peephole=True):
+        x = var()
+        y = var()
+        x <<= 2
+        y <<= 3
+        z = var(x-y)
+    res = '\n'.join(gen_hex(get_context().code_maker.output, 0x100))
+    assert res == '''
+:020000040000fa
+:0400000080ef00f09d
+:0c010000020e3f6f030e3e6f3f5d3d6f2f
+:00000001ff
+'''.strip()
+
+def test_track_values():
+    from barebits.pic16.lanes import LaneMachine
+    
+    def firmware(track_values):
+        with code(track_values=track_values):
+            port = Variable(PORT28p[1])
+            x = var()
+            y = var()
+            regs = (x.address, y.address)
+            x <<= 5
+            y <<= 5
+            port <<= 5
+            y <<= x + 1
+            with for_(x, 3):
+                port <<= 0
+                port <<= 0
+                y <<= y + x
+        return (get_context().code_maker, regs)
+    
+    (plain, regs) = firmware(False)
+    (tracked, regs) = firmware(True)
+    assert len(plain.output) - len(tracked.output) == 5
+    results = []
+    for code_maker in [plain, tracked]:
+        machine = LaneMachine(1)
+        machine.run(code_maker)
+        results.append([list(machine[r]) for r in regs])
+    assert results[0] == results[1] == [[3], [9]]
+
+def test_liveness_allocator():
+    from barebits.pic16.lanes import LaneMachine
+    
+    def firmware(allocator):
+        with code(allocator=allocator):
+            port = Variable(PORT28p[1])
+            a = var(port + 0)
+            for i in range(80):
+                a = var(a + 1)
+            port <<= a + 0
+            pause()
+            x = var()
+            with for_(x, 3):
+                y = var(x + x)
+                port <<= port + y
+        return get_context().code_maker
+    
+    try:
+        firmware('static')
+    except IndexError:
+        pass
+    else:
+        assert False
+    code_maker = firmware('liveness')
+    assert code_maker.allocation.registers == 86
+    assert code_maker.allocation.peak == 3
+    assert not code_maker.fixups
+    machine = LaneMachine(4)
+    machine[PORT28p[1]] = range(4)
+    machine.run(code_maker, 10**6)
+    assert list(machine[PORT28p[1]]) == [86 + i for i in range(4)]
+
+def test_banked_allocator():
+    from barebits.pic16.lanes import LaneMachine
+    from barebits.pic16.disasm import listing
+    
+    with code(allocator='banked'):
+        port = Variable(PORT28p[1])
+        vs = [var(port + i) for i in range(100)]
+        x = var()
+        with for_(x, 3):
+            for v in vs:
+                v <<= v + x
+        s = var(vs[0] + 0)
+        for v in vs[1:]:
+            s <<= s + v
+        port <<= s + 0
+    
+    code_maker = get_context().code_maker
+    allocation = code_maker.allocation
+    assert allocation.peak == 101
+    # BSR is loaded once, before the loop
+    assert allocation.movlb == 1 and allocation.movlb_cycles == (1, 1)
+    assert listing(code_maker.output).count('MOVLB') == 1
+    machine = LaneMachine(3)
+    machine[PORT28p[1]] = range(3)
+    machine.run(code_maker)
+    assert list(machine[PORT28p[1]]) == [
+            sum(p + i + 3 for i in range(100)) & 0xff for p in range(3)]
+
+def test_relax():
+    from array import array
+    from barebits.code import CodeMaker
+    from barebits.pic16.instructions import standard
+    from barebits.pic16.lanes import LaneMachine
+    from barebits.pic16.disasm import listing
+    
+    def firmware():
+        port = Variable(PORT28p[1])
+        with block():
+            x = var()
+            y = var()
+            y <<= 0
+            with for_(x, 3):
+                for i in range(700):
+                    y <<= y + 1
+                with if_(y&1 != 0):
+                    port.set_bit(7)
+            port <<= y + 0
+    
+    # the loop body is too long for BRA
+    with code(origin=0x100):
+        firmware()
+    code_maker = get_context().code_maker
+    gotos = [(pos, c[1]) for (pos, c) in code_maker.comments.items()
+                if c[0] == 'GOTO']
+    assert len(gotos) == 2 and not code_maker.fixups
+    for (pos, label) in gotos:
+        assert label.address == 0x100 + 2*label.pos
+        assert code_maker.output[pos] == 0xef00 | (label.address>>1) & 0xff
+    machine = LaneMachine(1).run(code_maker)
+    assert machine[PORT28p[1]][0] == 3*700 & 0xff
+    words = len(code_maker.output)
+    
+    # far jumps can not be encoded without an origin
+    try:
+        with code():
+            firmware()
+    except ValueError:
+        pass
+    else:
+        assert False
+    unlinked = CodeMaker(standard)
+    unlinked.do('GOTO', unlinked.label(0))
+    try:
+        list(gen_hex(unlinked, 0x100))
+    except ValueError:
+        pass
+    else:
+        assert False
+    unlinked.link(0x100)
+    assert list(gen_hex(unlinked, 0x100)) == list(gen_hex(
+                                    array('H', [0xef80, 0xf000]), 0x100))
+    
+    # a skip over the body of if_, the same size
+    with code(relax=True, origin=0x100):
+        firmware()
+    code_maker = get_context().code_maker
+    assert len(code_maker.output) == words
+    assert code_maker.relaxation.rules == {'skip': 1}
+    comments = code_maker.comments
+    [bsf] = [pos for pos in comments if comments[pos][0] == 'BSF']
+    assert comments[bsf-1][0] == 'BTFSS'
+    assert LaneMachine(1).run(code_maker)[PORT28p[1]][0] == 3*700 & 0xff
+    
+    # the peephole optimizer shortens the body, the GOTOs become BRAs
+    with code(peephole=True, relax=True):
+        firmware()
+    code_maker = get_context().code_maker
+    relaxation = code_maker.relaxation
+    assert relaxation.rules == {'skip': 1, 'skip_bra': 1, 'bra': 1}
+    assert relaxation.words == 2 and relaxation.cycles == (4, 4)
+    assert not code_maker.labels and 'GOTO' not in listing(code_maker.output)
+    assert LaneMachine(1).run(code_maker)[PORT28p[1]][0] == 3*700 & 0xff
+
+def test_simplify():
+    from barebits.operations import simplify, Operation
+    from barebits.pic16.lanes import LaneMachine
+    
+    with code():
+        port = Variable(PORT28p[1])
+        x = var()
+        y = var()
+        e = simplify((x + 3) + 6)
+        assert e.opname == '+' and e.args[0] is x and e.args[1] == 9
+        assert simplify(Operation('-', (5, 3))) == 2
+        assert simplify((x ^ 5) ^ x) == 5 and simplify(x - x) == 0
+        assert simplify((x & 0xff) | 0) is x and simplify(x & 0) == 0
+        e = simplify(x + 3 == 7)
+        assert e.opname == '==' and e.args[0] is x and e.args[1] == 4
+        e = simplify(x < 5)
+        assert e.opname == '<=' and e.args[1] == 4
+        e = simplify(x > y)
+        assert e.opname == '<' and e.args[0] is y and e.args[1] is x
+        # ports may change between two reads
+        e = simplify(port ^ port, lambda v: v is port)
+        assert e.opname == '^'
+    
+    def firmware():
+        portTRIS = Variable(TRIS28p[1])
+        port = Variable(PORT28p[1])
+        x = var()
+        x <<= port - 3
+        with if_(x + 3 < 20):
+            port <<= (port+3)+(portTRIS+6)-(5-port)
+        with if_(x > port):
+            port <<= (x ^ 0) + (port - port)
+    
+    results = []
+    for simple in (False, True):
+        with code(simplify=simple):
+            firmware()
+        code_maker = get_context().code_maker
+        machine = LaneMachine(256)
+        machine[PORT28p[1]] = range(256)
+        machine[TRIS28p[1]] = 7
+        machine.run(code_maker)
+        results.append((len(code_maker.output), list(machine[PORT28p[1]])))
+    assert results[1][0] < results[0][0] - 5
+    assert results[1][1] == results[0][1]
+
+def test_cse():
+    from barebits.pic16.lanes import LaneMachine
+    
+    def firmware(cse):
+        with code(cse=cse):
+            port = Variable(PORT28p[1])
+            x = var()
+            y = var()
+            y <<= port + 0
+            with for_(x, 8):
+                y <<= y + 1
+                with if_(y&1 != 0):
+                    port.set_bit(7)
+                with if_(y&1 == 0):
+                    port.clear_bit(7)
+                with if_(y&2 != 0):
+                    port.set_bit(6)
+                with if_(y&2 == 0):
+                    port.clear_bit(6)
+                z = var(y + x)
+                port <<= port + ((y + x) ^ 3)
+        return get_context().code_maker
+    
+    plain = firmware(False)
+    reused = firmware(True)
+    # the second y&1 and y&2 are still in WREG with Z set from them, no
+    # SUBLW 0 is needed, and y + x is taken from WREG
+    assert len(plain.output) - len(reused.output) == 11
+    results = []
+    for code_maker in [plain, reused]:
+        machine = LaneMachine(256)
+        machine[PORT28p[1]] = range(256)
+        machine.run(code_maker)
+        results.append(list(machine[PORT28p[1]]))
+    assert results[0] == results[1]
+
+def test_block_cache():
+    import os, shutil, tempfile
+    from barebits.pic16.cache import cached, BlockCache
+    
+    @cached
+    def blink(port, bit, n):
+        x = var()
+        with for_(x, n):
+            y = var(x + port)
+            with if_(y & 1 != 0):
+                port.set_bit(bit)
+    
+    def firmware(**options):
+        with code(**options):
+            port = Variable(PORT28p[1])
+            t = var(port + 1)
+            for i in range(4):
+                blink(port, i, 3)
+                blink(t, i, 3)
+        return get_context().code_maker
+    
+    path = tempfile.mkdtemp()
+    try:
+        cache = BlockCache(path)
+        for allocator in ('static', 'liveness'):
+            plain = firmware(allocator=allocator)
+            cold = firmware(allocator=allocator, cache=cache)
+            warm = firmware(allocator=allocator, cache=cache)
+            assert (cold.cache_stats.hits, cold.cache_stats.misses) == (0, 8)
+            assert (warm.cache_stats.hits, warm.cache_stats.misses) == (8, 0)
+            assert plain.output == cold.output == warm.output
+            assert plain.report().listing() == warm.report().listing()
+        assert len(os.listdir(path)) == 16
+        # the least recently used entries go first
+        size = sum(os.path.getsize(os.path.join(path, x))
+                    for x in os.listdir(path))
+        cache.max_bytes = size - 1
+        cache.evict()
+        assert len(os.listdir(path)) == 15
+        
+        # the functions and values a routine reads from its globals
+        namespace = {'BIT': 1}
+        exec ('def helper(port):\n'
+                '    port.set_bit(BIT)\n'
+                'def bump(port):\n'
+                '    helper(port)\n') in namespace
+        bump = cached(namespace['bump'])
+        def build():
+            with code(cache=cache):
+                bump(Variable(PORT28p[1]))
+            code_maker = get_context().code_maker
+            return (code_maker.cache_stats.hits, code_maker.output)
+        (hits, output) = build()
+        assert (hits, build()) == (0, (1, output))
+        namespace['BIT'] = 2
+        (hits, changed) = build()
+        assert hits == 0 and changed != output
+        exec ('def helper(port):\n'
+                '    port.set_bit(BIT + 1)\n') in namespace
+        (hits, changed) = build()
+        assert hits == 0 and changed != output
+        assert build()[0] == 1
+    finally:
+        shutil.rmtree(path)
+
+def blink(tris, port, n):
+    """ Source of the variants built by test_build """
+    portTRIS = Variable(tris)
+    port = Variable(port)
+    portTRIS.clear_bit(7)
+    x = var()
+    with for_(x, n):
+        with if_(x & 1 != 0):
+            port.set_bit(7)
+        port.clear_bit(7)
+
+def test_build():
+    import os
+    import shutil
+    import tempfile
+    import threading
+    from cStringIO import StringIO
+    from barebits.context import isolated
+    from barebits.pic16.build import Variant, build
+    from barebits.pic16.registers import TRIS40p, PORT40p
+    
+    variants = [Variant('blink28', blink, dict(tris=TRIS28p[1],
+                        port=PORT28p[1], n=10)),
+                Variant('blink40', blink, dict(tris=TRIS40p[3],
+                        port=PORT40p[3], n=10), offset=0x800),
+                Variant('blink40o', blink, dict(tris=TRIS40p[3],
+                        port=PORT40p[3], n=200), offset=0x800,
+                        peephole=True, relax=True, allocator='liveness')]
+    expected = [v.compile().output for v in variants]
+    assert expected[0] != expected[1]
+    
+    # the programs compiled by threads at once do not mix
+    with isolated() as context:
+        with code():
+            outputs = {}
+            def run(v):
+                outputs[v.name] = v.compile().output
+            threads = [threading.Thread(target=run, args=(v,))
+                        for v in variants*4]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            Variable(PORT28p[1]).set_bit(0)
+        assert len(context.code_maker.output) == 1
+    assert [outputs[v.name] for v in variants] == expected
+    
+    path = tempfile.mkdtemp()
+    try:
+        results = build(variants, path, processes=2)
+        assert [r.name for r in results] == [v.name for v in variants]
+        for (v, r, output) in zip(variants, results, expected):
+            assert r.words == len(output)
+            stream = StringIO()
+            write_hex(stream, output, v.offset)
+            assert open(r.path).read() == stream.getvalue()
+        assert sorted(os.listdir(path)) == ['blink28.hex', 'blink40.hex',
+                                            'blink40o.hex']
+    finally:
+        shutil.rmtree(path)
+
+def test_events():
+    from cStringIO import StringIO
+    from barebits import events
+    from barebits.events import (subscribed, TextTrace, Counters,
+                                BinaryTrace, read_trace)
+    
+    text = StringIO()
+    binary = StringIO()
+    with subscribed(Counters()) as counters:
+        with subscribed(TextTrace(text)):
+            with subscribed(BinaryTrace(binary)):
+                with code():
+                    port = Variable(PORT28p[1])
+                    x = var()
+                    with for_(x, 10):
+                        with if_(x & 1 != 0):
+                            port.set_bit(7)
+                    y = var(port + 3)
+                code_maker = get_context().code_maker
+                hex = StringIO()
+                write_hex(hex, code_maker.output, 0x100)
+    assert [e.fire for e in events.EVENTS] == [None]*len(events.EVENTS)
+    
+    names = {}
+    for comment in code_maker.comments.itervalues():
+        names[comment[0]] = names.get(comment[0], 0) + 1
+    assert counters.instructions == names
+    records = hex.getvalue().split()
+    assert counters.events == {'instruction': len(code_maker.comments),
+            'block_open': 3, 'block_close': 3, 'alloc': 2, 'free': 2,
+            'record': len(records)}
+    lines = text.getvalue().splitlines()
+    assert len(lines) == sum(counters.events.values())
+    assert lines[0] == 'alloc 0x3f (BSR)' and lines[-1] == records[-1]
+    assert 'BSF (0x81 (ACCESS), 7)' in lines
+    
+    binary.seek(0)
+    trace = list(read_trace(binary))
+    assert len(trace) == len(lines)
+    assert [b for (e, b, v) in trace if e == 'block_close'] == [
+                                            'if', 'for', 'block']
+    assert ('alloc', 0, 0x3f) in trace and ('free', 0, 0x3f) in trace
+    assert trace[-1] == ('record', 1, 0)
+
+def test_encoders():
+    from barebits.code import CodeMaker
+    from barebits.pic16.instructions import standard, extended, Designator
+    from barebits.pic16.registers import PORT28p
+    
+    r = Designator(0x3f, True)
+    assert standard['MOVFF'].encode(r, PORT28p[1]) == (0xc03f, 0xff81)
+    assert standard['LFSR'].encode(2, 0x123) == (0xee21, 0xf023)
+    assert extended['MOVSF'].encode(5, 0x123) == (0xeb05, 0xf123)
+    assert standard['BRA'].encode(-2) == (0xd7fe,)
+    assert [w.word for w in standard['BSF'].write(r, 7)] == [0x8f3f]
+    # operands out of range are refused instead of wrapping
+    for (table, name, args) in [(standard, 'BSF', (r, 8)),
+            (standard, 'BCF', (r, -1)), (standard, 'MOVLW', (300,)),
+            (standard, 'ANDLW', (-1,)), (standard, 'MOVLB', (16,)),
+            (extended, 'ADDFSR', (1, 0x40)), (extended, 'SUBFSR', (3, 1)),
+            (extended, 'ADDULNK', (0x40,)), (standard, 'LFSR', (3, 0)),
+            (standard, 'LFSR', (0, 0x1000)), (extended, 'MOVSF', (0x80, 0)),
+            (extended, 'MOVSS', (-1, 0)), (standard, 'BZ', (128,)),
+            (standard, 'BNN', (-129,)), (standard, 'BRA', (1024,)),
+            (standard, 'RCALL', (-1025,))]:
+        try:
+            table[name].encode(*args)
+            assert False, (name, args)
+        except ValueError:
+            pass
+    assert standard['BZ'].encode(-128) == (0xe080,)
+    assert standard['BN'].encode(127) == (0xe67f,)
+    assert standard['RCALL'].encode(-1024) == (0xdc00,)
+    assert standard['BRA'].encode(1023) == (0xd3ff,)
+    assert extended['ADDFSR'].encode(2, 0x3f) == (0xe8bf,)
+    assert extended['MOVSS'].encode(0x7f, 0x7f) == (0xebff, 0xf07f)
+    
+    sequence = [('MOVLW', (3,)), (standard['ADDWF'], (r, True)),
+                ('BTFSC', (r, 1)), ('MOVFF', (r, PORT28p[1])),
+                (standard['BNZ'], (-5,))]
+    one = CodeMaker(standard)
+    for (instruction, args) in sequence:
+        if not isinstance(instruction, str):
+            instruction = instruction.name
+        one.do(instruction, *args)
+    batch = CodeMaker(standard)
+    batch.emit(sequence)
+    assert batch.output == one.output and len(batch.output) == 6
+    assert batch.comments == one.comments
+    assert batch.cycles == one.cycles == (6, 9)
+
+def test_lazy_tables():
+    from barebits.pic16.instructions import (InstructionTable, standard,
+                                            extended, ArgInstr)
+    from barebits.pic16.registers import FieldRegister, BitRegister
+    
+    table = InstructionTable(standard, [(ArgInstr, 'PUSHL', '1110 1010', 8)])
+    assert dict.__len__(table) == 0
+    # the stamp comes from the specs, no instruction is created
+    assert table.stamp not in (standard.stamp, extended.stamp)
+    assert table.stamp == InstructionTable(standard,
+                                table.specs.values()).stamp
+    assert dict.__len__(table) == 0
+    assert table['MOVFF'] is standard['MOVFF']
+    assert table['PUSHL'].encode(3) == (0xea03,)
+    assert dict.__len__(table) == 2 and len(table) == len(standard) + 1
+    assert 'PUSHL' in table and 'PUSHL' not in standard
+    assert sorted(table) == sorted(x.name for x in table.values())
+    assert extended['BZ'].cycles == (1, 2) and standard['NOP'].cycles == (1, 1)
+    
+    reg = FieldRegister('T', 0xfa0, [('A', 3), (None, 6), ('B', 2)])
+    assert 'regs' not in vars(reg)
+    assert (reg.B.reg.address, reg.B.pos1) == (0xa1, 9)
+    assert len(reg.regs) == 2 and sorted(reg.fields) == ['A', 'B']
+    assert not hasattr(reg, 'C') and not hasattr(reg, 'bits')
+    reg = BitRegister('U', 0xfa0, '0101')
+    assert [b and b.ind for b in reg.bits] == [0, None, 2, None]
+
+def test_devices():
+    from barebits.pic16 import devices, registers
+    from barebits.pic16.instructions import standard, extended
+    from barebits.pic16.disasm import listing
+    from barebits.pic16.registers import TRIS40p
+    
+    assert 'pic18f4550' in devices.names() and 'pic18f452' in devices.names()
+    d = devices.device('pic18f4550')
+    assert devices.device('pic18f4550') is d
+    assert (d.flash, d.ram, d.access, d.instructions) == (0x8000, 0x800,
+                                                        0x60, extended)
+    (regs, bits) = registers._index()
+    for (address, reg) in regs.items():
+        assert d.find_register(address).name == reg.name
+    for (key, name) in bits.items():
+        assert d.find_bit(*key) == name
+    assert d.field('GIE').reg.address == 0xf2 and d['PLUSW2'].address == 0xdb
+    assert [r.name for r in d.group('TRIS')] == [r.name for r in TRIS40p]
+    old = devices.device('pic18f452')
+    assert (old.access, old.instructions) == (0x80, standard)
+    assert old.find_bit(0xfd3, 3) is None and d.find_bit(0xfd3, 3) == 'OSTS'
+    try:
+        devices.device('_pic18')
+    except ValueError:
+        pass
+    else:
+        assert False
+    
+    def many():
+        port = Variable(old['PORTD'])
+        xs = [var(port + i) for i in range(150)]
+        port <<= port + xs[0]
+        for x in xs:
+            port <<= port + x
+    for name in ('pic18f4550', 'pic18f452'):
+        with code(allocator='banked', device=name):
+            many()
+        code_maker = get_context().code_maker
+        d = devices.device(name)
+        assert code_maker.allocation.peak == 150
+        text = listing(code_maker.output, device=d) + '\n'
+        access = d.access
+        assert 'MOVWF 0x%02x\n' % (access - 1) in text
+        assert 'MOVWF 0x%02x\n' % access not in text
+        assert 'MOVWF 0x%02x, BANKED\n' % access in text
+    with code(device='pic18f452'):
+        Variable(old['OSCCON']).set_bit(3)
+        x = var(1)
+    code_maker = get_context().code_maker
+    assert code_maker.output[0] == 0x86d3
+    assert listing(code_maker.output[:1]) == (
+                                        '0000: 86d3       BSF OSCCON, OSTS')
+    assert listing(code_maker.output[:1], device=old) == (
+                                            '0000: 86d3       BSF OSCCON, 3')
+    try:
+        with code(origin=0x5ff8, device='pic18f2455'):
+            many()
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_sim():
+    from barebits.pic16.sim import Machine, simulate
+    from barebits.pic16.instructions import Designator, fullAddress
+    
+    # the simulated cycles of straight loops are the ones of the report
+    with code(origin=0x100):
+        port = Variable(PORT28p[1])
+        with block():
+            x = var()
+            with for_(x, 10):
+                y = var()
+                with for_(y, 3, 20):
+                    port <<= port + y
+    code_maker = get_context().code_maker
+    machine = simulate(code_maker, 0x100)
+    assert code_maker.cycles == (machine.cycles, machine.cycles) == (2037,
+                                                                    2037)
+    assert machine[0xf81] == 10*sum(range(3, 20)) & 0xff
+    
+    for options in [{}, dict(allocator='banked', peephole=True),
+                    dict(simplify=True, cse=True)]:
+        with code(origin=0x100, **options):
+            a = var()
+            b = var()
+            r = var()
+            s = var(0)
+            r <<= (a - b) ^ (a + 3)
+            with if_(a > b):
+                r <<= r + 1
+            with while_(b != 0):
+                s <<= s + a
+                b <<= b - 1
+            addresses = (a.address, b.address, r.address, s.address)
+        machine = Machine()
+        for (address, value) in zip(addresses, (100, 7)):
+            machine[address] = value
+        machine.run(get_context().code_maker.output, 0x100)
+        assert machine[addresses[2]] == ((100 - 7) ^ 103) + 1
+        assert machine[addresses[3]] == 700 & 0xff
+        assert set(fullAddress(x) for x in addresses) <= machine.used
+    
+    machine = Machine()
+    machine.run([0xe001, 0x0e05, 0x0e07])     # BZ +1 over MOVLW 5
+    assert (machine[0xfe8], machine.cycles, machine.steps) == (7, 3, 3)
+    machine.run([0x84d8, 0xe001, 0x0e05, 0x0e07])     # BSF STATUS, Z
+    assert (machine[0xfe8], machine.cycles, machine.steps) == (7, 4, 3)
+    machine.run([0xa4d8, 0xc001, 0xf002, 0x0e09])  # BTFSS STATUS, Z; MOVFF
+    assert (machine[2], machine.cycles) == (0, 4)
+    machine[Designator(0x10, True)] = 3
+    assert machine[0x010] == 3
+    # a skip as the last instruction
+    machine = Machine()
+    machine.run([0x0e05, 0x6610])       # MOVLW 5; TSTFSZ 0x10
+    assert (machine[0xfe8], machine.cycles, machine.steps) == (5, 3, 2)
+    # PLUSW0 adds WREG as a signed offset
+    machine = Machine()
+    machine[0x10f] = 7
+    machine.run([0xee01, 0xf010, 0x0eff, 0x50eb])   # LFSR 0, 0x110;
+    assert machine[0xfe8] == 7                      # MOVLW -1; MOVF PLUSW0
+    # INCF POSTINC0, F increments FSR0 once
+    machine = Machine()
+    machine[0x20] = 4
+    machine.run([0xee00, 0xf020, 0x2aee])   # LFSR 0, 0x20; INCF POSTINC0
+    assert (machine[0x20], machine[0x21], machine[0xfe9]) == (5, 0, 0x21)
+    
+    # Machine and LaneMachine agree on the code of the ALU
+    from barebits import operations
+    from barebits.pic16.alu import var16
+    from barebits.code import do
+    from barebits.pic16.lanes import LaneMachine
+    values = [0, 1, 2, 0x0f, 0x10, 0x7f, 0x80, 0x81, 0xc3, 0xfe, 0xff]
+    pairs = [(a, b) for a in values for b in values]
+    def assign(name, literal=None):
+        def snippet(x, y, z):
+            z <<= operations.Operation(name, (x, literal or y))
+        return snippet
+    def compare(name):
+        def snippet(x, y, z):
+            with if_(operations.Operation(name, (x, y))):
+                z <<= 1
+        return snippet
+    def count(x, y, z):
+        with for_(z, 3):
+            x <<= (x ^ y) + 1
+    def wide(x, y, z):
+        v = var16(x)
+        v <<= v + y - 0x1234
+        v <<= v*3
+        z <<= v ^ 0
+    def raw(x, y, z):
+        (x, y, z) = (x.address, y.address, z.address)
+        # the instructions the ALU does not use
+        for args in [('MOVLB', 0), ('MOVF', y, False), ('SUBFWB', x, True),
+                ('SUBWFB', z, True), ('RLCF', x, True), ('SWAPF', y, True),
+                ('COMF', z, True), ('IORLW', 0x21), ('CPFSEQ', x),
+                ('BTG', z, 3), ('CPFSGT', y), ('BCF', x, 0), ('CPFSLT', z),
+                ('SETF', z), ('BTFSC', x, 2), ('INCFSZ', y, True),
+                ('DECFSZ', x, True), ('INFSNZ', z, False),
+                ('DCFSNZ', y, True), ('NOP',), ('ADDWF', z, True)]:
+            do(*args)
+    snippets = ([assign(name) for name in operations.binary_ops
+                    if name not in operations.literal_ops] +
+                [assign(name, k) for name in ('*', '//') for k in (4, 7)] +
+                [assign('-', 7)] +
+                [compare(name) for name in operations.comp_ops] +
+                [count, wide, raw])
+    for snippet in snippets:
+        with code():
+            (x, y, z) = (var(), var(), var())
+            snippet(x, y, z)
+            (x, y) = (x.address, y.address)
+        code_maker = get_context().code_maker
+        lanes = LaneMachine(len(pairs))
+        lanes[x] = [a for (a, b) in pairs]
+        lanes[y] = [b for (a, b) in pairs]
+        lanes.run(code_maker)
+        for (i, (a, b)) in enumerate(pairs):
+            machine = Machine()
+            machine[x] = a
+            machine[y] = b
+            machine.run(code_maker.output)
+            for address in (set(lanes.regs) | machine.used |
+                            set(range(0xf60, 0x1000))):
+                expected = lanes.regs.get(address)
+                expected = 0 if expected is None else expected[i]
+                assert machine[address] == expected, (snippet, a, b,
+                                                        hex(address))
+
+def test_countdown():
+    from barebits.pic16.sim import simulate
+    from barebits.pic16.disasm import listing
+    
+    def loops():
+        port = Variable(PORT28p[1])
+        pause()
+        x = var()
+        with for_(x, 256):
+            port.set_bit(0)
+        with for_(x, 3, 10):
+            port <<= port + x
+        with for_(x, 5):
+            pass
+        return x.address
+    
+    with code(origin=0x100):
+        loops()
+    plain = get_context().code_maker
+    for options in [{}, dict(allocator='liveness', peephole=True, 
+                            relax=True)]:
+        with code(origin=0x100, countdown=True, **options):
+            x = loops()
+        code_maker = get_context().code_maker
+        machine = simulate(code_maker, 0x100)
+        assert code_maker.cycles == (machine.cycles, machine.cycles)
+        assert machine.cycles < plain.cycles[0]/3
+        assert machine[0xf81] == sum(range(3, 10)) | 1
+        assert machine[x] == 0
+        text = listing(code_maker.output, 0x100)
+        assert text.count('DECFSZ') == 5
+        # the loop using its variable is compiled as usual
+        assert text.count('SUBLW') == 1
+    [main] = code_maker.report().children
+    loop = main.children[0].children[0]
+    # 100 times: 2 cycles to set y, 99*34 + 33 cycles of its loop, DECFSZ
+    # and BRA
+    assert (loop.kind, loop.iterations, loop.iteration) == ('for', 100,
+                                                            (3404, 3404))
+
+def test_delay():
+    from barebits.pic16.control import (delay_cycles, delay_us, plan_delay,
+                                        _plan_cycles)
+    from barebits.pic16.sim import simulate
+    
+    for options in [{}, dict(allocator='liveness', peephole=True,
+                            relax=True)]:
+        for n in [0, 1, 2, 9, 11, 1000, 123457]:
+            with code(origin=0x100, **options):
+                port = Variable(PORT28p[1])
+                port <<= port + 1
+                delay_cycles(n, name='wait')
+                port <<= port + 1
+            code_maker = get_context().code_maker
+            machine = simulate(code_maker, 0x100)
+            assert machine[0xf81] == 2
+            assert machine.cycles - 6 == n
+            assert code_maker.cycles == (machine.cycles, machine.cycles)
+            [main] = code_maker.report().children
+            [wait] = main.children
+            assert (wait.kind, wait.name, wait.cycles) == ('delay', 'wait',
+                                                            (n, n))
+            assert len(machine.used) <= 3
+    # too long to simulate
+    for n in [10**6, 10**8, 10**10]:
+        assert _plan_cycles(plan_delay(n)) == n
+    # the padding survives the peephole optimizer
+    assert plan_delay(11) == [('loop', 3, []), ('pad', 2)]
+    assert plan_delay(11) is plan_delay(11)
+    with code(peephole=True):
+        delay_cycles(11)
+    assert len(get_context().code_maker.output) == 4
+    with code():
+        delay_us(250, 48000000)
+    code_maker = get_context().code_maker
+    assert code_maker.cycles == (3000, 3000)
+    assert simulate(code_maker).cycles == 3000
+    try:
+        delay_cycles(-1)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_long():
+    from barebits.pic16.alu import var16, var24, var32, LongVariable
+    from barebits.pic16.registers import TMR
+    from barebits.pic16.instructions import fullAddress
+    from barebits.pic16.sim import Machine, simulate
+    from barebits.pic16.disasm import listing
+    
+    def firmware():
+        port = Variable(PORT28p[1])
+        a = var32()
+        b = var32()
+        c = var()
+        r = [var32() for i in range(6)]
+        r[0] <<= a + b
+        r[1] <<= (a - b) ^ (a & 0xff00ff)
+        r[2] <<= b - a - 1000
+        r[3] <<= a
+        r[3] += 1
+        r[4] <<= 5 - c + a
+        r[5] <<= 0
+        with if_(a < b):
+            r[5] += 1
+        with if_(a == b):
+            r[5] += 2
+        with if_(a != 70000):
+            r[5] += 4
+        with if_(c + 300 > a):
+            r[5] += 8
+        with if_(b == 0):
+            r[5] += 16
+        for x in r:
+            for address in x.addresses:
+                port <<= Variable(address)
+        return [a.addresses, b.addresses, [c.address]] + [x.addresses
+                                                            for x in r]
+    
+    cases = [(0, 0, 0), (70000, 70001, 3), (0xffffffff, 0, 200),
+            (0x12345678, 0x12345678, 0x55), (299, 0x100, 0xff)]
+    for options in [{}, dict(peephole=True, relax=True),
+                    dict(allocator='liveness', peephole=True),
+                    dict(allocator='banked', peephole=True),
+                    dict(simplify=True, cse=True)]:
+        for (a, b, c) in cases:
+            with code(origin=0x100, **options):
+                registers = firmware()
+            code_maker = get_context().code_maker
+            machine = Machine()
+            for (addresses, value) in zip(registers, (a, b, c)):
+                for (i, address) in enumerate(addresses):
+                    machine[address] = value >> 8*i
+            machine.run(code_maker.output, 0x100)
+            res = [sum(machine[x] << 8*i for (i, x) in enumerate(addresses))
+                    for addresses in registers[3:]]
+            m = 2**32
+            assert res == [(a + b) % m, ((a - b) % m) ^ (a & 0xff00ff),
+                (b - a - 1000) % m, (a + 1) % m, (5 - c + a) % m,
+                (a < b) + 2*(a == b) + 4*(a != 70000) + 8*(c + 300 > a) +
+                16*(b == 0)]
+            assert code_maker.cycles[0] <= machine.cycles
+            assert machine.cycles <= code_maker.cycles[1]
+            # the bytes of a variable are consecutive
+            for addresses in registers[:2] + registers[3:]:
+                full = [fullAddress(x) for x in addresses]
+                assert full == range(full[0], full[0] + 4)
+    
+    # increments and decrements in place
+    with code():
+        x = var16()
+        y = var24()
+        x += 1
+        y -= 1
+    code_maker = get_context().code_maker
+    assert listing(code_maker.output).split('\n')[:2] == [
+                '0000: 4b3e       INFSNZ 0x3e, F, BANKED',
+                '0002: 2b3f       INCF 0x3f, F, BANKED']
+    assert len(code_maker.output) == 6 and code_maker.cycles == (6, 6)
+    
+    # the comparison stops at the first bytes which differ
+    steps = []
+    for (x, y) in [(0x1234, 0x1334), (0x1234, 0x1235), (0x1234, 0x1234)]:
+        with code(origin=0x100):
+            a = var16(x)
+            b = var16(y)
+            with if_(a >= b):
+                Variable(PORT28p[1]).set_bit(0)
+        machine = simulate(get_context().code_maker, 0x100)
+        assert machine[0xf81] == (x >= y)
+        steps.append(machine.steps)
+    assert steps[0] == steps[1] - 2
+    
+    # timers: the low byte is read first and written last
+    with code():
+        t = var16()
+        t <<= t + TMR[1]
+        LongVariable(TMR[3]).assign(t)
+    text = listing(get_context().code_maker.output)
+    assert text.index('TMR10') < text.index('TMR11')
+    assert text.index('TMR31') < text.index('TMR30')
+
+def test_mul():
+    from barebits.pic16.alu import var16, var32
+    from barebits.pic16.sim import Machine
+    from barebits.pic16.disasm import listing
+    from barebits.pic16.muldiv import magic
+    
+    def firmware(k, d):
+        port = Variable(PORT28p[1])
+        a = var32()
+        b = var16()
+        c = var()
+        r = [var32() for i in range(4)] + [var16() for i in range(2)]
+        r8 = [var() for i in range(3)]
+        r[0] <<= a * b
+        r[1] <<= a * k
+        r[2] <<= a // d
+        r[3] <<= a
+        r[3] *= 4
+        r[4] <<= (b + c) * (c + 1)
+        r[5] <<= b
+        r[5] //= 10
+        r8[0] <<= a // d
+        r8[1] <<= c * k + b
+        r8[2] <<= c // 7 - c // 10
+        for x in r:
+            for address in x.addresses:
+                port <<= Variable(address)
+        for x in r8:
+            port <<= x
+        return ([a.addresses, b.addresses, [c.address]] +
+                [x.addresses for x in r] + [[x.address] for x in r8])
+    
+    cases = [(0, 0, 0, 3, 1), (0xffffffff, 0xffff, 0xff, 0xffff, 12345),
+            (0x12345678, 0x9abc, 0x5a, 10, 0xffffffff),
+            (70000, 257, 200, 0x8000, 3), (123456789, 1000, 99, 1, 256)]
+    for options in [{}, dict(peephole=True, relax=True),
+                    dict(allocator='liveness', peephole=True),
+                    dict(simplify=True, cse=True)]:
+        for (a, b, c, k, d) in cases:
+            with code(origin=0x100, **options):
+                registers = firmware(k, d)
+            code_maker = get_context().code_maker
+            machine = Machine()
+            for (addresses, value) in zip(registers, (a, b, c)):
+                for (i, address) in enumerate(addresses):
+                    machine[address] = value >> 8*i
+            machine.run(code_maker.output, 0x100)
+            res = [sum(machine[x] << 8*i for (i, x) in enumerate(addresses))
+                    for addresses in registers[3:]]
+            m = 2**32
+            assert res == [a*b % m, a*k % m, a//d, a*4 % m,
+                (b + c)*(c + 1) % 2**16, b//10, a//d % 256,
+                (c*k + b) % 256, (c//7 - c//10) % 256]
+            assert code_maker.cycles[0] <= machine.cycles
+            assert machine.cycles <= code_maker.cycles[1]
+    
+    # the cheapest of MULLW and shifts
+    for (k, words, mul) in [(16, 3, False), (3, 4, False), (10, 4, True),
+                            (128, 3, False)]:
+        with code():
+            x = var()
+            y = var(x * k)
+        text = listing(get_context().code_maker.output)
+        assert len(get_context().code_maker.output) == words
+        assert ('MULLW' in text) == mul
+    with code():
+        x = var16()
+        x *= 2
+    assert listing(get_context().code_maker.output).split('\n')[1:3] == [
+                '0002: 373e       RLCF 0x3e, F, BANKED',
+                '0004: 373f       RLCF 0x3f, F, BANKED']
+    
+    # the reciprocals are exact for all the bytes
+    for d in range(1, 256):
+        (m, s) = magic(d, 8)
+        assert all(x*m >> 8 + s == x//d for x in range(256))
+    
+    try:
+        with code():
+            x = var()
+            x <<= 100 // x
+    except ValueError:
+        pass
+    else:
+        assert False
+
 test1()
 test2()
 test3()
+test_code_buffer()
+test_encoders()
+test_lazy_tables()
+test_write_hex()
+test_read_hex()
+test_alu_lanes()
+test_disassemble()
+test_report()
+test_peephole()
+test_track_values()
+test_liveness_allocator()
+test_banked_allocator()
+test_relax()
+test_simplify()
+test_cse()
+test_block_cache()
+test_build()
+test_devices()
+test_sim()
+test_countdown()
+test_delay()
+test_long()
+test_events()
+test_mul()